@@ -5,7 +5,15 @@ from lnbits.tasks import create_permanent_unique_task
 from loguru import logger
 
 from .crud import db
-from .tasks import cleanup_empty_chats, wait_for_paid_invoices
+from .pubsub import chat_pubsub
+from .tasks import (
+    archive_chats,
+    cleanup_empty_chats,
+    expire_chat_payments,
+    refresh_fiat_rates,
+    run_outbox,
+    wait_for_paid_invoices,
+)
 from .views import chat_generic_router
 from .views_api import chat_api_router
 from .views_lnurl import chat_lnurl_router
@@ -39,6 +47,16 @@ def chat_start():
     scheduled_tasks.append(task)
     cleanup_task = create_permanent_unique_task("ext_chat_cleanup", cleanup_empty_chats)
     scheduled_tasks.append(cleanup_task)
+    outbox_task = create_permanent_unique_task("ext_chat_outbox", run_outbox)
+    scheduled_tasks.append(outbox_task)
+    archive_task = create_permanent_unique_task("ext_chat_archive", archive_chats)
+    scheduled_tasks.append(archive_task)
+    rates_task = create_permanent_unique_task("ext_chat_rates", refresh_fiat_rates)
+    scheduled_tasks.append(rates_task)
+    payments_task = create_permanent_unique_task("ext_chat_payments", expire_chat_payments)
+    scheduled_tasks.append(payments_task)
+    pubsub_task = create_permanent_unique_task("ext_chat_pubsub", chat_pubsub.run)
+    scheduled_tasks.append(pubsub_task)
 
 
 __all__ = [
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any
+
+
+class TTLCache:
+    """
+    Small per-process LRU cache with a time to live per entry.
+    Values are shared between callers, treat them as read-only.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 60) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+
+    def get(self, key: str) -> Any | None:
+        cached = self._values.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        value, expiry = cached
+        if expiry <= monotonic():
+            self._values.pop(key, None)
+            self.misses += 1
+            return None
+        self._values.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._values[key] = (value, monotonic() + self.ttl)
+        self._values.move_to_end(key)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: str) -> None:
+        self._values.pop(key, None)
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._values),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Categories change rarely but are read on every public request.
+# The TTL bounds how long other workers may serve a stale copy.
+categories_cache = TTLCache("categories", maxsize=1024, ttl=60)
+
+# Resolved payout wallet ids, keyed by `category:<id>` and `user:<id>`.
+wallets_cache = TTLCache("wallets", maxsize=2048, ttl=60)
+
+
+def cache_stats() -> dict:
+    return {cache.name: cache.stats() for cache in (categories_cache, wallets_cache)}
@@ -1,18 +1,94 @@
-from lnbits.db import DB_TYPE, POSTGRES, SQLITE, Database, Filters, Page
+import base64
+import json
+import zlib
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+from lnbits.db import (
+    POSTGRES,
+    SQLITE,
+    Connection,
+    Database,
+    Filters,
+    Page,
+    dict_to_model,
+    insert_query,
+    model_to_dict,
+    update_query,
+)
 from lnbits.helpers import urlsafe_short_hash
+from pydantic import BaseModel
+from sqlalchemy import text  # type: ignore[import]
 
+from .cache import categories_cache, wallets_cache
 from .models import (
+    ArchivedChat,
+    ArchivedChatsFilters,
     Categories,
     CategoriesFilters,
+    ChatEvent,
+    ChatMessage,
     ChatPayment,
+    ChatSearchHit,
     ChatSession,
     ChatsFilters,
+    ChatSummary,
     CreateCategories,
+    OutboxJob,
 )
 
 db = Database("ext_chat")
 
 
+class _TransactionConnection(Connection):
+    """
+    Connection that leaves committing to `transaction()`, so the crud calls
+    made with it are applied together or not at all.
+    """
+
+    async def execute(self, query: str, values: dict | None = None):
+        params = self.rewrite_values(values) if values else {}
+        return await self.conn.execute(text(self.rewrite_query(query)), params)
+
+    async def insert(self, table_name: str, model: BaseModel) -> None:
+        await self.conn.execute(text(insert_query(table_name, model)), model_to_dict(model))
+
+    async def update(self, table_name: str, model: BaseModel, where: str = "WHERE id = :id") -> None:
+        await self.conn.execute(text(update_query(table_name, model, where)), model_to_dict(model))
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[Connection]:
+    async with db.connect() as conn:
+        tx = _TransactionConnection(conn.conn, conn.type, conn.name, conn.schema)
+        try:
+            yield tx
+        except BaseException:
+            await conn.conn.rollback()
+            raise
+        await conn.conn.commit()
+
+
+@asynccontextmanager
+async def _connection(conn: Connection | None = None) -> AsyncIterator[Connection]:
+    if conn:
+        yield conn
+        return
+    async with transaction() as tx:
+        yield tx
+
+
+async def _execute_verbatim(conn: Connection, query: str, values: dict):
+    """
+    `Connection.execute` strips anything that looks like HTML from string
+    values, which changes stored JSON and text. This binds them as given,
+    with datetimes as timestamps like `model_to_dict`. Does not commit.
+    """
+    params = {key: value.timestamp() if isinstance(value, datetime) else value for key, value in values.items()}
+    return await conn.conn.execute(text(conn.rewrite_query(query)), params)
+
+
 ########################### Categories ############################
 async def create_categories(user_id: str, data: CreateCategories) -> Categories:
     categories = Categories(**data.dict(), id=urlsafe_short_hash(), user_id=user_id)
@@ -24,20 +100,19 @@ async def get_categories(
     user_id: str,
     categories_id: str,
 ) -> Categories | None:
-    return await db.fetchone(
-        """
-            SELECT * FROM chat.categories
-            WHERE id = :id AND user_id = :user_id
-        """,
-        {"id": categories_id, "user_id": user_id},
-        Categories,
-    )
+    categories = await get_categories_by_id(categories_id)
+    if not categories or categories.user_id != user_id:
+        return None
+    return categories
 
 
 async def get_categories_by_id(
     categories_id: str,
 ) -> Categories | None:
-    return await db.fetchone(
+    cached = categories_cache.get(categories_id)
+    if cached:
+        return cached
+    categories = await db.fetchone(
         """
             SELECT * FROM chat.categories
             WHERE id = :id
@@ -45,6 +120,9 @@ async def get_categories_by_id(
         {"id": categories_id},
         Categories,
     )
+    if categories:
+        categories_cache.set(categories_id, categories)
+    return categories
 
 
 async def get_categories_ids_by_user(
@@ -61,6 +139,16 @@ async def get_categories_ids_by_user(
     return [row["id"] for row in rows]
 
 
+async def get_categories_with_retention() -> list[Categories]:
+    return await db.fetchall(
+        """
+            SELECT * FROM chat.categories
+            WHERE archive_resolved_days > 0 OR archive_idle_days > 0
+        """,
+        model=Categories,
+    )
+
+
 async def get_categories_paginated(
     user_id: str | None = None,
     filters: Filters[CategoriesFilters] | None = None,
@@ -82,6 +170,8 @@ async def get_categories_paginated(
 
 async def update_categories(data: Categories) -> Categories:
     await db.update("chat.categories", data)
+    categories_cache.pop(data.id)
+    wallets_cache.pop(f"category:{data.id}")
     return data
 
 
@@ -93,18 +183,39 @@ async def delete_categories(user_id: str, categories_id: str) -> None:
         """,
         {"id": categories_id, "user_id": user_id},
     )
+    categories_cache.pop(categories_id)
+    wallets_cache.pop(f"category:{categories_id}")
 
 
 ################################# Chats ###########################
 
+CHAT_SUMMARY_COLUMNS = ", ".join(ChatSummary.__fields__.keys())
+
 
 async def create_chat(categories_id: str, chat: ChatSession) -> ChatSession:
     await db.insert("chat.chats", chat)
     return chat
 
 
-async def get_chat(chat_id: str) -> ChatSession | None:
-    return await db.fetchone(
+async def create_chat_if_missing(chat: ChatSession) -> bool:
+    """
+    Insert the chat unless a row with its id exists already, so concurrent
+    first writes to a provisional chat create it once. An archived chat is not
+    created again from its token. True if it was inserted.
+    """
+    async with transaction() as conn:
+        if await conn.fetchone("SELECT id FROM chat.chats_archive WHERE id = :id", {"id": chat.id}):
+            return False
+        result = await _execute_verbatim(
+            conn,
+            f"{insert_query('chat.chats', chat)} ON CONFLICT (id) DO NOTHING",
+            model_to_dict(chat),
+        )
+    return result.rowcount == 1
+
+
+async def get_chat(chat_id: str, include_messages: bool = True, conn: Connection | None = None) -> ChatSession | None:
+    chat: ChatSession | None = await (conn or db).fetchone(
         """
             SELECT * FROM chat.chats
             WHERE id = :id
@@ -112,10 +223,13 @@ async def get_chat(chat_id: str) -> ChatSession | None:
         {"id": chat_id},
         ChatSession,
     )
+    if chat and include_messages:
+        chat.messages = [message.dict() for message in await get_chat_messages(chat.id, conn=conn)]
+    return chat
 
 
-async def get_chat_for_category(categories_id: str, chat_id: str) -> ChatSession | None:
-    return await db.fetchone(
+async def get_chat_for_category(categories_id: str, chat_id: str, include_messages: bool = True) -> ChatSession | None:
+    chat: ChatSession | None = await db.fetchone(
         """
             SELECT * FROM chat.chats
             WHERE id = :id AND categories_id = :categories_id
@@ -123,38 +237,125 @@ async def get_chat_for_category(categories_id: str, chat_id: str) -> ChatSession
         {"id": chat_id, "categories_id": categories_id},
         ChatSession,
     )
+    if chat and include_messages:
+        chat.messages = [message.dict() for message in await get_chat_messages(chat.id)]
+    return chat
 
 
 async def get_chats_paginated(
-    categories_ids: list[str] | None = None,
+    user_id: str,
+    categories_id: str | None = None,
     filters: Filters[ChatsFilters] | None = None,
-) -> Page[ChatSession]:
-
-    if not categories_ids:
-        return Page(data=[], total=0)
-
-    where = []
-    values = {}
-    id_clause = []
-    for i, item_id in enumerate(categories_ids):
-        categories_id = f"categories_id__{i}"
-        id_clause.append(f"categories_id = :{categories_id}")
-        values[categories_id] = item_id
-    or_clause = " OR ".join(id_clause)
-    where.append(f"({or_clause})")
+) -> Page[ChatSummary]:
+    where = ["categories_id IN (SELECT id FROM chat.categories WHERE user_id = :user_id)"]
+    values = {"user_id": user_id}
+    if categories_id:
+        where.append("categories_id = :categories_id")
+        values["categories_id"] = categories_id
 
     return await db.fetch_page(
-        "SELECT * FROM chat.chats",
+        f"SELECT {CHAT_SUMMARY_COLUMNS} FROM chat.chats",
         where=where,
         values=values,
         filters=filters,
-        model=ChatSession,
+        model=ChatSummary,
     )
 
 
-async def update_chat(chat: ChatSession) -> ChatSession:
-    await db.update("chat.chats", chat)
-    return chat
+async def update_chat(chat: ChatSession) -> ChatSession | None:
+    """
+    Write the fields owned by the chat row, the balance and message counters
+    are only changed in SQL. Applies only if the row is still at the version
+    that was read, returns None when another writer got there first.
+    """
+    return await _update_chat_returning(
+        f"""
+            UPDATE chat.chats
+            SET title = :title,
+                resolved = :resolved,
+                unread = :unread,
+                public_url = :public_url,
+                claimed_by_id = :claimed_by_id,
+                claimed_by_name = :claimed_by_name,
+                participants = :participants,
+                updated_at = {db.timestamp_placeholder("updated_at")},
+                version = version + 1
+            WHERE id = :id AND version = :version
+            RETURNING *
+        """,
+        {
+            "id": chat.id,
+            "version": chat.version,
+            "title": chat.title,
+            "resolved": chat.resolved,
+            "unread": chat.unread,
+            "public_url": chat.public_url,
+            "claimed_by_id": chat.claimed_by_id,
+            "claimed_by_name": chat.claimed_by_name,
+            "participants": json.dumps(chat.participants),
+            "updated_at": chat.updated_at,
+        },
+    )
+
+
+async def update_chat_activity(chat: ChatSession, conn: Connection | None = None) -> ChatSession | None:
+    return await _update_chat_returning(
+        f"""
+            UPDATE chat.chats
+            SET last_message_at = {db.timestamp_placeholder("last_message_at")},
+                last_message_preview = :last_message_preview,
+                message_count = message_count + 1,
+                unread = :unread,
+                updated_at = {db.timestamp_placeholder("updated_at")},
+                version = version + 1
+            WHERE id = :id
+            RETURNING *
+        """,
+        {
+            "id": chat.id,
+            "last_message_at": chat.last_message_at,
+            "last_message_preview": chat.last_message_preview,
+            "unread": chat.unread,
+            "updated_at": chat.updated_at,
+        },
+        conn=conn,
+    )
+
+
+async def _update_chat_returning(query: str, values: dict, conn: Connection | None = None) -> ChatSession | None:
+    async with _connection(conn) as tx:
+        result = await _execute_verbatim(tx, query, values)
+        row = result.mappings().first()
+        result.close()
+    return dict_to_model(row, ChatSession) if row else None
+
+
+async def credit_chat_balance(chat_id: str, amount: int, conn: Connection | None = None) -> ChatSession | None:
+    return await _update_chat_returning(
+        f"""
+            UPDATE chat.chats
+            SET balance = balance + :amount,
+                updated_at = {db.timestamp_placeholder("updated_at")}
+            WHERE id = :id
+            RETURNING *
+        """,
+        {"id": chat_id, "amount": amount, "updated_at": datetime.now(timezone.utc)},
+        conn=conn,
+    )
+
+
+async def debit_chat_balance(chat_id: str, amount: int, conn: Connection | None = None) -> ChatSession | None:
+    return await _update_chat_returning(
+        f"""
+            UPDATE chat.chats
+            SET balance = balance - :amount,
+                updated_at = {db.timestamp_placeholder("updated_at")}
+            WHERE id = :id AND balance >= :amount
+            RETURNING *
+        """,
+        {"id": chat_id, "amount": amount, "updated_at": datetime.now(timezone.utc)},
+        conn=conn,
+    )
 
 
 async def delete_chat(categories_id: str, chat_id: str) -> None:
@@ -165,18 +366,302 @@ async def delete_chat(categories_id: str, chat_id: str) -> None:
         """,
         {"id": chat_id, "categories_id": categories_id},
     )
+    await db.execute(
+        """
+            DELETE FROM chat.messages
+            WHERE chat_id = :chat_id
+        """,
+        {"chat_id": chat_id},
+    )
+    await db.execute(
+        """
+            DELETE FROM chat.chat_events
+            WHERE chat_id = :chat_id
+        """,
+        {"chat_id": chat_id},
+    )
+
+
+################################# Chat Messages ###########################
+
+
+async def create_chat_message(message: ChatMessage, conn: Connection | None = None) -> ChatMessage:
+    await (conn or db).insert("chat.messages", message)
+    return message
+
+
+async def get_chat_messages(chat_id: str, conn: Connection | None = None) -> list[ChatMessage]:
+    return await (conn or db).fetchall(
+        """
+            SELECT * FROM chat.messages
+            WHERE chat_id = :chat_id
+            ORDER BY created_at ASC, id ASC
+        """,
+        {"chat_id": chat_id},
+        ChatMessage,
+    )
+
+
+async def get_chat_messages_before(
+    chat_id: str,
+    limit: int,
+    before_id: str | None = None,
+) -> list[ChatMessage]:
+    where = "chat_id = :chat_id"
+    values: dict = {"chat_id": chat_id, "limit": limit}
+    if before_id:
+        # keyset on (created_at, id) relative to the cursor message
+        where += """
+              AND (created_at, id) < (
+                SELECT created_at, id FROM chat.messages
+                WHERE id = :before_id AND chat_id = :chat_id
+              )
+        """
+        values["before_id"] = before_id
+    return await db.fetchall(
+        f"""
+            SELECT * FROM chat.messages
+            WHERE {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT :limit
+        """,
+        values,
+        ChatMessage,
+    )
+
+
+def _fts5_query(query: str) -> str:
+    """
+    Quote every term so user input can't use FTS5 syntax, the last term
+    matches as a prefix so results show up while typing.
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+async def search_chat_messages(
+    user_id: str,
+    query: str,
+    categories_id: str | None = None,
+    limit: int = 20,
+) -> list[ChatSearchHit]:
+    where = "c.categories_id IN (SELECT id FROM chat.categories WHERE user_id = :user_id)"
+    values: dict = {"user_id": user_id, "limit": limit}
+    if categories_id:
+        where += " AND c.categories_id = :categories_id"
+        values["categories_id"] = categories_id
+    columns = "m.id AS message_id, m.chat_id, c.categories_id, c.title, m.sender_name, m.sender_role, m.created_at"
+
+    if db.type == SQLITE:
+        values["query"] = _fts5_query(query)
+        if not values["query"]:
+            return []
+        sql = f"""
+            SELECT {columns},
+                snippet(messages_fts, 0, '[', ']', '...', 12) AS snippet,
+                -bm25(messages_fts) AS rank
+            FROM chat.messages_fts
+            JOIN chat.messages m ON m.search_key = messages_fts.rowid
+            JOIN chat.chats c ON c.id = m.chat_id
+            WHERE messages_fts MATCH :query AND {where}
+            ORDER BY bm25(messages_fts), m.created_at DESC
+            LIMIT :limit
+        """
+    elif db.type == POSTGRES:
+        values["query"] = query
+        sql = f"""
+            SELECT {columns},
+                ts_headline('simple', m.message, q, 'StartSel=[, StopSel=], MinWords=8, MaxWords=24') AS snippet,
+                ts_rank(to_tsvector('simple', m.message), q) AS rank
+            FROM chat.messages m
+            JOIN chat.chats c ON c.id = m.chat_id
+            CROSS JOIN websearch_to_tsquery('simple', :query) q
+            WHERE to_tsvector('simple', m.message) @@ q AND {where}
+            ORDER BY rank DESC, m.created_at DESC
+            LIMIT :limit
+        """
+    else:
+        # no full text index on CockroachDB, scan with ILIKE
+        values["query"] = f"%{query}%"
+        sql = f"""
+            SELECT {columns}, substr(m.message, 1, 200) AS snippet, 0 AS rank
+            FROM chat.messages m
+            JOIN chat.chats c ON c.id = m.chat_id
+            WHERE m.message ILIKE :query AND {where}
+            ORDER BY m.created_at DESC
+            LIMIT :limit
+        """
+    return await db.fetchall(sql, values, ChatSearchHit)
+
+
+################################# Chat Events ###########################
+async def create_chat_event(chat_id: str, type_: str, payload: dict) -> ChatEvent | None:
+    async with transaction() as conn:
+        result = await conn.execute(
+            """
+                UPDATE chat.chats
+                SET event_seq = event_seq + 1
+                WHERE id = :id
+                RETURNING event_seq
+            """,
+            {"id": chat_id},
+        )
+        row = result.mappings().first()
+        result.close()
+        if not row:
+            return None
+        event = ChatEvent(chat_id=chat_id, seq=row["event_seq"], type=type_, payload=payload)
+        await conn.insert("chat.chat_events", event)
+    return event
+
+
+async def get_chat_events_after(chat_id: str, after_seq: int, limit: int) -> list[ChatEvent]:
+    return await db.fetchall(
+        """
+            SELECT * FROM chat.chat_events
+            WHERE chat_id = :chat_id AND seq > :after_seq
+            ORDER BY seq ASC
+            LIMIT :limit
+        """,
+        {"chat_id": chat_id, "after_seq": after_seq, "limit": limit},
+        ChatEvent,
+    )
+
+
+async def delete_chat_events_before(cutoff: datetime) -> None:
+    await db.execute(
+        f"""
+            DELETE FROM chat.chat_events
+            WHERE created_at < {db.timestamp_placeholder("cutoff")}
+        """,
+        {"cutoff": cutoff},
+    )
+
+
+################################# Chat Archive ###########################
+ARCHIVE_SUMMARY_COLUMNS = ", ".join(key for key in ArchivedChat.__fields__.keys() if key != "data")
+
+
+async def get_chat_ids_to_archive(
+    categories_id: str,
+    resolved_before: datetime | None,
+    idle_before: datetime | None,
+    limit: int,
+) -> list[str]:
+    """
+    Chats past the category's retention. Chats holding prepaid balance or an
+    unpaid invoice are kept, the payment needs the live chat to land in.
+    """
+    conditions = []
+    values: dict = {"categories_id": categories_id, "limit": limit, "unpaid": False}
+    if resolved_before:
+        conditions.append(f"(resolved = :resolved AND updated_at < {db.timestamp_placeholder('resolved_before')})")
+        values["resolved"] = True
+        values["resolved_before"] = resolved_before.timestamp()
+    if idle_before:
+        conditions.append(f"COALESCE(last_message_at, created_at) < {db.timestamp_placeholder('idle_before')}")
+        values["idle_before"] = idle_before.timestamp()
+    if not conditions:
+        return []
+    rows: list[dict] = await db.fetchall(
+        f"""
+            SELECT id FROM chat.chats
+            WHERE categories_id = :categories_id AND ({" OR ".join(conditions)})
+              AND balance = 0
+              AND NOT EXISTS (
+                SELECT 1 FROM chat.chat_payments p
+                WHERE p.chat_id = chats.id AND p.paid = :unpaid
+              )
+            ORDER BY id
+            LIMIT :limit
+        """,
+        values,
+    )
+    return [row["id"] for row in rows]
+
+
+async def archive_chat(chat_id: str) -> ArchivedChat | None:
+    """
+    Move a chat and its messages into chat.chats_archive as one compressed
+    record. Chat payments stay where they are for accounting. None if there
+    is no chat, or it is archived already and the existing record is kept.
+    """
+    async with transaction() as conn:
+        chat = await get_chat(chat_id, include_messages=False, conn=conn)
+        if not chat:
+            return None
+        messages = await get_chat_messages(chat_id, conn=conn)
+        export = {
+            "chat": chat.dict(exclude={"messages", "messages_cursor"}),
+            "messages": [message.dict() for message in messages],
+        }
+        archived = ArchivedChat(
+            id=chat.id,
+            categories_id=chat.categories_id,
+            title=chat.title,
+            resolved=chat.resolved,
+            balance=chat.balance,
+            message_count=len(messages),
+            last_message_at=chat.last_message_at,
+            created_at=chat.created_at,
+            data=base64.b64encode(
+                zlib.compress(json.dumps(export, default=lambda value: value.isoformat()).encode())
+            ).decode(),
+        )
+        result = await _execute_verbatim(
+            conn,
+            f"{insert_query('chat.chats_archive', archived)} ON CONFLICT (id) DO NOTHING",
+            model_to_dict(archived),
+        )
+        if result.rowcount != 1:
+            return None
+        for table, column in (("messages", "chat_id"), ("chat_events", "chat_id"), ("chats", "id")):
+            await conn.execute(f"DELETE FROM chat.{table} WHERE {column} = :id", {"id": chat_id})
+    return archived
+
+
+async def get_archived_chats(
+    user_id: str,
+    categories_id: str | None = None,
+    filters: Filters[ArchivedChatsFilters] | None = None,
+) -> Page[ArchivedChat]:
+    where = ["categories_id IN (SELECT id FROM chat.categories WHERE user_id = :user_id)"]
+    values = {"user_id": user_id}
+    if categories_id:
+        where.append("categories_id = :categories_id")
+        values["categories_id"] = categories_id
+    return await db.fetch_page(
+        f"SELECT {ARCHIVE_SUMMARY_COLUMNS} FROM chat.chats_archive",
+        where=where,
+        values=values,
+        filters=filters,
+        model=ArchivedChat,
+    )
+
+
+async def get_archived_chat(chat_id: str) -> ArchivedChat | None:
+    return await db.fetchone(
+        """
+            SELECT * FROM chat.chats_archive
+            WHERE id = :id
+        """,
+        {"id": chat_id},
+        ArchivedChat,
+    )
 
 
 ################################# Chat Payments ###########################
 
 
-async def create_chat_payment(payment: ChatPayment) -> ChatPayment:
-    await db.insert("chat.chat_payments", payment)
+async def create_chat_payment(payment: ChatPayment, conn: Connection | None = None) -> ChatPayment:
+    await (conn or db).insert("chat.chat_payments", payment)
     return payment
 
 
-async def get_chat_payment(payment_hash: str) -> ChatPayment | None:
-    return await db.fetchone(
+async def get_chat_payment(payment_hash: str, conn: Connection | None = None) -> ChatPayment | None:
+    return await (conn or db).fetchone(
         """
             SELECT * FROM chat.chat_payments
             WHERE payment_hash = :payment_hash
@@ -186,28 +671,128 @@ async def get_chat_payment(payment_hash: str) -> ChatPayment | None:
     )
 
 
+async def mark_chat_payment_paid(payment_hash: str, conn: Connection | None = None) -> ChatPayment | None:
+    """
+    Flip `paid` only if it is still false. Returns the payment for the one
+    caller that won, None for duplicate or concurrent deliveries.
+    """
+    result = await (conn or db).execute(
+        """
+            UPDATE chat.chat_payments
+            SET paid = :paid
+            WHERE payment_hash = :payment_hash AND paid = :unpaid
+            RETURNING *
+        """,
+        {"payment_hash": payment_hash, "paid": True, "unpaid": False},
+    )
+    row = result.mappings().first()
+    result.close()
+    return dict_to_model(row, ChatPayment) if row else None
+
+
 async def update_chat_payment(payment: ChatPayment) -> ChatPayment:
     await db.update("chat.chat_payments", payment, where="WHERE payment_hash = :payment_hash")
     return payment
 
 
-async def delete_empty_chats_before(cutoff: int) -> None:
-    if DB_TYPE == SQLITE:
-        query = """
-            DELETE FROM chat.chats
-            WHERE (messages IS NULL OR messages = '[]')
-              AND created_at < :cutoff
-        """
-    elif DB_TYPE == POSTGRES:
-        query = """
-            DELETE FROM chat.chats
-            WHERE (messages IS NULL OR messages = '[]')
-              AND created_at < to_timestamp(:cutoff)
-        """
-    else:
-        query = """
+async def delete_unpaid_chat_payments_before(cutoff: datetime, limit: int) -> int:
+    """
+    Delete up to `limit` unpaid chat payments created before `cutoff`, whose
+    invoices can no longer be paid. Returns the number of rows removed.
+    """
+    result = await db.execute(
+        f"""
+            DELETE FROM chat.chat_payments
+            WHERE payment_hash IN (
+                SELECT payment_hash FROM chat.chat_payments
+                WHERE paid = :unpaid
+                  AND created_at < {db.timestamp_placeholder("cutoff")}
+                LIMIT :limit
+            )
+        """,
+        {"unpaid": False, "cutoff": cutoff.timestamp(), "limit": limit},
+    )
+    return result.rowcount
+
+
+async def delete_empty_chats_before(cutoff: datetime, limit: int) -> int:
+    """
+    Delete up to `limit` chats created before `cutoff` that never got a
+    message or a balance. Chats with an unpaid invoice are kept until the
+    invoice expires and is swept. Returns the number of rows removed.
+    """
+    result = await db.execute(
+        f"""
             DELETE FROM chat.chats
-            WHERE (messages IS NULL OR messages = '[]')
-              AND created_at < cast(:cutoff AS timestamp)
-        """
-    await db.execute(query, {"cutoff": cutoff})
+            WHERE id IN (
+                SELECT id FROM chat.chats
+                WHERE last_message_at IS NULL
+                  AND created_at < {db.timestamp_placeholder("cutoff")}
+                  AND message_count = 0
+                  AND balance = 0
+                  AND NOT EXISTS (
+                    SELECT 1 FROM chat.chat_payments p
+                    WHERE p.chat_id = chats.id AND p.paid = :unpaid
+                  )
+                LIMIT :limit
+            )
+        """,
+        {"cutoff": cutoff.timestamp(), "limit": limit, "unpaid": False},
+    )
+    return result.rowcount
+
+
+################################# Outbox ###########################
+async def create_outbox_job(job: OutboxJob, conn: Connection | None = None) -> OutboxJob:
+    await (conn or db).insert("chat.outbox", job)
+    return job
+
+
+async def get_due_outbox_jobs(limit: int) -> list[OutboxJob]:
+    return await db.fetchall(
+        f"""
+            SELECT * FROM chat.outbox
+            WHERE status = 'pending'
+              AND next_attempt_at <= {db.timestamp_placeholder("now")}
+            ORDER BY next_attempt_at ASC
+            LIMIT :limit
+        """,
+        # a float keeps sub-second precision, inserted rows store one on sqlite
+        {"now": datetime.now(timezone.utc).timestamp(), "limit": limit},
+        OutboxJob,
+    )
+
+
+async def claim_outbox_job(job: OutboxJob, lease_until: datetime) -> bool:
+    """
+    Take a lease on a job so only one worker runs it. The attempts counter
+    doubles as a version, a concurrent claim of the same attempt matches no row.
+    """
+    result = await db.execute(
+        f"""
+            UPDATE chat.outbox
+            SET attempts = attempts + 1,
+                next_attempt_at = {db.timestamp_placeholder("lease_until")}
+            WHERE id = :id AND status = 'pending' AND attempts = :attempts
+        """,
+        {"id": job.id, "attempts": job.attempts, "lease_until": lease_until},
+    )
+    if result.rowcount != 1:
+        return False
+    job.attempts += 1
+    job.next_attempt_at = lease_until
+    return True
+
+
+async def update_outbox_job(job: OutboxJob) -> OutboxJob:
+    await db.update("chat.outbox", job)
+    return job
+
+
+async def delete_outbox_job(job_id: str) -> None:
+    await db.execute("DELETE FROM chat.outbox WHERE id = :id", {"id": job_id})
+
+
+async def get_outbox_counts() -> dict[str, int]:
+    rows: list[dict] = await db.fetchall("SELECT status, COUNT(*) AS count FROM chat.outbox GROUP BY status")
+    return {row["status"]: row["count"] for row in rows}
@@ -0,0 +1,161 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta, timezone
+
+from lnbits.db import Connection
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.settings import settings
+from loguru import logger
+
+from .crud import (
+    claim_outbox_job,
+    create_outbox_job,
+    delete_outbox_job,
+    get_due_outbox_jobs,
+    update_outbox_job,
+)
+from .models import OutboxJob
+
+Handler = Callable[[OutboxJob], Awaitable[None]]
+
+
+class Dispatcher:
+    """
+    Runs side effects (notifications, claim split payouts) off the request path.
+    Jobs are written to `chat.outbox` first, so queued work survives a restart,
+    and are retried with exponential backoff until `max_attempts`.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 4,
+        batch_size: int = 50,
+        max_attempts: int = 8,
+        base_delay: float = 5,
+        max_delay: float = 3600,
+        lease: float = 300,
+        poll_interval: float = 30,
+    ) -> None:
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.handlers: dict[str, Handler] = {}
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+
+    def register(self, kind: str, handler: Handler) -> None:
+        self.handlers[kind] = handler
+
+    async def enqueue(self, kind: str, payload: dict, conn: Connection | None = None) -> OutboxJob:
+        job = await create_outbox_job(OutboxJob(id=urlsafe_short_hash(), kind=kind, payload=payload), conn=conn)
+        self._wakeup.set()
+        return job
+
+    def backoff(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** max(0, attempts - 1))
+
+    async def _claim(self, job: OutboxJob) -> bool:
+        lease_until = datetime.now(timezone.utc) + timedelta(seconds=self.lease)
+        return await claim_outbox_job(job, lease_until)
+
+    async def run_job(self, job: OutboxJob) -> None:
+        if not await self._claim(job):
+            return
+        await self._execute(job)
+
+    async def _execute(self, job: OutboxJob) -> None:
+        handler = self.handlers.get(job.kind)
+        try:
+            if not handler:
+                raise ValueError(f"No handler for outbox job kind '{job.kind}'.")
+            await handler(job)
+        except Exception as exc:
+            job.last_error = str(exc)[:500]
+            if job.attempts >= self.max_attempts:
+                job.status = "failed"
+                self.failed += 1
+                logger.warning(f"Chat outbox job {job.kind} {job.id} gave up: {exc}")
+            else:
+                delay = self.backoff(job.attempts)
+                job.next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                self.retried += 1
+                logger.info(f"Chat outbox job {job.kind} {job.id} retry in {delay}s: {exc}")
+            await update_outbox_job(job)
+            return
+        await delete_outbox_job(job.id)
+        self.completed += 1
+
+    async def _run_claimed(self, job: OutboxJob) -> None:
+        # holds the slot taken in start_due until the job is done
+        self.in_flight += 1
+        try:
+            await self._execute(job)
+        except Exception as exc:
+            logger.warning(f"Chat outbox job {job.id} crashed: {exc}")
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    async def start_due(self) -> int:
+        """
+        Claim each due job as soon as a slot is free and start it without
+        waiting for it, so a hung job only holds its own slot. Returns the
+        number of due jobs found.
+        """
+        jobs = await get_due_outbox_jobs(self.batch_size)
+        for job in jobs:
+            await self._semaphore.acquire()
+            started = False
+            try:
+                if await self._claim(job):
+                    task = asyncio.create_task(self._run_claimed(job))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    started = True
+            finally:
+                if not started:
+                    self._semaphore.release()
+        return len(jobs)
+
+    async def run_due(self) -> int:
+        """
+        Start every due job and wait until no job is in flight.
+        """
+        found = await self.start_due()
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+        return found
+
+    async def run(self) -> None:
+        while settings.lnbits_running:
+            self._wakeup.clear()
+            try:
+                if await self.start_due() >= self.batch_size:
+                    continue
+            except Exception as exc:
+                logger.warning(f"Error running chat outbox: {exc}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+dispatcher = Dispatcher()
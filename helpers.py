@@ -9,14 +9,17 @@ def is_valid_email_address(email: str) -> bool:
     return re.fullmatch(email_regex, email) is not None
 
 
-def chat_lnurl_url(req: Request, chat_id: str) -> str:
+def chat_lnurl_url(req: Request, chat_id: str, token: str | None = None) -> str:
     url = req.url_for("chat.api_lnurl_response", chat_id=chat_id)
     url = url.replace(path=url.path)
+    if token:
+        # a provisional chat is created when the wallet asks for an invoice
+        url = url.include_query_params(token=token)
     url_str = str(url)
     if url.netloc.endswith(".onion"):
         url_str = url_str.replace("https://", "http://")
     return url_str
 
 
-def lnurl_encode_chat(req: Request, chat_id: str) -> str:
-    return str(lnurl_encode(chat_lnurl_url(req, chat_id)).bech32)
+def lnurl_encode_chat(req: Request, chat_id: str, token: str | None = None) -> str:
+    return str(lnurl_encode(chat_lnurl_url(req, chat_id, token)).bech32)
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from time import monotonic
+
+# requests per minute per visitor when the category does not set `rate_limit`
+DEFAULT_RATE_LIMIT = 30
+
+
+class RateLimiter:
+    """
+    In-memory token buckets for the public endpoints, per process. A bucket
+    holds up to `rate` tokens and refills `rate` per minute, every request
+    takes one token from each of its buckets. Idle buckets are full anyway,
+    the least recently used ones are dropped past `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = 10000) -> None:
+        self.maxsize = maxsize
+        self.allowed = 0
+        self.rejected: dict[str, int] = {}
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def _tokens(self, key: str, rate: int, now: float) -> float:
+        cached = self._buckets.get(key)
+        if cached is None:
+            return float(rate)
+        tokens, updated_at = cached
+        return min(float(rate), tokens + (now - updated_at) * rate / 60)
+
+    def _set(self, key: str, tokens: float, now: float) -> None:
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+
+    def admit(self, keys: dict[str, str], rate: int) -> float:
+        """
+        Take a token from the bucket of every `kind: key` pair. Returns 0 when
+        admitted, otherwise the seconds until all buckets have a token again.
+        Nothing is taken from a rejected request.
+        """
+        if rate <= 0:
+            return 0
+        now = monotonic()
+        tokens = {key: self._tokens(key, rate, now) for key in keys.values()}
+        empty = [kind for kind, key in keys.items() if tokens[key] < 1]
+        if empty:
+            for kind in empty:
+                self.rejected[kind] = self.rejected.get(kind, 0) + 1
+            return max((1 - tokens[keys[kind]]) * 60 / rate for kind in empty)
+        for key, value in tokens.items():
+            self._set(key, value - 1, now)
+        self.allowed += 1
+        return 0
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+    def stats(self) -> dict:
+        return {
+            "buckets": len(self._buckets),
+            "maxsize": self.maxsize,
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected),
+        }
+
+
+rate_limiter = RateLimiter()
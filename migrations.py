@@ -1,6 +1,27 @@
+import json
+from datetime import datetime, timezone
+
+from lnbits.db import POSTGRES, SQLITE
+from sqlalchemy import text  # type: ignore[import]
+
 empty_dict: dict[str, str] = {}
 
 
+def _create_index(db, name: str, table: str, columns: str) -> str:
+    if db.type == SQLITE:
+        return f"CREATE INDEX IF NOT EXISTS chat.{name} ON {table} ({columns});"
+    return f"CREATE INDEX IF NOT EXISTS {name} ON chat.{table} ({columns});"
+
+
+async def _execute_verbatim(db, query: str, values: dict) -> None:
+    """
+    `db.execute` strips anything that looks like HTML from string values,
+    this binds them as given so stored text is copied unchanged.
+    """
+    await db.conn.execute(text(db.rewrite_query(query)), values)
+    await db.conn.commit()
+
+
 async def m002_categories(db):
     """
     Initial categories table.
@@ -173,3 +194,324 @@ async def m010_chat_claim_split(db):
         ALTER TABLE chat.categories ADD COLUMN claim_split REAL DEFAULT 0;
         """
     )
+
+
+async def m011_chat_messages(db):
+    """
+    Move chat messages out of the chats.messages JSON column into their own table.
+    `search_key` gives the SQLite search index a stable key, the implicit rowid
+    of a table with a TEXT primary key may be renumbered by VACUUM.
+    """
+
+    await db.execute(
+        f"""
+        CREATE TABLE chat.messages (
+            search_key {db.serial_primary_key},
+            id TEXT NOT NULL UNIQUE,
+            chat_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            sender_name TEXT NOT NULL,
+            sender_role TEXT NOT NULL,
+            message TEXT NOT NULL,
+            amount {db.big_int},
+            message_type TEXT NOT NULL DEFAULT 'message',
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    await db.execute(_create_index(db, "idx_messages_chat_created", "messages", "chat_id, created_at, id"))
+    await _copy_chat_messages(db)
+    await db.execute("UPDATE chat.chats SET messages = '[]'")
+
+
+async def _copy_chat_messages(db) -> None:
+    rows = await db.fetchall("SELECT id, messages FROM chat.chats")
+    for row in rows:
+        try:
+            messages = json.loads(row["messages"] or "[]")
+        except json.JSONDecodeError:
+            messages = []
+        seen = set()
+        for message in messages:
+            message_id = message.get("id")
+            if not message_id or message_id in seen:
+                continue
+            seen.add(message_id)
+            created_at = message.get("created_at")
+            created_at = datetime.fromisoformat(created_at) if created_at else datetime.now(timezone.utc)
+            await _execute_verbatim(
+                db,
+                f"""
+                INSERT INTO chat.messages
+                    (id, chat_id, sender_id, sender_name, sender_role,
+                     message, amount, message_type, created_at)
+                VALUES
+                    (:id, :chat_id, :sender_id, :sender_name, :sender_role,
+                     :message, :amount, :message_type, {db.timestamp_placeholder("created_at")})
+                """,
+                {
+                    "id": message_id,
+                    "chat_id": row["id"],
+                    "sender_id": message.get("sender_id") or "",
+                    "sender_name": message.get("sender_name") or "",
+                    "sender_role": message.get("sender_role") or "public",
+                    "message": message.get("message") or "",
+                    "amount": message.get("amount"),
+                    "message_type": message.get("message_type") or "message",
+                    "created_at": created_at.timestamp(),
+                },
+            )
+
+
+async def m012_chat_summary_columns(db):
+    """
+    Denormalised message count and last message preview for the chat list.
+    """
+
+    await db.execute(
+        """
+        ALTER TABLE chat.chats ADD COLUMN message_count INT DEFAULT 0;
+        """
+    )
+    await db.execute(
+        """
+        ALTER TABLE chat.chats ADD COLUMN last_message_preview TEXT;
+        """
+    )
+    await db.execute(
+        """
+        UPDATE chat.chats SET
+            message_count = (
+                SELECT COUNT(*) FROM chat.messages
+                WHERE chat.messages.chat_id = chat.chats.id
+            ),
+            last_message_preview = (
+                SELECT substr(message, 1, 120) FROM chat.messages
+                WHERE chat.messages.chat_id = chat.chats.id
+                ORDER BY created_at DESC, id DESC
+                LIMIT 1
+            )
+        """
+    )
+
+
+async def m013_query_indexes(db):
+    """
+    Indexes for the chat list, the empty chat sweeper and category lookups.
+    """
+
+    await db.execute(_create_index(db, "idx_categories_user", "categories", "user_id"))
+    await db.execute(_create_index(db, "idx_chats_category_last_message", "chats", "categories_id, last_message_at"))
+    await db.execute(_create_index(db, "idx_chats_category_updated", "chats", "categories_id, updated_at"))
+    await db.execute(_create_index(db, "idx_chats_last_message_created", "chats", "last_message_at, created_at"))
+
+
+async def m014_outbox(db):
+    """
+    Persisted outbox for notifications and claim split payouts.
+    """
+
+    await db.execute(
+        f"""
+        CREATE TABLE chat.outbox (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now},
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    await db.execute(_create_index(db, "idx_outbox_status_next_attempt", "outbox", "status, next_attempt_at"))
+
+
+async def m015_chat_events(db):
+    """
+    Per-chat websocket event log so reconnecting clients can resume from a sequence.
+    """
+
+    await db.execute(
+        """
+        ALTER TABLE chat.chats ADD COLUMN event_seq INT DEFAULT 0;
+        """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE chat.chat_events (
+            chat_id TEXT NOT NULL,
+            seq INT NOT NULL,
+            type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now},
+            PRIMARY KEY (chat_id, seq)
+        );
+    """
+    )
+    await db.execute(_create_index(db, "idx_chat_events_created", "chat_events", "created_at"))
+
+
+async def m016_chat_archive(db):
+    """
+    Per-category retention and the archive resolved or idle chats are moved to.
+    """
+
+    await db.execute(
+        """
+        ALTER TABLE chat.categories ADD COLUMN archive_resolved_days INT;
+        """
+    )
+    await db.execute(
+        """
+        ALTER TABLE chat.categories ADD COLUMN archive_idle_days INT;
+        """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE chat.chats_archive (
+            id TEXT PRIMARY KEY,
+            categories_id TEXT NOT NULL,
+            title TEXT,
+            resolved BOOLEAN,
+            balance {db.big_int} DEFAULT 0,
+            message_count INT DEFAULT 0,
+            last_message_at TIMESTAMP,
+            created_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now},
+            data TEXT NOT NULL
+        );
+    """
+    )
+    await db.execute(_create_index(db, "idx_chats_archive_category", "chats_archive", "categories_id, archived_at"))
+    await db.execute(
+        _create_index(db, "idx_chats_category_resolved_updated", "chats", "categories_id, resolved, updated_at")
+    )
+
+
+async def m017_message_search(db):
+    """
+    Full text index over chat messages, kept up to date as messages are written.
+    SQLite uses an external content FTS5 table maintained by triggers, Postgres
+    a GIN expression index over the message tsvector. CockroachDB falls back to ILIKE.
+    """
+
+    if db.type == SQLITE:
+        await db.execute(
+            """
+            CREATE VIRTUAL TABLE chat.messages_fts
+            USING fts5(message, content='messages', content_rowid='search_key');
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER chat.messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, message) VALUES (new.search_key, new.message);
+            END;
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER chat.messages_fts_delete AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message)
+                VALUES ('delete', old.search_key, old.message);
+            END;
+            """
+        )
+        await db.execute("INSERT INTO chat.messages_fts (messages_fts) VALUES ('rebuild');")
+    elif db.type == POSTGRES:
+        await db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_messages_search
+            ON chat.messages USING GIN (to_tsvector('simple', message));
+            """
+        )
+
+
+async def m018_chat_payments_expiry(db):
+    """
+    Index for the sweep that removes unpaid chat payments past invoice expiry.
+    """
+
+    await db.execute(_create_index(db, "idx_chat_payments_paid_created", "chat_payments", "paid, created_at"))
+
+
+async def m019_chats_version(db):
+    """
+    Row version for optimistic concurrency on chat updates across workers.
+    """
+
+    await db.execute(
+        """
+        ALTER TABLE chat.chats ADD COLUMN version INT NOT NULL DEFAULT 0;
+        """
+    )
+
+
+async def m020_categories_rate_limit(db):
+    """
+    Per-category rate limit for the public endpoints, requests per minute per visitor.
+    """
+
+    await db.execute(
+        """
+        ALTER TABLE chat.categories ADD COLUMN rate_limit INT;
+        """
+    )
+
+
+async def m021_public_admin_ids(db):
+    """
+    Store admin senders and participants under their public id, `admin-{name}`,
+    so public reads serve chats as stored instead of rewriting them.
+    """
+
+    def public_id(name: str | None) -> str:
+        return f"admin-{name or 'admin'}"
+
+    await db.execute(
+        """
+        UPDATE chat.messages SET sender_id = 'admin-' || COALESCE(NULLIF(sender_name, ''), 'admin')
+        WHERE sender_role = 'admin'
+        """
+    )
+
+    rows = await db.fetchall("SELECT id, participants FROM chat.chats WHERE participants LIKE '%admin%'")
+    for row in rows:
+        try:
+            participants = json.loads(row["participants"] or "[]")
+        except json.JSONDecodeError:
+            continue
+        changed = False
+        for participant in participants:
+            if participant.get("role") == "admin" and participant.get("id") != public_id(participant.get("name")):
+                participant["id"] = public_id(participant.get("name"))
+                changed = True
+        if changed:
+            await _execute_verbatim(
+                db,
+                "UPDATE chat.chats SET participants = :participants WHERE id = :id",
+                {"id": row["id"], "participants": json.dumps(participants)},
+            )
+
+    rows = await db.fetchall(
+        """
+        SELECT chat_id, seq, payload FROM chat.chat_events
+        WHERE type = 'message' AND payload LIKE '%admin%'
+        """
+    )
+    for row in rows:
+        try:
+            payload = json.loads(row["payload"])
+        except json.JSONDecodeError:
+            continue
+        message = payload.get("message") or {}
+        if message.get("sender_role") != "admin" or message.get("sender_id") == public_id(message.get("sender_name")):
+            continue
+        message["sender_id"] = public_id(message.get("sender_name"))
+        await _execute_verbatim(
+            db,
+            "UPDATE chat.chat_events SET payload = :payload WHERE chat_id = :chat_id AND seq = :seq",
+            {"chat_id": row["chat_id"], "seq": row["seq"], "payload": json.dumps(payload)},
+        )
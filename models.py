@@ -17,6 +17,11 @@ class CreateCategories(BaseModel):
     notify_telegram: str | None = None
     notify_nostr: str | None = None
     notify_email: str | None = None
+    # days before resolved / inactive chats move to chat.chats_archive, empty keeps them
+    archive_resolved_days: int | None = None
+    archive_idle_days: int | None = None
+    # public requests per minute per visitor, empty uses the default and 0 turns it off
+    rate_limit: int | None = None
 
 
 class Categories(BaseModel):
@@ -34,6 +39,11 @@ class Categories(BaseModel):
     notify_telegram: str | None = None
     notify_nostr: str | None = None
     notify_email: str | None = None
+    # days before resolved / inactive chats move to chat.chats_archive, empty keeps them
+    archive_resolved_days: int | None = None
+    archive_idle_days: int | None = None
+    # public requests per minute per visitor, empty uses the default and 0 turns it off
+    rate_limit: int | None = None
 
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -51,6 +61,14 @@ class PublicCategories(BaseModel):
     claim_split: float | None = 0
 
 
+class PriceQuote(BaseModel):
+    denomination: str
+    price_chars: float
+    sats_per_unit: float
+    # seconds the rate is cached for, clients can reuse the quote that long
+    ttl: int
+
+
 class CategoriesFilters(FilterModel):
     __search_fields__ = [
         "name",
@@ -92,6 +110,7 @@ class ChatParticipant(BaseModel):
 
 class ChatMessage(BaseModel):
     id: str
+    chat_id: str | None = None
     sender_id: str
     sender_name: str
     sender_role: str
@@ -112,13 +131,91 @@ class ChatSession(BaseModel):
     claimed_by_id: str | None = None
     claimed_by_name: str | None = None
     participants: list[dict] = Field(default_factory=list)
-    messages: list[dict] = Field(default_factory=list)
+    # stored in chat.messages, loaded separately
+    messages: list[dict] = Field(default_factory=list, no_database=True)
+    last_message_at: datetime | None = None
+    # maintained in SQL when messages are appended, never written back from here
+    message_count: int = Field(default=0, no_database=True)
+    last_message_preview: str | None = Field(default=None, no_database=True)
+    # cursor for older messages when only the latest page was loaded
+    messages_cursor: str | None = Field(default=None, no_database=True)
+    # sequence of the last websocket event, bumped in SQL by create_chat_event
+    event_seq: int = Field(default=0, no_database=True)
+    # bumped on every write, `update_chat` only applies to the version it read
+    version: int = 0
+    # signed provisional chat, handed out before the row exists
+    token: str | None = Field(default=None, no_database=True)
+
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class ChatSummary(BaseModel):
+    id: str
+    categories_id: str
+    title: str | None = None
+    resolved: bool = False
+    unread: bool = True
+    balance: int = 0
+    claimed_by_id: str | None = None
+    claimed_by_name: str | None = None
+    message_count: int = 0
+    last_message_preview: str | None = None
     last_message_at: datetime | None = None
 
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
+class ChatSearchHit(BaseModel):
+    message_id: str
+    chat_id: str
+    categories_id: str
+    title: str | None = None
+    sender_name: str
+    sender_role: str
+    # matched terms are wrapped in [brackets]
+    snippet: str
+    rank: float = 0
+    created_at: datetime
+
+
+class ChatMessagesPage(BaseModel):
+    data: list[dict] = Field(default_factory=list)
+    next_cursor: str | None = None
+
+
+class ChatEvent(BaseModel):
+    chat_id: str
+    seq: int
+    type: str
+    payload: dict = Field(default_factory=dict)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class ChatEventsPage(BaseModel):
+    data: list[dict] = Field(default_factory=list)
+    last_seq: int = 0
+    has_more: bool = False
+    # the requested events were pruned, the client has to reload the chat
+    reset: bool = False
+
+
+class ArchivedChat(BaseModel):
+    id: str
+    categories_id: str
+    title: str | None = None
+    resolved: bool = False
+    balance: int = 0
+    message_count: int = 0
+    last_message_at: datetime | None = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    archived_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # zlib compressed, base64 encoded JSON of the chat row and its messages,
+    # left out of list queries
+    data: str | None = None
+
+
 class CreateChat(BaseModel):
     participant_id: str | None = None
     participant_name: str | None = None
@@ -129,6 +226,8 @@ class CreateChatMessage(BaseModel):
     sender_name: str
     sender_role: str
     message: str
+    # creates the chat on its first message if it is still provisional
+    token: str | None = None
 
 
 class ChatPaymentRequest(BaseModel):
@@ -154,10 +253,22 @@ class ChatPayment(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
+class OutboxJob(BaseModel):
+    id: str
+    kind: str
+    payload: dict = Field(default_factory=dict)
+    status: str = "pending"
+    attempts: int = 0
+    last_error: str | None = None
+    next_attempt_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
 class TipRequest(BaseModel):
     amount: int
     sender_id: str
     sender_name: str
+    token: str | None = None
 
 
 class ChatsFilters(FilterModel):
@@ -173,3 +284,18 @@ class ChatsFilters(FilterModel):
 
     created_at: datetime | None
     updated_at: datetime | None
+
+
+class ArchivedChatsFilters(FilterModel):
+    __search_fields__ = [
+        "title",
+    ]
+
+    __sort_fields__ = [
+        "archived_at",
+        "last_message_at",
+        "created_at",
+    ]
+
+    archived_at: datetime | None
+    created_at: datetime | None
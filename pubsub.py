@@ -0,0 +1,214 @@
+import asyncio
+import json
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Coroutine
+from typing import Any
+
+from lnbits.core.services import websocket_manager
+from lnbits.db import POSTGRES
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.settings import settings
+from loguru import logger
+
+from .crud import db, get_chat_events_after
+
+Handler = Callable[[str], Coroutine[Any, Any, None]]
+Deliver = Callable[[str, str], Awaitable[None]]
+
+# NOTIFY payloads are capped at 8000 bytes, leave room for the envelope
+MAX_NOTIFY_BYTES = 7500
+
+
+class LocalBackend:
+    """
+    In-memory stand-in for a single worker, or several publishers sharing one
+    instance in tests. Messages are handed to every subscriber in process.
+    """
+
+    name = "local"
+    remote = False
+
+    def __init__(self) -> None:
+        self._handlers: list[Handler] = []
+
+    async def run(self, handler: Handler) -> None:
+        self._handlers.append(handler)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self._handlers.remove(handler)
+
+    async def publish(self, message: str) -> bool:
+        for handler in list(self._handlers):
+            await handler(message)
+        return True
+
+
+class PostgresBackend:
+    """
+    Fan-out between workers over Postgres LISTEN/NOTIFY, on a connection of
+    its own outside the pool. Reconnects after `retry_interval` if it drops,
+    messages published meanwhile only reach the local clients.
+    """
+
+    name = "postgres"
+    remote = True
+
+    def __init__(self, dsn: str, channel: str = "chat_events", retry_interval: float = 5) -> None:
+        self.dsn = dsn
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+
+    async def _listen(self, handler: Handler) -> None:
+        import asyncpg  # type: ignore[import]
+
+        def on_notify(_conn, _pid, _channel, payload: str) -> None:
+            task = asyncio.create_task(handler(payload))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        conn = await asyncpg.connect(self.dsn)
+        closed = asyncio.Event()
+        conn.add_termination_listener(lambda _: closed.set())
+        try:
+            await conn.add_listener(self.channel, on_notify)
+            self._conn = conn
+            await closed.wait()
+        finally:
+            self._conn = None
+            if not conn.is_closed():
+                await conn.close()
+
+    async def run(self, handler: Handler) -> None:
+        while True:
+            try:
+                await self._listen(handler)
+                logger.warning("chat: pubsub listener connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning(f"chat: pubsub listener failed: {exc}")
+            await asyncio.sleep(self.retry_interval)
+
+    async def publish(self, message: str) -> bool:
+        conn = self._conn
+        if not conn:
+            return False
+        # one query at a time per asyncpg connection
+        async with self._lock:
+            await conn.execute("SELECT pg_notify($1, $2)", self.channel, message)
+        return True
+
+
+async def _send_to_websockets(channel: str, data: str) -> None:
+    await websocket_manager.send(channel, data)
+
+
+class ChatPubSub:
+    """
+    Relays chat websocket payloads to every worker. Each payload goes to the
+    local clients right away and to the backend in an envelope with a unique
+    id. Workers deliver envelopes from the backend to their own clients,
+    skipping their own and any id seen before.
+    """
+
+    def __init__(self, backend: LocalBackend | PostgresBackend, deliver: Deliver | None = None, max_seen: int = 4096):
+        self.backend = backend
+        self.deliver = deliver or _send_to_websockets
+        self.max_seen = max_seen
+        self.origin = urlsafe_short_hash()
+        self.published = 0
+        self.relayed = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self._seen: OrderedDict[str, None] = OrderedDict()
+
+    @property
+    def remote(self) -> bool:
+        return self.backend.remote
+
+    def _mark_seen(self, message_id: str) -> bool:
+        if message_id in self._seen:
+            return False
+        self._seen[message_id] = None
+        while len(self._seen) > self.max_seen:
+            self._seen.popitem(last=False)
+        return True
+
+    def _envelope(self, message_id: str, channel: str, data: str, ref: bool = False) -> str:
+        header: dict[str, Any] = {"id": message_id, "origin": self.origin, "channel": channel}
+        if ref:
+            header["ref"] = True
+        # `data` is JSON already, spliced in rather than encoded a second time
+        return f'{json.dumps(header)[:-1]}, "data": {data}}}'
+
+    async def publish(self, channel: str, payload: dict) -> None:
+        data = json.dumps(payload)
+        message_id = urlsafe_short_hash()
+        self._mark_seen(message_id)
+        self.published += 1
+        await self.deliver(channel, data)
+
+        message = self._envelope(message_id, channel, data)
+        if len(message.encode()) > MAX_NOTIFY_BYTES:
+            if not channel.startswith("chat:") or "seq" not in payload:
+                self.dropped += 1
+                logger.warning(f"chat: {channel} payload too large to relay")
+                return
+            # receivers load the recorded event instead
+            message = self._envelope(message_id, channel, json.dumps({"seq": payload["seq"]}), ref=True)
+        try:
+            if not await self.backend.publish(message):
+                self.dropped += 1
+        except Exception as exc:
+            self.dropped += 1
+            logger.warning(f"chat: pubsub publish failed: {exc}")
+
+    async def receive(self, message: str) -> None:
+        try:
+            envelope = json.loads(message)
+        except ValueError:
+            return
+        if envelope.get("origin") == self.origin:
+            # our own, the local clients already have it
+            return
+        if not self._mark_seen(envelope.get("id", "")):
+            self.duplicates += 1
+            return
+        channel = envelope["channel"]
+        payload = envelope["data"]
+        if envelope.get("ref"):
+            seq = payload["seq"]
+            events = await get_chat_events_after(channel.removeprefix("chat:"), seq - 1, 1)
+            if not events or events[0].seq != seq:
+                return
+            payload = {**events[0].payload, "seq": seq}
+        self.relayed += 1
+        try:
+            await self.deliver(channel, json.dumps(payload))
+        except Exception as exc:
+            logger.warning(f"chat: pubsub delivery failed: {exc}")
+
+    async def run(self) -> None:
+        await self.backend.run(self.receive)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend.name,
+            "published": self.published,
+            "relayed": self.relayed,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+        }
+
+
+def _default_backend() -> LocalBackend | PostgresBackend:
+    if db.type == POSTGRES and settings.lnbits_database_url:
+        return PostgresBackend(settings.lnbits_database_url)
+    return LocalBackend()
+
+
+chat_pubsub = ChatPubSub(_default_backend())
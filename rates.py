@@ -0,0 +1,76 @@
+import asyncio
+from time import monotonic
+
+from lnbits.settings import settings
+from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
+from loguru import logger
+
+from .cache import TTLCache
+
+
+class FiatRates:
+    """
+    Sats per unit of each fiat denomination, cached for `ttl` seconds.
+    `run` refetches the denominations used within `keep_warm` seconds before
+    they expire, so paid messages and price quotes rarely wait on the rate
+    providers.
+    """
+
+    def __init__(self, ttl: float = 120, refresh_interval: float = 60, keep_warm: float = 900) -> None:
+        self.cache = TTLCache("rates", maxsize=64, ttl=ttl)
+        self.refresh_interval = refresh_interval
+        self.keep_warm = keep_warm
+        self.last_used: dict[str, float] = {}
+        self.refreshed = 0
+        self.errors = 0
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    async def fetch(self, denomination: str) -> float:
+        rate = await get_fiat_rate_satoshis(denomination)
+        self.cache.set(denomination, rate)
+        return rate
+
+    async def get(self, denomination: str) -> float:
+        rate = self.cache.get(denomination)
+        if rate is None:
+            # one fetch per denomination, concurrent callers wait for it
+            async with self._locks.setdefault(denomination, asyncio.Lock()):
+                rate = self.cache.get(denomination)
+                if rate is None:
+                    rate = await self.fetch(denomination)
+        self.last_used[denomination] = monotonic()
+        return rate
+
+    async def refresh(self) -> int:
+        cutoff = monotonic() - self.keep_warm
+        refreshed = 0
+        for denomination, used_at in list(self.last_used.items()):
+            if used_at < cutoff:
+                self.last_used.pop(denomination, None)
+                continue
+            try:
+                await self.fetch(denomination)
+                refreshed += 1
+            except Exception as exc:
+                # the cached rate stays valid until its ttl runs out
+                self.errors += 1
+                logger.warning(f"Error refreshing {denomination} rate: {exc}")
+        self.refreshed += refreshed
+        return refreshed
+
+    async def run(self) -> None:
+        while settings.lnbits_running:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            "refresh_interval": self.refresh_interval,
+            "refreshed": self.refreshed,
+            "errors": self.errors,
+            "denominations": sorted(self.last_used),
+        }
+
+
+fiat_rates = FiatRates()
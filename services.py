@@ -1,38 +1,79 @@
+import base64
+import hmac
 import json
 import math
-from datetime import datetime, timezone
+import zlib
+from collections.abc import Callable
+from datetime import datetime, timedelta, timezone
 
+from lnbits.core.crud.payments import get_standalone_payment
 from lnbits.core.crud.users import get_user
 from lnbits.core.crud.wallets import get_wallets
 from lnbits.core.models import Payment
 from lnbits.core.services import create_invoice, pay_invoice, websocket_manager
-from lnbits.core.services.notifications import send_notification
+from lnbits.core.services.notifications import (
+    send_email_notification,
+    send_nostr_notification,
+    send_telegram_notification,
+)
+from lnbits.db import Connection
 from lnbits.helpers import urlsafe_short_hash
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis
+from lnbits.settings import settings
 from loguru import logger
 
+from .cache import wallets_cache
 from .crud import (
-    create_chat,
+    archive_chat,
+    create_chat_event,
+    create_chat_if_missing,
+    create_chat_message,
     create_chat_payment,
+    credit_chat_balance,
+    debit_chat_balance,
     get_categories_by_id,
     get_chat,
+    get_chat_events_after,
     get_chat_for_category,
+    get_chat_ids_to_archive,
+    get_chat_messages_before,
     get_chat_payment,
+    mark_chat_payment_paid,
+    transaction,
     update_chat,
-    update_chat_payment,
+    update_chat_activity,
+    update_outbox_job,
 )
+from .dispatch import dispatcher
 from .models import (
+    ArchivedChat,
     Categories,
+    ChatEventsPage,
     ChatMessage,
+    ChatMessagesPage,
     ChatParticipant,
     ChatPayment,
     ChatPaymentRequest,
     ChatSession,
+    ChatSummary,
     CreateChat,
     CreateChatMessage,
+    OutboxJob,
+    PriceQuote,
 )
+from .pubsub import chat_pubsub
+from .rates import fiat_rates
+from .writer import chat_writers
 
 MAX_PARTICIPANTS = 10
+MAX_WRITE_ATTEMPTS = 5
+MESSAGES_PAGE_SIZE = 50
+MAX_MESSAGES_PAGE_SIZE = 200
+MAX_EVENTS_PAGE_SIZE = 200
+MAX_SEARCH_RESULTS = 50
+ARCHIVE_BATCH_SIZE = 100
+# how long a provisional chat can wait for its first message
+CHAT_TOKEN_TTL = timedelta(days=30)
+PREVIEW_LENGTH = 120
 
 
 def _clean_name(value: str | None, fallback: str) -> str:
@@ -62,26 +103,74 @@ def _message_payload(message: dict) -> dict:
 
 async def _broadcast_chat(chat_id: str, payload: dict) -> None:
     try:
-        await websocket_manager.send(f"chat:{chat_id}", json.dumps(payload))
+        event = await create_chat_event(chat_id, payload["type"], payload)
+        if event:
+            payload = {**payload, "seq": event.seq}
+    except Exception as exc:
+        logger.warning(f"chat: recording event failed: {exc}")
+    try:
+        await chat_pubsub.publish(f"chat:{chat_id}", payload)
     except Exception as exc:
         logger.warning(f"chat: websocket send failed: {exc}")
 
 
-async def _broadcast_balance(chat_id: str, balance: int) -> None:
-    payload = {"type": "balance", "balance": balance}
-    await _broadcast_chat(chat_id, payload)
-    await websocket_manager.send(f"chatbalance:{chat_id}", json.dumps(payload))
+def owner_channel(user_id: str) -> str:
+    digest = hmac.new(
+        settings.auth_secret_key.encode(),
+        f"chat-owner:{user_id}".encode(),
+        "sha256",
+    ).hexdigest()
+    return f"chatowner:{digest[:32]}"
+
+
+def _owner_feed_listening() -> bool:
+    return any(conn.item_id.startswith("chatowner:") for conn in websocket_manager.active_connections)
+
+
+def _serialize_changes(changes: dict) -> dict:
+    return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in changes.items()}
+
+
+async def _broadcast_owner(categories_id: str, payload: dict) -> None:
+    # the owner may be connected to another worker
+    if not chat_pubsub.remote and not _owner_feed_listening():
+        return
+    category = await get_categories_by_id(categories_id)
+    if not category:
+        return
+    try:
+        await chat_pubsub.publish(owner_channel(category.user_id), payload)
+    except Exception as exc:
+        logger.warning(f"chat: owner feed send failed: {exc}")
+
+
+async def _broadcast_chat_update(chat: ChatSession, **changes) -> None:
+    payload = {"type": "update", "chat_id": chat.id, "changes": _serialize_changes(changes)}
+    await _broadcast_owner(chat.categories_id, payload)
 
 
-async def _broadcast_claim(chat_id: str, claimed_by_id: str | None, claimed_by_name: str | None) -> None:
+async def _broadcast_balance(chat: ChatSession) -> None:
+    payload = {"type": "balance", "balance": chat.balance}
+    await _broadcast_chat(chat.id, payload)
+    await _broadcast_chat_update(chat, balance=chat.balance)
+
+
+async def _broadcast_claim(chat: ChatSession) -> None:
     payload = {
         "type": "claim",
-        "claimed_by_name": claimed_by_name,
+        "claimed_by_name": chat.claimed_by_name,
     }
-    await _broadcast_chat(chat_id, payload)
+    await _broadcast_chat(chat.id, payload)
+    await _broadcast_chat_update(
+        chat,
+        claimed_by_id=chat.claimed_by_id,
+        claimed_by_name=chat.claimed_by_name,
+    )
 
 
-async def _maybe_pay_claim_split(category: Categories, chat: ChatSession, amount: int) -> None:
+async def _maybe_pay_claim_split(
+    category: Categories, chat: ChatSession, amount: int, conn: Connection | None = None
+) -> None:
     if not chat.claimed_by_id:
         return
     split = float(category.claim_split or 0)
@@ -91,34 +180,59 @@ async def _maybe_pay_claim_split(category: Categories, chat: ChatSession, amount
     split_amount = math.floor(amount * (split / 100))
     if split_amount <= 0:
         return
-    claimer_wallets = await get_wallets(chat.claimed_by_id)
-    if not claimer_wallets:
+    await dispatcher.enqueue(
+        "claim_split",
+        {
+            "categories_id": category.id,
+            "chat_id": chat.id,
+            "claimed_by_id": chat.claimed_by_id,
+            "amount": split_amount,
+        },
+        conn=conn,
+    )
+
+
+async def _dispatch_claim_split(job: OutboxJob) -> None:
+    payload = job.payload
+    category = await get_categories_by_id(payload["categories_id"])
+    if not category:
+        return
+    claimer_wallet_id = await _resolve_user_wallet(payload["claimed_by_id"])
+    if not claimer_wallet_id:
         return
     category_wallet_id = await _resolve_category_wallet(category)
     if not category_wallet_id:
         return
-    try:
+    split_amount = int(payload["amount"])
+    # The invoice is created once and kept on the job, so a retry pays the
+    # same invoice instead of paying the claimer twice.
+    if not payload.get("payment_hash"):
         claim_invoice = await create_invoice(
-            wallet_id=claimer_wallets[0].id,
+            wallet_id=claimer_wallet_id,
             amount=split_amount,
             memo=f"Chat claim split for {category.name}",
             extra={
                 "tag": "chat",
                 "payment_type": "claim_split",
-                "chat_id": chat.id,
-                "categories_id": chat.categories_id,
-                "claimed_by_id": chat.claimed_by_id,
+                "chat_id": payload["chat_id"],
+                "categories_id": category.id,
+                "claimed_by_id": payload["claimed_by_id"],
             },
         )
-        await pay_invoice(
-            wallet_id=category_wallet_id,
-            payment_request=claim_invoice.bolt11,
-            max_sat=split_amount,
-            description="Chat claim split",
-            tag="chat",
-        )
-    except Exception as exc:
-        logger.warning(f"Chat claim split payment failed: {exc}")
+        payload["payment_hash"] = claim_invoice.payment_hash
+        payload["payment_request"] = claim_invoice.bolt11
+        await update_outbox_job(job)
+    else:
+        existing = await get_standalone_payment(payload["payment_hash"], incoming=True)
+        if existing and existing.success:
+            return
+    await pay_invoice(
+        wallet_id=category_wallet_id,
+        payment_request=payload["payment_request"],
+        max_sat=split_amount,
+        description="Chat claim split",
+        tag="chat",
+    )
 
 
 def _parse_notify_emails(raw: str | None) -> list[str]:
@@ -127,11 +241,29 @@ def _parse_notify_emails(raw: str | None) -> list[str]:
     return [email.strip() for email in raw.split(",") if email.strip()]
 
 
+async def _resolve_user_wallet(user_id: str) -> str | None:
+    key = f"user:{user_id}"
+    wallet_id = wallets_cache.get(key)
+    if wallet_id:
+        return wallet_id
+    wallets = await get_wallets(user_id)
+    if not wallets:
+        return None
+    wallets_cache.set(key, wallets[0].id)
+    return wallets[0].id
+
+
 async def _resolve_category_wallet(category: Categories) -> str | None:
     if category.wallet:
         return category.wallet
-    wallets = await get_wallets(category.user_id)
-    return wallets[0].id if wallets else None
+    key = f"category:{category.id}"
+    wallet_id = wallets_cache.get(key)
+    if wallet_id:
+        return wallet_id
+    wallet_id = await _resolve_user_wallet(category.user_id)
+    if wallet_id:
+        wallets_cache.set(key, wallet_id)
+    return wallet_id
 
 
 def _build_chat_link(base_url: str | None, chat: ChatSession) -> str:
@@ -147,18 +279,92 @@ async def _notify_new_chat(
     chat: ChatSession,
     base_url: str | None = None,
     first_message: str | None = None,
+    conn: Connection | None = None,
 ) -> None:
+    targets: list[tuple[str, str | list[str]]] = []
+    if category.notify_telegram:
+        targets.append(("telegram", category.notify_telegram))
+    if category.notify_nostr:
+        targets.append(("nostr", category.notify_nostr))
+    emails = _parse_notify_emails(category.notify_email)
+    if emails:
+        targets.append(("email", emails))
+    if not targets:
+        return
     chat_link = _build_chat_link(base_url, chat)
     if first_message:
         message = f'You have a new chat: "{first_message}" {chat_link}'
     else:
         message = f"You have a new chat {chat_link}"
-    await send_notification(
-        category.notify_telegram,
-        [category.notify_nostr] if category.notify_nostr else [],
-        _parse_notify_emails(category.notify_email),
-        message,
-        "chat.new",
+    # One job per channel, so a failing channel is retried on its own
+    # without resending to the ones that already went out.
+    for channel, target in targets:
+        await dispatcher.enqueue("notify", {"channel": channel, "target": target, "message": message}, conn=conn)
+
+
+async def _dispatch_notification(job: OutboxJob) -> None:
+    channel = job.payload["channel"]
+    target = job.payload["target"]
+    message = job.payload["message"]
+    if channel == "telegram" and settings.is_telegram_notifications_configured():
+        await send_telegram_notification(target, message)
+    elif channel == "nostr" and settings.is_nostr_notifications_configured():
+        await send_nostr_notification(target, message)
+    elif channel == "email" and settings.lnbits_email_notifications_enabled:
+        result = await send_email_notification(target, message)
+        if result.get("status") != "ok":
+            raise ValueError(result.get("message") or "Email notification failed.")
+
+
+dispatcher.register("claim_split", _dispatch_claim_split)
+dispatcher.register("notify", _dispatch_notification)
+
+
+def _sign_chat_token(payload: str) -> str:
+    return hmac.new(
+        settings.auth_secret_key.encode(),
+        f"chat-token:{payload}".encode(),
+        "sha256",
+    ).hexdigest()
+
+
+def create_chat_token(chat: ChatSession) -> str:
+    data = {
+        "id": chat.id,
+        "categories_id": chat.categories_id,
+        "participants": chat.participants,
+        "iat": int(chat.created_at.timestamp()),
+    }
+    payload = base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode().rstrip("=")
+    return f"{payload}.{_sign_chat_token(payload)}"
+
+
+def read_chat_token(token: str | None, chat_id: str, categories_id: str | None = None) -> ChatSession | None:
+    """
+    The provisional chat a token was issued for. None if the token is
+    missing, forged, expired or belongs to another chat.
+    """
+    if not token or "." not in token:
+        return None
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _sign_chat_token(payload)):
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except ValueError:
+        return None
+    if data.get("id") != chat_id or (categories_id and data.get("categories_id") != categories_id):
+        return None
+    created_at = datetime.fromtimestamp(data["iat"], timezone.utc)
+    if created_at < datetime.now(timezone.utc) - CHAT_TOKEN_TTL:
+        return None
+    return ChatSession(
+        id=chat_id,
+        categories_id=data["categories_id"],
+        participants=data["participants"],
+        created_at=created_at,
+        updated_at=created_at,
+        token=token,
     )
 
 
@@ -167,6 +373,11 @@ async def create_public_chat(
     data: CreateChat,
     base_url: str,
 ) -> ChatSession:
+    """
+    Hand out a provisional chat without writing it. The row is created by
+    `materialize_chat` when the first message, tip or LNURL funding arrives,
+    so page loads that never write leave nothing behind.
+    """
     category = await get_categories_by_id(categories_id)
     if not category:
         raise ValueError("Invalid categories ID.")
@@ -188,55 +399,187 @@ async def create_public_chat(
         updated_at=datetime.now(timezone.utc),
     )
     chat.public_url = _build_chat_link(base_url, chat)
-    await create_chat(categories_id, chat)
+    chat.token = create_chat_token(chat)
     return chat
 
 
-async def get_public_chat(categories_id: str, chat_id: str) -> ChatSession:
-    chat = await get_chat_for_category(categories_id, chat_id)
+async def materialize_chat(
+    chat_id: str,
+    token: str | None,
+    base_url: str | None,
+    categories_id: str | None = None,
+) -> ChatSession | None:
+    """
+    The chat row, created from its provisional token if this is the first
+    write. None if there is no row and the token is not valid for the chat.
+    """
+    if categories_id:
+        chat = await get_chat_for_category(categories_id, chat_id, include_messages=False)
+    else:
+        chat = await get_chat(chat_id, include_messages=False)
+    if chat:
+        return chat
+    provisional = read_chat_token(token, chat_id, categories_id)
+    if not provisional:
+        return None
+    provisional.public_url = _build_chat_link(base_url, provisional)
+    provisional.updated_at = datetime.now(timezone.utc)
+    if await create_chat_if_missing(provisional):
+        await _broadcast_owner(
+            provisional.categories_id,
+            {"type": "created", "chat": json.loads(ChatSummary(**provisional.dict()).json())},
+        )
+    return await get_chat(chat_id, include_messages=False)
+
+
+async def get_public_chat(
+    categories_id: str,
+    chat_id: str,
+    messages_limit: int | None = None,
+    token: str | None = None,
+) -> ChatSession:
+    chat = await get_chat_for_category(categories_id, chat_id, include_messages=not messages_limit)
     if not chat:
-        raise ValueError("Chat not found.")
+        provisional = read_chat_token(token, chat_id, categories_id)
+        if not provisional:
+            raise ValueError("Chat not found.")
+        return _sanitize_public_chat(provisional)
+    if messages_limit:
+        await load_latest_messages(chat, messages_limit)
     return _sanitize_public_chat(chat)
 
 
-def _ensure_participant(chat: ChatSession, sender_id: str, sender_name: str, sender_role: str) -> None:
+async def get_chat_messages_page(
+    chat_id: str,
+    before: str | None = None,
+    limit: int = MESSAGES_PAGE_SIZE,
+) -> ChatMessagesPage:
+    limit = max(1, min(limit, MAX_MESSAGES_PAGE_SIZE))
+    messages = await get_chat_messages_before(chat_id, limit + 1, before)
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    data = [_serialize_message(message) for message in messages]
+    return ChatMessagesPage(
+        data=data,
+        next_cursor=messages[0].id if has_more else None,
+    )
+
+
+async def get_chat_events_page(
+    chat: ChatSession,
+    after: int,
+    limit: int = MAX_EVENTS_PAGE_SIZE,
+) -> ChatEventsPage:
+    limit = max(1, min(limit, MAX_EVENTS_PAGE_SIZE))
+    events = await get_chat_events_after(chat.id, after, limit + 1)
+    has_more = len(events) > limit
+    events = events[:limit]
+    # A client ahead of the chat, or a hole before the first event, means the
+    # missed events were pruned and only a full reload is consistent.
+    if after > chat.event_seq or (after < chat.event_seq and (not events or events[0].seq != after + 1)):
+        return ChatEventsPage(last_seq=chat.event_seq, reset=True)
+    return ChatEventsPage(
+        data=[{**event.payload, "seq": event.seq} for event in events],
+        last_seq=events[-1].seq if events else after,
+        has_more=has_more,
+    )
+
+
+async def load_latest_messages(chat: ChatSession, limit: int) -> ChatSession:
+    page = await get_chat_messages_page(chat.id, limit=limit)
+    chat.messages = page.data
+    chat.messages_cursor = page.next_cursor
+    return chat
+
+
+def _ensure_participant(chat: ChatSession, sender_id: str, sender_name: str, sender_role: str) -> bool:
     normalized_name = (sender_name or "").strip().lower()
     for participant in chat.participants:
         if participant.get("id") == sender_id:
-            return
+            return False
         existing_name = (participant.get("name") or "").strip().lower()
         if normalized_name and existing_name == normalized_name:
-            return
+            return False
     if len(chat.participants) >= MAX_PARTICIPANTS:
         raise ValueError("Chat is full.")
     chat.participants.append(_serialize_participant(ChatParticipant(id=sender_id, name=sender_name, role=sender_role)))
+    return True
+
+
+def _public_admin_id(name: str | None) -> str:
+    return f"admin-{name or 'admin'}"
 
 
 def _sanitize_public_chat(chat: ChatSession) -> ChatSession:
-    sanitized = chat.copy(deep=True)
-    sanitized.claimed_by_id = None
-    for participant in sanitized.participants:
-        if participant.get("role") == "admin":
-            name = participant.get("name") or "admin"
-            participant["id"] = f"admin-{name}"
-    for message in sanitized.messages:
-        if message.get("sender_role") == "admin":
-            name = message.get("sender_name") or "admin"
-            message["sender_id"] = f"admin-{name}"
-    return sanitized
+    """
+    Admin messages and participants are stored under their public id, only
+    the claimer's user id has to go. `chat` is the caller's own copy.
+    """
+    chat.claimed_by_id = None
+    return chat
 
 
-async def _append_message(chat: ChatSession, message: ChatMessage, unread: bool) -> ChatSession:
-    payload = _serialize_message(message)
-    chat.messages.append(payload)
+async def _store_message(
+    chat: ChatSession, message: ChatMessage, unread: bool, conn: Connection | None = None
+) -> ChatSession:
+    message.chat_id = chat.id
+    await create_chat_message(message, conn=conn)
+    chat.messages.append(_serialize_message(message))
+    chat.message_count += 1
+    chat.last_message_preview = message.message[:PREVIEW_LENGTH]
     chat.last_message_at = message.created_at
     chat.unread = unread
     chat.updated_at = datetime.now(timezone.utc)
-    await update_chat(chat)
-    await _broadcast_chat(chat.id, _message_payload(payload))
+    updated = await update_chat_activity(chat, conn=conn)
+    if updated:
+        chat.message_count = updated.message_count
+        chat.version = updated.version
+    return chat
+
+
+async def _publish_message(chat: ChatSession, message: ChatMessage) -> None:
+    await _broadcast_chat(chat.id, _message_payload(_serialize_message(message)))
+    await _broadcast_chat_update(
+        chat,
+        last_message_at=chat.last_message_at,
+        last_message_preview=chat.last_message_preview,
+        message_count=chat.message_count,
+        unread=chat.unread,
+        updated_at=chat.updated_at,
+    )
+
+
+async def _append_message(chat: ChatSession, message: ChatMessage, unread: bool) -> ChatSession:
+    async with chat_writers.hold(chat.id):
+        # message row and counters together, the empty chat sweeper only looks at the counters
+        async with transaction() as conn:
+            await _store_message(chat, message, unread, conn=conn)
+        await _publish_message(chat, message)
     return chat
 
 
+async def _mutate_chat(chat_id: str, mutate: Callable[[ChatSession], bool]) -> tuple[ChatSession, bool]:
+    """
+    Apply `mutate` to a fresh copy of the chat and save it, one writer per chat
+    at a time. `mutate` returns False when there is nothing to save. A write
+    from another worker in between is detected by the row version and the
+    mutation is applied again to the newer row.
+    """
+    async with chat_writers.hold(chat_id):
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            chat = await get_chat(chat_id, include_messages=False)
+            if not chat:
+                raise ValueError("Chat not found.")
+            if not mutate(chat):
+                return chat, False
+            updated = await update_chat(chat)
+            if updated:
+                return updated, True
+            chat_writers.conflicts += 1
+    raise ValueError("Chat is busy, try again.")
+
+
 async def _calculate_amount(category: Categories, message: str) -> int:
     if not category.price_chars:
         return 0
@@ -244,11 +587,22 @@ async def _calculate_amount(category: Categories, message: str) -> int:
     if raw_amount <= 0:
         return 0
     if category.denomination and category.denomination != "sat":
-        sats = await fiat_amount_as_satoshis(raw_amount, category.denomination)
-        return math.ceil(sats)
+        rate = await fiat_rates.get(category.denomination)
+        return int(raw_amount * rate)
     return math.ceil(raw_amount)
 
 
+async def get_price_quote(category: Categories) -> PriceQuote:
+    denomination = category.denomination or "sat"
+    sats_per_unit = 1.0 if denomination == "sat" else await fiat_rates.get(denomination)
+    return PriceQuote(
+        denomination=denomination,
+        price_chars=category.price_chars or 0,
+        sats_per_unit=sats_per_unit,
+        ttl=int(fiat_rates.cache.ttl),
+    )
+
+
 async def _handle_lnurlp_drawdown(
     category: Categories,
     chat: ChatSession,
@@ -257,10 +611,6 @@ async def _handle_lnurlp_drawdown(
     sender_name: str,
     base_url: str | None,
 ) -> ChatPaymentRequest:
-    if chat.balance < amount:
-        raise ValueError("Insufficient balance. Fund the chat to continue.")
-    chat.balance = max(0, chat.balance - amount)
-    await _maybe_pay_claim_split(category, chat, amount)
     message = ChatMessage(
         id=urlsafe_short_hash(),
         sender_id=data.sender_id,
@@ -271,10 +621,19 @@ async def _handle_lnurlp_drawdown(
         amount=amount,
         message_type="message",
     )
-    if not chat.messages:
-        await _notify_new_chat(category, chat, base_url, data.message)
-    await _append_message(chat, message, unread=True)
-    await _broadcast_balance(chat.id, chat.balance)
+    async with chat_writers.hold(chat.id):
+        # the debit stands only if the message is stored with it
+        async with transaction() as conn:
+            debited = await debit_chat_balance(chat.id, amount, conn=conn)
+            if not debited:
+                raise ValueError("Insufficient balance. Fund the chat to continue.")
+            chat.balance = debited.balance
+            await _maybe_pay_claim_split(category, chat, amount, conn=conn)
+            if not chat.last_message_at:
+                await _notify_new_chat(category, chat, base_url, data.message, conn=conn)
+            await _store_message(chat, message, unread=True, conn=conn)
+        await _publish_message(chat, message)
+    await _broadcast_balance(chat)
     return ChatPaymentRequest(chat_id=chat.id, pending=False, message_id=message.id)
 
 
@@ -340,7 +699,7 @@ async def _send_free_message(
         message=data.message,
         created_at=datetime.now(timezone.utc),
     )
-    if not chat.messages:
+    if not chat.last_message_at:
         await _notify_new_chat(category, chat, base_url, data.message)
     await _append_message(chat, message, unread=True)
     return ChatPaymentRequest(chat_id=chat.id, pending=False, message_id=message.id)
@@ -356,14 +715,17 @@ async def send_public_message(
     category = await get_categories_by_id(categories_id)
     if not category:
         raise ValueError("Invalid categories ID.")
-    chat = await get_chat_for_category(categories_id, chat_id)
-    if not chat:
-        raise ValueError("Chat not found.")
     if category.chars and len(data.message) > category.chars:
         raise ValueError("Message too long.")
+    chat = await materialize_chat(chat_id, data.token, base_url, categories_id=categories_id)
+    if not chat:
+        raise ValueError("Chat not found.")
 
     sender_name = _clean_name(data.sender_name, "anon")
-    _ensure_participant(chat, data.sender_id, sender_name, data.sender_role)
+    if _ensure_participant(chat, data.sender_id, sender_name, data.sender_role):
+        chat, _ = await _mutate_chat(
+            chat.id, lambda latest: _ensure_participant(latest, data.sender_id, sender_name, data.sender_role)
+        )
 
     if user_id and chat.claimed_by_id and chat.claimed_by_id != user_id:
         claimed_name = chat.claimed_by_name or "another user"
@@ -386,14 +748,19 @@ async def send_admin_message(
     chat_id: str,
     data: CreateChatMessage,
 ) -> ChatMessage:
-    chat = await get_chat(chat_id)
+    chat = await get_chat(chat_id, include_messages=False)
     if not chat:
         raise ValueError("Chat not found.")
     sender_name = _clean_name(data.sender_name, "support")
-    _ensure_participant(chat, data.sender_id, sender_name, "admin")
+    # the public page sees every message, so admins never go in by user id
+    sender_id = _public_admin_id(sender_name)
+    if _ensure_participant(chat, sender_id, sender_name, "admin"):
+        chat, _ = await _mutate_chat(
+            chat.id, lambda latest: _ensure_participant(latest, sender_id, sender_name, "admin")
+        )
     message = ChatMessage(
         id=urlsafe_short_hash(),
-        sender_id=data.sender_id,
+        sender_id=sender_id,
         sender_name=sender_name,
         sender_role="admin",
         message=data.message,
@@ -404,25 +771,29 @@ async def send_admin_message(
 
 
 async def mark_chat_resolved(chat_id: str, resolved: bool) -> ChatSession:
-    chat = await get_chat(chat_id)
-    if not chat:
-        raise ValueError("Chat not found.")
-    chat.resolved = resolved
-    chat.updated_at = datetime.now(timezone.utc)
-    await update_chat(chat)
+    def resolve(chat: ChatSession) -> bool:
+        chat.resolved = resolved
+        chat.updated_at = datetime.now(timezone.utc)
+        return True
+
+    chat, _ = await _mutate_chat(chat_id, resolve)
     await _broadcast_chat(chat.id, {"type": "resolved", "resolved": resolved})
+    await _broadcast_chat_update(chat, resolved=resolved, updated_at=chat.updated_at)
     return chat
 
 
 async def mark_chat_seen(chat_id: str) -> ChatSession:
-    chat = await get_chat(chat_id)
-    if not chat:
-        raise ValueError("Chat not found.")
-    if chat.unread:
+    def see(chat: ChatSession) -> bool:
+        if not chat.unread:
+            return False
         chat.unread = False
         chat.updated_at = datetime.now(timezone.utc)
-        await update_chat(chat)
+        return True
+
+    chat, seen = await _mutate_chat(chat_id, see)
+    if seen:
         await _broadcast_chat(chat.id, {"type": "seen"})
+        await _broadcast_chat_update(chat, unread=False, updated_at=chat.updated_at)
     return chat
 
 
@@ -432,6 +803,8 @@ async def request_tip(
     amount: int,
     sender_id: str,
     sender_name: str,
+    token: str | None = None,
+    base_url: str | None = None,
 ) -> ChatPaymentRequest:
     if amount <= 0:
         raise ValueError("Tip amount must be positive.")
@@ -441,6 +814,8 @@ async def request_tip(
     wallet_id = await _resolve_category_wallet(category)
     if not wallet_id:
         raise ValueError("Category wallet not configured.")
+    if not await materialize_chat(chat_id, token, base_url, categories_id=categories_id):
+        raise ValueError("Chat not found.")
 
     sender_name = _clean_name(sender_name, "anon")
     payment = await create_invoice(
@@ -480,69 +855,96 @@ async def request_tip(
     )
 
 
-async def _apply_balance_payment(chat_id: str | None, amount_sat: int) -> bool:
+async def _apply_balance_payment(payment: Payment) -> bool:
+    chat_id = payment.extra.get("chat_id")
     if not chat_id:
         logger.warning("Chat balance payment missing chat_id.")
         return False
-    chat = await get_chat(chat_id)
-    if not chat:
-        logger.warning("Chat not found for balance payment.")
-        return False
-    chat.balance = max(0, chat.balance + amount_sat)
-    chat.updated_at = datetime.now(timezone.utc)
-    await update_chat(chat)
-    await _broadcast_balance(chat.id, chat.balance)
+    async with transaction() as conn:
+        # LNURL top-ups have no pending chat payment, the row written here
+        # marks the payment_hash as applied so a replay does not credit twice.
+        if await get_chat_payment(payment.payment_hash, conn=conn):
+            return True
+        chat = await credit_chat_balance(chat_id, max(0, payment.sat), conn=conn)
+        if not chat:
+            logger.warning("Chat not found for balance payment.")
+            return False
+        await create_chat_payment(
+            ChatPayment(
+                payment_hash=payment.payment_hash,
+                chat_id=chat.id,
+                categories_id=chat.categories_id,
+                sender_id="lnurl",
+                sender_name="lnurl",
+                sender_role="public",
+                message="",
+                amount=payment.sat,
+                payment_type="balance",
+                paid=True,
+            ),
+            conn=conn,
+        )
+    await _broadcast_balance(chat)
     return True
 
 
 async def _finalize_chat_payment(chat_payment: ChatPayment) -> bool:
-    if chat_payment.paid:
-        return True
-
-    chat_payment.paid = True
-    await update_chat_payment(chat_payment)
-
-    chat = await get_chat(chat_payment.chat_id)
-    if not chat:
-        logger.warning("Chat not found for payment.")
-        return False
-
-    if chat_payment.payment_type == "balance":
-        chat.balance = max(0, chat.balance + chat_payment.amount)
-        chat.updated_at = datetime.now(timezone.utc)
-        await update_chat(chat)
-        await _broadcast_balance(chat.id, chat.balance)
+    category = await get_categories_by_id(chat_payment.categories_id)
+    # a paid invoice is not delivered again, so it waits its turn however busy the chat is
+    async with chat_writers.hold(chat_payment.chat_id, capped=False):
+        message: ChatMessage | None = None
+        try:
+            async with transaction() as conn:
+                # Only the delivery that flips `paid` carries on, duplicates stop here.
+                if not await mark_chat_payment_paid(chat_payment.payment_hash, conn=conn):
+                    return True
+                chat = await get_chat(chat_payment.chat_id, include_messages=False, conn=conn)
+                if not chat:
+                    # rolls back `paid` too, so a replay can still deliver it
+                    raise ValueError("Chat not found for payment.")
+
+                if chat_payment.payment_type == "balance":
+                    chat = await credit_chat_balance(chat.id, max(0, chat_payment.amount), conn=conn)
+                    if not chat:
+                        raise ValueError("Chat not found for payment.")
+                else:
+                    if chat_payment.payment_type == "message" and category:
+                        await _maybe_pay_claim_split(category, chat, chat_payment.amount, conn=conn)
+                    message = ChatMessage(
+                        id=urlsafe_short_hash(),
+                        sender_id=chat_payment.sender_id,
+                        sender_name=chat_payment.sender_name,
+                        sender_role=chat_payment.sender_role,
+                        message=chat_payment.message,
+                        created_at=datetime.now(timezone.utc),
+                        amount=chat_payment.amount,
+                        message_type="tip" if chat_payment.payment_type == "tip" else "message",
+                    )
+                    if not chat.last_message_at and category:
+                        await _notify_new_chat(category, chat, None, chat_payment.message, conn=conn)
+                    await _store_message(chat, message, unread=True, conn=conn)
+        except ValueError as exc:
+            logger.warning(str(exc))
+            return False
+
+        if message:
+            await _publish_message(chat, message)
+        else:
+            await _broadcast_balance(chat)
+        # lets the payer's page close its invoice dialog without a socket per invoice
+        await _broadcast_chat(
+            chat.id,
+            {"type": "paid", "payment_hash": chat_payment.payment_hash, "amount": chat_payment.amount},
+        )
         return True
 
-    message_type = "tip" if chat_payment.payment_type == "tip" else "message"
-    if chat_payment.payment_type == "message":
-        category = await get_categories_by_id(chat.categories_id)
-        if category:
-            await _maybe_pay_claim_split(category, chat, chat_payment.amount)
-    message = ChatMessage(
-        id=urlsafe_short_hash(),
-        sender_id=chat_payment.sender_id,
-        sender_name=chat_payment.sender_name,
-        sender_role=chat_payment.sender_role,
-        message=chat_payment.message,
-        created_at=datetime.now(timezone.utc),
-        amount=chat_payment.amount,
-        message_type=message_type,
-    )
-    if not chat.messages:
-        category = await get_categories_by_id(chat.categories_id)
-        if category:
-            await _notify_new_chat(category, chat, None, chat_payment.message)
-    await _append_message(chat, message, unread=True)
-    return True
-
 
 async def payment_received_for_client_data(payment: Payment) -> bool:
     if payment.extra.get("tag") != "chat":
         return False
 
     if payment.extra.get("payment_type") == "balance":
-        return await _apply_balance_payment(payment.extra.get("chat_id"), payment.sat)
+        return await _apply_balance_payment(payment)
 
     chat_payment = await get_chat_payment(payment.payment_hash)
     if not chat_payment:
@@ -553,22 +955,46 @@ async def payment_received_for_client_data(payment: Payment) -> bool:
 
 
 async def toggle_chat_claim(chat_id: str, user_id: str) -> ChatSession:
-    chat = await get_chat(chat_id)
-    if not chat:
-        raise ValueError("Chat not found.")
-
     user = await get_user(user_id)
     if not user:
         raise ValueError("User not found.")
 
-    if chat.claimed_by_id == user_id:
-        chat.claimed_by_id = None
-        chat.claimed_by_name = None
-    else:
-        chat.claimed_by_id = user_id
-        chat.claimed_by_name = user.username or "user"
+    def claim(chat: ChatSession) -> bool:
+        if chat.claimed_by_id == user_id:
+            chat.claimed_by_id = None
+            chat.claimed_by_name = None
+        else:
+            chat.claimed_by_id = user_id
+            chat.claimed_by_name = user.username or "user"
+        chat.updated_at = datetime.now(timezone.utc)
+        return True
 
-    chat.updated_at = datetime.now(timezone.utc)
-    await update_chat(chat)
-    await _broadcast_claim(chat.id, chat.claimed_by_id, chat.claimed_by_name)
+    chat, _ = await _mutate_chat(chat_id, claim)
+    await _broadcast_claim(chat)
     return chat
+
+
+async def archive_category_chats(category: Categories, limit: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Archive one batch of the category's chats that are past its retention.
+    Returns how many were moved, fewer than `limit` means the backlog is done.
+    """
+    now = datetime.now(timezone.utc)
+    resolved_before = now - timedelta(days=category.archive_resolved_days) if category.archive_resolved_days else None
+    idle_before = now - timedelta(days=category.archive_idle_days) if category.archive_idle_days else None
+    chat_ids = await get_chat_ids_to_archive(category.id, resolved_before, idle_before, limit)
+    archived = 0
+    for chat_id in chat_ids:
+        # one chat failing does not hold back the rest of the batch
+        try:
+            if await archive_chat(chat_id):
+                archived += 1
+        except Exception as exc:
+            logger.warning(f"Error archiving chat {chat_id}: {exc}")
+    return archived
+
+
+def get_archived_chat_export(archived: ArchivedChat) -> dict:
+    if not archived.data:
+        return {}
+    return json.loads(zlib.decompress(base64.b64decode(archived.data)))
@@ -4,6 +4,7 @@ window.PageChatEmbed = {
     return {
       categoriesId: '',
       chatId: '',
+      chatToken: null,
       participantId: '',
       participantName: '',
       messageInput: '',
@@ -28,17 +29,24 @@ window.PageChatEmbed = {
       showTipDialog: false,
       tipAmount: null,
       chatSocket: null,
-      balanceSocket: null,
+      pendingPaymentHash: null,
       isMinimized: false,
       launcherText: 'Chat to us',
       lnurlPay: '',
       lnurlDialog: false,
-      authUser: null
+      authUser: null,
+      messagesPageSize: 50,
+      messagesCursor: null,
+      loadingOlder: false,
+      lastSeq: 0,
+      catchingUp: false,
+      catchUpAgain: false
     }
   },
   watch: {
     'chatData.messages': {
       handler() {
+        if (this.loadingOlder) return
         this.$nextTick(() => this.scrollToBottom())
       },
       deep: true
@@ -123,6 +131,7 @@ window.PageChatEmbed = {
       const chatId = this.$route.params.chat
       if (chatId) {
         this.chatId = chatId
+        this.chatToken = this.$q.localStorage.getItem(this.chatTokenKey())
         await this.fetchChat()
         return
       }
@@ -138,6 +147,14 @@ window.PageChatEmbed = {
       )
       this.chatId = data.id
       this.chatData = data
+      // the chat is only stored with its first message, until then the
+      // signed token stands in for it
+      this.chatToken = data.token || null
+      if (this.chatToken) {
+        this.$q.localStorage.set(this.chatTokenKey(), this.chatToken)
+      }
+      this.messagesCursor = null
+      this.lastSeq = data.event_seq || 0
       this.updateChatUrl()
     },
 
@@ -148,12 +165,49 @@ window.PageChatEmbed = {
       window.history.replaceState({}, '', target)
     },
 
+    chatTokenKey() {
+      return `lnbits.chat.token.${this.chatId}`
+    },
+
+    withToken(url) {
+      if (!this.chatToken) return url
+      const separator = url.includes('?') ? '&' : '?'
+      return `${url}${separator}token=${encodeURIComponent(this.chatToken)}`
+    },
+
     async fetchChat() {
       const {data} = await LNbits.api.request(
         'GET',
-        `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public`
+        this.withToken(
+          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public?messages_limit=${this.messagesPageSize}`
+        )
       )
       this.chatData = data
+      this.messagesCursor = data.messages_cursor
+      this.lastSeq = data.event_seq || 0
+    },
+
+    async loadOlderMessages() {
+      if (!this.chatId || !this.messagesCursor || this.loadingOlder) return
+      this.loadingOlder = true
+      try {
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public/messages?before=${this.messagesCursor}&limit=${this.messagesPageSize}`
+        )
+        const el = this.$refs.chatScroll
+        const previousHeight = el ? el.scrollHeight : 0
+        this.chatData.messages.unshift(...data.data)
+        this.messagesCursor = data.next_cursor
+        await this.$nextTick()
+        if (el) {
+          el.scrollTop += el.scrollHeight - previousHeight
+        }
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      } finally {
+        this.loadingOlder = false
+      }
     },
 
     async toggleClaim() {
@@ -164,7 +218,7 @@ window.PageChatEmbed = {
           `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public/claim`,
           null
         )
-        this.chatData = data
+        this.chatData.claimed_by_name = data.claimed_by_name
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       }
@@ -175,7 +229,9 @@ window.PageChatEmbed = {
       try {
         const {data} = await LNbits.api.request(
           'GET',
-          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/lnurl`
+          this.withToken(
+            `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/lnurl`
+          )
         )
         this.lnurlPay = data.url || data.lnurl
       } catch (error) {
@@ -188,7 +244,9 @@ window.PageChatEmbed = {
       try {
         const {data} = await LNbits.api.request(
           'GET',
-          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public`
+          this.withToken(
+            `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public?messages_limit=1`
+          )
         )
         if (data && typeof data.balance !== 'undefined') {
           this.applyBalanceUpdate(data.balance)
@@ -233,7 +291,8 @@ window.PageChatEmbed = {
           sender_id: this.participantId,
           sender_name: this.participantName,
           sender_role: 'public',
-          message: messageText
+          message: messageText,
+          token: this.chatToken
         }
         const {data} = await LNbits.api.request(
           'POST',
@@ -250,7 +309,7 @@ window.PageChatEmbed = {
             hash: data.payment_hash,
             amount: data.amount || 0
           }
-          await this.waitForPayment(data.payment_hash)
+          this.waitForPayment(data.payment_hash)
         }
       } catch (error) {
         LNbits.utils.notifyApiError(error)
@@ -309,7 +368,8 @@ window.PageChatEmbed = {
         const payload = {
           amount: this.tipAmount,
           sender_id: this.participantId,
-          sender_name: this.participantName
+          sender_name: this.participantName,
+          token: this.chatToken
         }
         const {data} = await LNbits.api.request(
           'POST',
@@ -326,38 +386,27 @@ window.PageChatEmbed = {
             hash: data.payment_hash,
             amount: data.amount || 0
           }
-          await this.waitForPayment(data.payment_hash)
+          this.waitForPayment(data.payment_hash)
         }
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       }
     },
 
-    async waitForPayment(paymentHash) {
-      try {
-        const url = new URL(window.location)
-        url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
-        url.pathname = `/api/v1/ws/${paymentHash}`
-        const ws = new WebSocket(url)
-        ws.addEventListener('message', async ({data}) => {
-          const payment = JSON.parse(data)
-          if (payment.pending === false) {
-            this.pendingAmount = 0
-            this.closePaymentDialog()
-            Quasar.Notify.create({
-              type: 'positive',
-              message: 'Payment received'
-            })
-            ws.close()
-          }
-        })
-      } catch (err) {
-        console.warn(err)
-        Quasar.Notify.create({
-          type: 'negative',
-          message: 'Error waiting for payment.'
-        })
-      }
+    waitForPayment(paymentHash) {
+      // settled invoices arrive as `paid` events on the chat socket
+      this.pendingPaymentHash = paymentHash
+    },
+
+    onPaymentPaid(paymentHash) {
+      if (!paymentHash || paymentHash !== this.pendingPaymentHash) return
+      this.pendingPaymentHash = null
+      this.pendingAmount = 0
+      this.closePaymentDialog()
+      Quasar.Notify.create({
+        type: 'positive',
+        message: 'Payment received'
+      })
     },
 
     closePaymentDialog() {
@@ -367,74 +416,118 @@ window.PageChatEmbed = {
       this.paymentDialog.amount = 0
     },
 
-    connectChatWebsocket() {
+    connectChatWebsocket(resume = false) {
       if (!this.chatId) return
       if (this.chatSocket) {
-        this.chatSocket.close()
+        const previous = this.chatSocket
+        this.chatSocket = null
+        previous.close()
       }
       const url = new URL(window.location)
       url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
       url.pathname = `/api/v1/ws/chat:${this.chatId}`
       const ws = new WebSocket(url)
+      ws.addEventListener('open', () => {
+        if (resume) {
+          this.catchUpEvents()
+        } else {
+          this.refreshBalance()
+        }
+      })
       ws.addEventListener('message', ({data}) => {
         try {
-          const payload = JSON.parse(data)
-          if (payload.type === 'message' && payload.message) {
-            const message = payload.message
-            const exists = this.chatData.messages.some(m => m.id === message.id)
-            if (!exists) {
-              this.chatData.messages.push(message)
-              const participantExists = this.chatData.participants.some(
-                p => p.id === message.sender_id
-              )
-              if (!participantExists) {
-                this.chatData.participants.push({
-                  id: message.sender_id,
-                  name: message.sender_name,
-                  role: message.sender_role
-                })
-              }
-            }
-          }
-          if (payload.type === 'resolved') {
-            this.chatData.resolved = payload.resolved
-          }
-          if (payload.type === 'balance') {
-            this.applyBalanceUpdate(payload.balance)
-          }
-          if (payload.type === 'claim') {
-            this.chatData.claimed_by_name = payload.claimed_by_name
-          }
+          this.handleChatEvent(JSON.parse(data))
         } catch (err) {
           console.warn('Chat websocket message failed', err)
         }
       })
+      ws.addEventListener('close', () => {
+        if (this.chatSocket !== ws) return
+        setTimeout(() => {
+          if (this.chatSocket === ws) this.connectChatWebsocket(true)
+        }, 3000)
+      })
       this.chatSocket = ws
     },
 
-    connectBalanceWebsocket() {
-      if (!this.chatId) return
-      if (this.balanceSocket) {
-        this.balanceSocket.close()
+    handleChatEvent(payload) {
+      if (payload.seq) {
+        if (payload.seq <= this.lastSeq) return
+        if (payload.seq > this.lastSeq + 1) {
+          // missed events in between, fetch them in order instead
+          this.catchUpEvents()
+          return
+        }
+        this.lastSeq = payload.seq
       }
-      const url = new URL(window.location)
-      url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
-      url.pathname = `/api/v1/ws/chatbalance:${this.chatId}`
-      const ws = new WebSocket(url)
-      ws.addEventListener('open', () => {
-        this.refreshBalance()
-      })
-      ws.addEventListener('message', ({data}) => {
-        try {
-          const payload = JSON.parse(data)
-          if (payload.type === 'balance') {
-            this.applyBalanceUpdate(payload.balance)
+      this.applyChatEvent(payload)
+    },
+
+    applyChatEvent(payload) {
+      if (payload.type === 'message' && payload.message) {
+        const message = payload.message
+        const exists = this.chatData.messages.some(m => m.id === message.id)
+        if (!exists) {
+          this.chatData.messages.push(message)
+          const participantExists = this.chatData.participants.some(
+            p => p.id === message.sender_id
+          )
+          if (!participantExists) {
+            this.chatData.participants.push({
+              id: message.sender_id,
+              name: message.sender_name,
+              role: message.sender_role
+            })
           }
-        } catch (err) {
-          console.warn('Balance websocket message failed', err)
         }
-      })
-      this.balanceSocket = ws
+      }
+      if (payload.type === 'resolved') {
+        this.chatData.resolved = payload.resolved
+      }
+      if (payload.type === 'balance') {
+        this.applyBalanceUpdate(payload.balance)
+      }
+      if (payload.type === 'claim') {
+        this.chatData.claimed_by_name = payload.claimed_by_name
+      }
+      if (payload.type === 'paid') {
+        this.onPaymentPaid(payload.payment_hash)
+      }
+    },
+
+    async catchUpEvents() {
+      if (this.catchingUp) {
+        this.catchUpAgain = true
+        return
+      }
+      this.catchingUp = true
+      try {
+        let hasMore = true
+        while (hasMore) {
+          this.catchUpAgain = false
+          const {data} = await LNbits.api.request(
+            'GET',
+            this.withToken(
+              `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public/events?after=${this.lastSeq}`
+            )
+          )
+          if (data.reset) {
+            await this.fetchChat()
+            return
+          }
+          for (const event of data.data) {
+            if (event.seq > this.lastSeq) {
+              this.lastSeq = event.seq
+              this.applyChatEvent(event)
+            }
+          }
+          hasMore = data.has_more || this.catchUpAgain
+        }
+      } catch (error) {
+        console.warn(error)
+      } finally {
+        this.catchingUp = false
+      }
     }
   },
   created: async function () {
@@ -447,15 +540,13 @@ window.PageChatEmbed = {
     await this.ensureChat()
     await this.fetchLnurl()
     this.connectChatWebsocket()
-    this.connectBalanceWebsocket()
     this.notifyParent()
   },
   beforeUnmount() {
     if (this.chatSocket) {
-      this.chatSocket.close()
-    }
-    if (this.balanceSocket) {
-      this.balanceSocket.close()
+      const socket = this.chatSocket
+      this.chatSocket = null
+      socket.close()
     }
   }
 }
@@ -18,7 +18,10 @@ window.PageChat = {
           claim_split: 0,
           notify_telegram: null,
           notify_nostr: null,
-          notify_email: null
+          notify_email: null,
+          archive_resolved_days: null,
+          archive_idle_days: null,
+          rate_limit: null
         }
       },
       categoriesList: [],
@@ -73,7 +76,8 @@ window.PageChat = {
       },
       chatViewMode: 'list',
       chatFilters: {
-        categories: {label: 'All Categories', value: ''}
+        categories: {label: 'All Categories', value: ''},
+        messages: false
       },
       chatsTable: {
         search: '',
@@ -87,12 +91,19 @@ window.PageChat = {
         }
       },
       chatList: [],
+      messageHits: [],
       selectedChat: null,
       chatSocket: null,
       messageInput: '',
       sending: false,
       poller: null,
+      feedSocket: null,
+      feedReconnect: null,
+      refreshTimer: null,
       autoScroll: true,
+      messagesPageSize: 50,
+      messagesCursor: null,
+      loadingOlder: false,
       embedDialog: {
         show: false,
         iframe: ''
@@ -132,6 +143,11 @@ window.PageChat = {
         this.getChats()
       }
     },
+    'chatFilters.messages': {
+      handler() {
+        this.getChats()
+      }
+    },
     'selectedChat.messages': {
       async handler() {
         if (!this.autoScroll) return
@@ -186,7 +202,10 @@ window.PageChat = {
         claim_split: 0,
         notify_telegram: null,
         notify_nostr: null,
-        notify_email: null
+        notify_email: null,
+        archive_resolved_days: null,
+        archive_idle_days: null,
+        rate_limit: null
       }
       this.categoriesFormDialog.show = true
     },
@@ -201,6 +220,13 @@ window.PageChat = {
           data.lnurlp = false
           data.claim_split = 0
         }
+        for (const key of [
+          'archive_resolved_days',
+          'archive_idle_days',
+          'rate_limit'
+        ]) {
+          if (data[key] === '') data[key] = null
+        }
         const method = data.id ? 'PUT' : 'POST'
         const entry = data.id ? `/${data.id}` : ''
         await LNbits.api.request(
@@ -254,6 +280,9 @@ window.PageChat = {
     },
 
     async getChats(props) {
+      if (this.chatFilters.messages) {
+        return this.searchMessages()
+      }
       try {
         this.chatsTable.loading = true
         let params = LNbits.utils.prepareFilterQuery(this.chatsTable, props)
@@ -275,14 +304,38 @@ window.PageChat = {
       }
     },
 
+    async searchMessages() {
+      const query = this.chatsTable.search.trim()
+      if (!query) {
+        this.messageHits = []
+        return
+      }
+      try {
+        let params = `q=${encodeURIComponent(query)}`
+        const categoriesId = this.chatFilters.categories.value
+        if (categoriesId) {
+          params += `&categories_id=${categoriesId}`
+        }
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/chat/api/v1/chats/search?${params}`,
+          null
+        )
+        this.messageHits = data
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      }
+    },
+
     async selectChat(chat) {
       try {
         const {data} = await LNbits.api.request(
           'GET',
-          `/chat/api/v1/chats/${chat.id}`,
+          `/chat/api/v1/chats/${chat.id}?messages_limit=${this.messagesPageSize}`,
           null
         )
         this.selectedChat = data
+        this.messagesCursor = data.messages_cursor
         this.autoScroll = true
         await this.markChatSeen(chat.id)
         this.connectChatWebsocket(chat.id)
@@ -291,6 +344,35 @@ window.PageChat = {
       }
     },
 
+    async loadOlderMessages() {
+      if (!this.selectedChat || !this.messagesCursor || this.loadingOlder) {
+        return
+      }
+      const chatId = this.selectedChat.id
+      this.loadingOlder = true
+      try {
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/chat/api/v1/chats/${chatId}/messages?before=${this.messagesCursor}&limit=${this.messagesPageSize}`,
+          null
+        )
+        if (!this.selectedChat || this.selectedChat.id !== chatId) return
+        const el = this.getChatScrollEl()
+        const previousHeight = el ? el.scrollHeight : 0
+        this.autoScroll = false
+        this.selectedChat.messages.unshift(...data.data)
+        this.messagesCursor = data.next_cursor
+        await this.$nextTick()
+        if (el) {
+          el.scrollTop += el.scrollHeight - previousHeight
+        }
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      } finally {
+        this.loadingOlder = false
+      }
+    },
+
     async onSendMessage(messageText) {
       if (!messageText || !this.selectedChat || this.sending) return
       this.sending = true
@@ -363,7 +445,7 @@ window.PageChat = {
           null,
           {resolved: !this.selectedChat.resolved}
         )
-        this.selectedChat = data
+        this.selectedChat.resolved = data.resolved
         this.updateChatListEntry(data)
       } catch (error) {
         LNbits.utils.notifyApiError(error)
@@ -404,8 +486,8 @@ window.PageChat = {
               m => m.id === message.id
             )
             if (!exists) {
+              // the chat list itself is kept current by the change feed
               this.selectedChat.messages.push(message)
-              this.updateChatListEntry(this.selectedChat)
               this.markChatSeen(chatId)
             }
           }
@@ -422,9 +504,15 @@ window.PageChat = {
 
     updateChatListEntry(chat) {
       const index = this.chatList.findIndex(item => item.id === chat.id)
-      if (index >= 0) {
-        this.chatList.splice(index, 1, chat)
+      if (index < 0) return
+      // only copy the summary fields, full chats also carry their messages
+      const entry = {...this.chatList[index]}
+      for (const key of Object.keys(entry)) {
+        if (key in chat) {
+          entry[key] = chat[key]
+        }
       }
+      this.chatList.splice(index, 1, entry)
     },
 
     chatTitle(chat) {
@@ -433,11 +521,11 @@ window.PageChat = {
     },
 
     chatSubtitle(chat) {
-      const participants = chat.participants?.length || 0
+      const count = chat.message_count || 0
       const last = chat.last_message_at
         ? this.dateFromNow(chat.last_message_at)
         : 'No messages yet'
-      return `${participants} participants · ${last}`
+      return `${count} messages · ${last}`
     },
 
     categoryName(categoryId) {
@@ -492,25 +580,117 @@ window.PageChat = {
       }
     },
 
+    async connectFeed() {
+      try {
+        const {data} = await LNbits.api.request(
+          'GET',
+          '/chat/api/v1/chats/feed',
+          null
+        )
+        const url = new URL(window.location)
+        url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
+        url.pathname = `/api/v1/ws/${data.channel}`
+        const ws = new WebSocket(url)
+        ws.addEventListener('message', ({data}) => {
+          try {
+            this.applyChatDelta(JSON.parse(data))
+          } catch (err) {
+            console.warn('Chat feed message failed', err)
+          }
+        })
+        ws.addEventListener('close', () => {
+          if (this.feedSocket !== ws) return
+          this.feedSocket = null
+          this.feedReconnect = setTimeout(() => {
+            this.getChats()
+            this.connectFeed()
+          }, 5000)
+        })
+        this.feedSocket = ws
+      } catch (error) {
+        console.warn('Chat feed unavailable, polling only', error)
+      }
+    },
+
+    applyChatDelta(payload) {
+      const categoriesId = this.chatFilters.categories.value
+      if (payload.type === 'created') {
+        const chat = payload.chat
+        if (categoriesId && chat.categories_id !== categoriesId) return
+        if (this.chatsTable.search || this.chatsTable.pagination.page !== 1) {
+          this.scheduleChatsRefresh()
+          return
+        }
+        this.chatList.unshift(chat)
+        if (this.chatList.length > this.chatsTable.pagination.rowsPerPage) {
+          this.chatList.pop()
+        }
+        this.chatsTable.pagination.rowsNumber += 1
+        return
+      }
+      if (payload.type !== 'update') return
+      const changes = payload.changes || {}
+      const index = this.chatList.findIndex(item => item.id === payload.chat_id)
+      if (index < 0) {
+        // activity on a chat that is not on this page may move it here
+        if (changes.last_message_at) this.scheduleChatsRefresh()
+      } else {
+        const entry = {...this.chatList[index], ...changes}
+        const {sortBy, descending, page} = this.chatsTable.pagination
+        if (page === 1 && descending && sortBy in changes && index > 0) {
+          this.chatList.splice(index, 1)
+          this.chatList.unshift(entry)
+        } else {
+          this.chatList.splice(index, 1, entry)
+        }
+      }
+      if (this.selectedChat && this.selectedChat.id === payload.chat_id) {
+        for (const key of ['resolved', 'balance', 'claimed_by_name']) {
+          if (key in changes) this.selectedChat[key] = changes[key]
+        }
+      }
+    },
+
+    scheduleChatsRefresh() {
+      if (this.refreshTimer) return
+      this.refreshTimer = setTimeout(() => {
+        this.refreshTimer = null
+        this.getChats()
+      }, 1000)
+    },
+
     startPolling() {
       if (this.poller) {
         clearInterval(this.poller)
       }
+      // the change feed keeps the list current, this is only a safety net
       this.poller = setInterval(() => {
         this.getChats()
-      }, 8000)
+      }, 60000)
     }
   },
   async created() {
     await this.fetchCurrencies()
     await this.getCategories()
     await this.getChats()
+    await this.connectFeed()
     this.startPolling()
   },
   beforeUnmount() {
     if (this.chatSocket) {
       this.chatSocket.close()
     }
+    if (this.feedSocket) {
+      const ws = this.feedSocket
+      this.feedSocket = null
+      ws.close()
+    }
+    if (this.feedReconnect) {
+      clearTimeout(this.feedReconnect)
+    }
+    if (this.refreshTimer) {
+      clearTimeout(this.refreshTimer)
+    }
     if (this.poller) {
       clearInterval(this.poller)
     }
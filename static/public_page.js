@@ -4,6 +4,7 @@ window.PageChatPublic = {
     return {
       categoriesId: '',
       chatId: '',
+      chatToken: null,
       participantId: '',
       participantName: '',
       messageInput: '',
@@ -28,10 +29,18 @@ window.PageChatPublic = {
       showTipDialog: false,
       tipAmount: null,
       chatSocket: null,
-      balanceSocket: null,
+      pendingPaymentHash: null,
       lnurlPay: '',
       authUser: null,
-      autoScroll: true
+      autoScroll: true,
+      messagesPageSize: 50,
+      messagesCursor: null,
+      loadingOlder: false,
+      lastSeq: 0,
+      catchingUp: false,
+      catchUpAgain: false,
+      priceQuote: null,
+      quoteTimer: null
     }
   },
   computed: {
@@ -41,6 +50,15 @@ window.PageChatPublic = {
       const value = Number(raw)
       return Number.isFinite(value) ? value : 0
     },
+    messageCost() {
+      // priced locally from the cached quote, no request per keystroke
+      const quote = this.priceQuote
+      if (!quote || !this.publicPageData?.paid || this.authUser) return 0
+      const raw = this.messageInput.length * quote.price_chars
+      if (raw <= 0) return 0
+      if (quote.denomination === 'sat') return Math.ceil(raw)
+      return Math.floor(raw * quote.sats_per_unit)
+    },
     isClaimedByMe() {
       if (!this.authUser?.username) return false
       return this.chatData.claimed_by_name === this.authUser.username
@@ -115,6 +133,26 @@ window.PageChatPublic = {
       }
     },
 
+    async fetchPriceQuote() {
+      clearTimeout(this.quoteTimer)
+      if (!this.publicPageData?.paid || !this.publicPageData?.price_chars) {
+        return
+      }
+      try {
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/chat/api/v1/categories/${this.categoriesId}/public/quote`
+        )
+        this.priceQuote = data
+        this.quoteTimer = setTimeout(
+          () => this.fetchPriceQuote(),
+          (data.ttl || 60) * 1000
+        )
+      } catch (error) {
+        console.warn(error)
+      }
+    },
+
     async ensureParticipant() {
       const storageKey = `lnbits.chat.participant.${this.categoriesId}`
       const existing = this.$q.localStorage.getItem(storageKey)
@@ -152,6 +190,7 @@ window.PageChatPublic = {
       const chatId = this.$route.params.chat
       if (chatId) {
         this.chatId = chatId
+        this.chatToken = this.$q.localStorage.getItem(this.chatTokenKey())
         await this.fetchChat()
         return
       }
@@ -167,6 +206,14 @@ window.PageChatPublic = {
       )
       this.chatId = data.id
       this.chatData = data
+      // the chat is only stored with its first message, until then the
+      // signed token stands in for it
+      this.chatToken = data.token || null
+      if (this.chatToken) {
+        this.$q.localStorage.set(this.chatTokenKey(), this.chatToken)
+      }
+      this.messagesCursor = null
+      this.lastSeq = data.event_seq || 0
       this.updateChatUrl()
 
       this.autoScroll = true
@@ -179,17 +226,55 @@ window.PageChatPublic = {
       window.history.replaceState({}, '', target)
     },
 
+    chatTokenKey() {
+      return `lnbits.chat.token.${this.chatId}`
+    },
+
+    withToken(url) {
+      if (!this.chatToken) return url
+      const separator = url.includes('?') ? '&' : '?'
+      return `${url}${separator}token=${encodeURIComponent(this.chatToken)}`
+    },
+
     async fetchChat() {
       const {data} = await LNbits.api.request(
         'GET',
-        `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public`
+        this.withToken(
+          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public?messages_limit=${this.messagesPageSize}`
+        )
       )
       this.chatData = data
+      this.messagesCursor = data.messages_cursor
+      this.lastSeq = data.event_seq || 0
 
       this.autoScroll = true
       await this.scrollToBottomSmooth()
     },
 
+    async loadOlderMessages() {
+      if (!this.chatId || !this.messagesCursor || this.loadingOlder) return
+      this.loadingOlder = true
+      try {
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public/messages?before=${this.messagesCursor}&limit=${this.messagesPageSize}`
+        )
+        const el = this.getChatScrollEl()
+        const previousHeight = el ? el.scrollHeight : 0
+        this.autoScroll = false
+        this.chatData.messages.unshift(...data.data)
+        this.messagesCursor = data.next_cursor
+        await this.$nextTick()
+        if (el) {
+          el.scrollTop += el.scrollHeight - previousHeight
+        }
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      } finally {
+        this.loadingOlder = false
+      }
+    },
+
     async toggleClaim() {
       if (!this.authUser) return
       try {
@@ -198,7 +283,7 @@ window.PageChatPublic = {
           `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public/claim`,
           null
         )
-        this.chatData = data
+        this.chatData.claimed_by_name = data.claimed_by_name
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       }
@@ -224,7 +309,9 @@ window.PageChatPublic = {
       try {
         const {data} = await LNbits.api.request(
           'GET',
-          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/lnurl`
+          this.withToken(
+            `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/lnurl`
+          )
         )
         this.lnurlPay = data.url || data.lnurl
       } catch (error) {
@@ -237,7 +324,9 @@ window.PageChatPublic = {
       try {
         const {data} = await LNbits.api.request(
           'GET',
-          `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public`
+          this.withToken(
+            `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public?messages_limit=1`
+          )
         )
         if (data && typeof data.balance !== 'undefined') {
           this.applyBalanceUpdate(data.balance)
@@ -259,7 +348,8 @@ window.PageChatPublic = {
           sender_id: this.participantId,
           sender_name: this.participantName,
           sender_role: 'public',
-          message: messageText
+          message: messageText,
+          token: this.chatToken
         }
         const {data} = await LNbits.api.request(
           'POST',
@@ -276,7 +366,7 @@ window.PageChatPublic = {
             hash: data.payment_hash,
             amount: data.amount || 0
           }
-          await this.waitForPayment(data.payment_hash)
+          this.waitForPayment(data.payment_hash)
         }
       } catch (error) {
         LNbits.utils.notifyApiError(error)
@@ -347,7 +437,8 @@ window.PageChatPublic = {
         const payload = {
           amount: this.tipAmount,
           sender_id: this.participantId,
-          sender_name: this.participantName
+          sender_name: this.participantName,
+          token: this.chatToken
         }
         const {data} = await LNbits.api.request(
           'POST',
@@ -364,40 +455,29 @@ window.PageChatPublic = {
             hash: data.payment_hash,
             amount: data.amount || 0
           }
-          await this.waitForPayment(data.payment_hash)
+          this.waitForPayment(data.payment_hash)
         }
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       }
     },
 
-    async waitForPayment(paymentHash) {
-      try {
-        const url = new URL(window.location)
-        url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
-        url.pathname = `/api/v1/ws/${paymentHash}`
-        const ws = new WebSocket(url)
-        ws.addEventListener('message', async ({data}) => {
-          const payment = JSON.parse(data)
-          if (payment.pending === false) {
-            this.pendingAmount = 0
-            this.closePaymentDialog()
-            Quasar.Notify.create({
-              type: 'positive',
-              message: 'Payment received'
-            })
-            ws.close()
-            if (this.autoScroll) {
-              await this.scrollToBottomSmooth()
-            }
-          }
-        })
-      } catch (err) {
-        console.warn(err)
-        Quasar.Notify.create({
-          type: 'negative',
-          message: 'Error waiting for payment.'
-        })
+    waitForPayment(paymentHash) {
+      // settled invoices arrive as `paid` events on the chat socket
+      this.pendingPaymentHash = paymentHash
+    },
+
+    async onPaymentPaid(paymentHash) {
+      if (!paymentHash || paymentHash !== this.pendingPaymentHash) return
+      this.pendingPaymentHash = null
+      this.pendingAmount = 0
+      this.closePaymentDialog()
+      Quasar.Notify.create({
+        type: 'positive',
+        message: 'Payment received'
+      })
+      if (this.autoScroll) {
+        await this.scrollToBottomSmooth()
       }
     },
 
@@ -408,85 +488,129 @@ window.PageChatPublic = {
       this.paymentDialog.amount = 0
     },
 
-    connectChatWebsocket() {
+    connectChatWebsocket(resume = false) {
       if (!this.chatId) return
       if (this.chatSocket) {
-        this.chatSocket.close()
+        const previous = this.chatSocket
+        this.chatSocket = null
+        previous.close()
       }
       const url = new URL(window.location)
       url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
       url.pathname = `/api/v1/ws/chat:${this.chatId}`
       const ws = new WebSocket(url)
+      ws.addEventListener('open', () => {
+        if (resume) {
+          this.catchUpEvents()
+        } else {
+          this.refreshBalance()
+        }
+      })
       ws.addEventListener('message', ({data}) => {
         try {
-          const payload = JSON.parse(data)
-          if (payload.type === 'message' && payload.message) {
-            const message = payload.message
-            const exists = this.chatData.messages.some(m => m.id === message.id)
-            if (!exists) {
-              this.chatData.messages.push(message)
-              const participantExists = this.chatData.participants.some(
-                p => p.id === message.sender_id
-              )
-              if (!participantExists) {
-                this.chatData.participants.push({
-                  id: message.sender_id,
-                  name: message.sender_name,
-                  role: message.sender_role
-                })
-              }
-            }
-          }
-          if (payload.type === 'resolved') {
-            this.chatData.resolved = payload.resolved
-          }
-          if (payload.type === 'balance') {
-            this.applyBalanceUpdate(payload.balance)
-          }
-          if (payload.type === 'claim') {
-            this.chatData.claimed_by_name = payload.claimed_by_name
-          }
+          this.handleChatEvent(JSON.parse(data))
         } catch (err) {
           console.warn('Chat websocket message failed', err)
         }
       })
+      ws.addEventListener('close', () => {
+        if (this.chatSocket !== ws) return
+        setTimeout(() => {
+          if (this.chatSocket === ws) this.connectChatWebsocket(true)
+        }, 3000)
+      })
       this.chatSocket = ws
     },
 
-    connectBalanceWebsocket() {
-      if (!this.chatId) return
-      if (this.balanceSocket) {
-        this.balanceSocket.close()
+    handleChatEvent(payload) {
+      if (payload.seq) {
+        if (payload.seq <= this.lastSeq) return
+        if (payload.seq > this.lastSeq + 1) {
+          // missed events in between, fetch them in order instead
+          this.catchUpEvents()
+          return
+        }
+        this.lastSeq = payload.seq
       }
-      const url = new URL(window.location)
-      url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
-      url.pathname = `/api/v1/ws/chatbalance:${this.chatId}`
-      const ws = new WebSocket(url)
-      ws.addEventListener('open', () => {
-        this.refreshBalance()
-      })
-      ws.addEventListener('message', ({data}) => {
-        try {
-          const payload = JSON.parse(data)
-          if (payload.type === 'balance') {
-            this.applyBalanceUpdate(payload.balance)
+      this.applyChatEvent(payload)
+    },
+
+    applyChatEvent(payload) {
+      if (payload.type === 'message' && payload.message) {
+        const message = payload.message
+        const exists = this.chatData.messages.some(m => m.id === message.id)
+        if (!exists) {
+          this.chatData.messages.push(message)
+          const participantExists = this.chatData.participants.some(
+            p => p.id === message.sender_id
+          )
+          if (!participantExists) {
+            this.chatData.participants.push({
+              id: message.sender_id,
+              name: message.sender_name,
+              role: message.sender_role
+            })
           }
-        } catch (err) {
-          console.warn('Balance websocket message failed', err)
         }
-      })
-      this.balanceSocket = ws
+      }
+      if (payload.type === 'resolved') {
+        this.chatData.resolved = payload.resolved
+      }
+      if (payload.type === 'balance') {
+        this.applyBalanceUpdate(payload.balance)
+      }
+      if (payload.type === 'claim') {
+        this.chatData.claimed_by_name = payload.claimed_by_name
+      }
+      if (payload.type === 'paid') {
+        this.onPaymentPaid(payload.payment_hash)
+      }
+    },
+
+    async catchUpEvents() {
+      if (this.catchingUp) {
+        this.catchUpAgain = true
+        return
+      }
+      this.catchingUp = true
+      try {
+        let hasMore = true
+        while (hasMore) {
+          this.catchUpAgain = false
+          const {data} = await LNbits.api.request(
+            'GET',
+            this.withToken(
+              `/chat/api/v1/chats/${this.categoriesId}/${this.chatId}/public/events?after=${this.lastSeq}`
+            )
+          )
+          if (data.reset) {
+            await this.fetchChat()
+            return
+          }
+          for (const event of data.data) {
+            if (event.seq > this.lastSeq) {
+              this.lastSeq = event.seq
+              this.applyChatEvent(event)
+            }
+          }
+          hasMore = data.has_more || this.catchUpAgain
+        }
+      } catch (error) {
+        console.warn(error)
+      } finally {
+        this.catchingUp = false
+      }
     }
   },
 
   created: async function () {
     this.categoriesId = this.$route.params.id
     await this.fetchPublicData()
+    this.fetchPriceQuote()
     await this.ensureParticipant()
     await this.ensureChat()
     await this.fetchLnurl()
     this.connectChatWebsocket()
-    this.connectBalanceWebsocket()
   },
 
   mounted() {
@@ -496,11 +620,11 @@ window.PageChatPublic = {
   },
 
   beforeUnmount() {
+    clearTimeout(this.quoteTimer)
     if (this.chatSocket) {
-      this.chatSocket.close()
-    }
-    if (this.balanceSocket) {
-      this.balanceSocket.close()
+      const socket = this.chatSocket
+      this.chatSocket = null
+      socket.close()
     }
   }
 }
@@ -1,21 +1,149 @@
 import asyncio
+import zlib
+from collections import deque
+from collections.abc import Awaitable, Callable
 from datetime import datetime, timedelta, timezone
+from time import monotonic
 
 from lnbits.core.models import Payment
 from lnbits.settings import settings
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
-from .crud import delete_empty_chats_before
-from .services import payment_received_for_client_data
+from .crud import (
+    delete_chat_events_before,
+    delete_empty_chats_before,
+    delete_unpaid_chat_payments_before,
+    get_categories_with_retention,
+)
+from .dispatch import dispatcher
+from .rates import fiat_rates
+from .services import ARCHIVE_BATCH_SIZE, archive_category_chats, payment_received_for_client_data
+
+
+def _percentile(values: deque[float], percentile: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * percentile))
+    return round(ordered[index] * 1000, 2)
+
+
+class InvoiceWorkers:
+    """
+    Paid invoices fanned out over a fixed number of lanes. A chat always maps to
+    the same lane, so its payments are handled in arrival order while payments
+    for other chats are processed in parallel.
+    """
+
+    def __init__(
+        self,
+        lanes: int = 4,
+        maxsize: int = 1000,
+        handler: Callable[[Payment], Awaitable[None]] | None = None,
+    ) -> None:
+        self.queues: list[asyncio.Queue] = [asyncio.Queue(maxsize) for _ in range(lanes)]
+        self.handler = handler
+        self.processed = 0
+        self.waits: deque[float] = deque(maxlen=1000)
+        self.durations: deque[float] = deque(maxlen=1000)
+
+    def lane(self, payment: Payment) -> int:
+        key = payment.extra.get("chat_id") or payment.payment_hash
+        return zlib.crc32(key.encode()) % len(self.queues)
+
+    async def submit(self, payment: Payment) -> None:
+        await self.queues[self.lane(payment)].put((monotonic(), payment))
+
+    async def _run_lane(self, queue: asyncio.Queue) -> None:
+        handler = self.handler or on_invoice_paid
+        while True:
+            queued_at, payment = await queue.get()
+            started_at = monotonic()
+            try:
+                await handler(payment)
+            except Exception as exc:
+                logger.error(f"Error in chat invoice worker: {exc}")
+            finally:
+                self.waits.append(started_at - queued_at)
+                self.durations.append(monotonic() - started_at)
+                self.processed += 1
+                queue.task_done()
+
+    def start(self) -> list[asyncio.Task]:
+        return [asyncio.create_task(self._run_lane(queue)) for queue in self.queues]
+
+    async def join(self) -> None:
+        for queue in self.queues:
+            await queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "lanes": len(self.queues),
+            "queue_depth": sum(queue.qsize() for queue in self.queues),
+            "lane_depths": [queue.qsize() for queue in self.queues],
+            "processed": self.processed,
+            "wait_ms_p50": _percentile(self.waits, 0.5),
+            "wait_ms_p99": _percentile(self.waits, 0.99),
+            "processing_ms_p50": _percentile(self.durations, 0.5),
+            "processing_ms_p99": _percentile(self.durations, 0.99),
+        }
+
+
+invoice_workers = InvoiceWorkers()
+
+
+class SweepStats:
+    """
+    Rows touched and time taken by the last run of a housekeeping task.
+    """
+
+    def __init__(self) -> None:
+        self.runs = 0
+        self.total_rows = 0
+        self.last_rows = 0
+        self.last_duration_ms = 0.0
+        self.last_run_at: datetime | None = None
+
+    def record(self, rows: int, duration: float) -> None:
+        self.runs += 1
+        self.total_rows += rows
+        self.last_rows = rows
+        self.last_duration_ms = round(duration * 1000, 2)
+        self.last_run_at = datetime.now(timezone.utc)
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "total_rows": self.total_rows,
+            "last_rows": self.last_rows,
+            "last_duration_ms": self.last_duration_ms,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+        }
+
+
+cleanup_stats = SweepStats()
+archive_stats = SweepStats()
+payments_stats = SweepStats()
+
+# unpaid invoices are kept this long past their expiry, so a payment that
+# settled right before it expired is still matched to its chat payment
+PAYMENT_EXPIRY_GRACE = timedelta(hours=1)
 
 
 async def wait_for_paid_invoices():
     invoice_queue = asyncio.Queue()
     register_invoice_listener(invoice_queue, "ext_chat")
-    while True:
-        payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+    workers = invoice_workers.start()
+    try:
+        while True:
+            payment = await invoice_queue.get()
+            if payment.extra.get("tag") != "chat":
+                continue
+            await invoice_workers.submit(payment)
+    finally:
+        for worker in workers:
+            worker.cancel()
 
 
 async def on_invoice_paid(payment: Payment) -> None:
@@ -30,11 +158,99 @@ async def on_invoice_paid(payment: Payment) -> None:
         logger.error(f"Error processing payment for chat: {e}")
 
 
+async def run_outbox() -> None:
+    await dispatcher.run()
+
+
+async def refresh_fiat_rates() -> None:
+    await fiat_rates.run()
+
+
+async def _delete_in_batches(
+    delete: Callable[[datetime, int], Awaitable[int]],
+    cutoff: datetime,
+    batch_size: int,
+    max_batches: int,
+) -> int:
+    """
+    Delete in short batches so each DELETE only holds the write lock briefly
+    and sends can interleave.
+    """
+    removed = 0
+    for _ in range(max_batches):
+        deleted = await delete(cutoff, batch_size)
+        removed += deleted
+        if deleted < batch_size:
+            break
+        await asyncio.sleep(0)
+    return removed
+
+
+async def sweep_empty_chats(batch_size: int = 500, max_batches: int = 20) -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=20)
+    return await _delete_in_batches(delete_empty_chats_before, cutoff, batch_size, max_batches)
+
+
+async def sweep_expired_payments(batch_size: int = 500, max_batches: int = 20) -> int:
+    expiry = timedelta(seconds=settings.lightning_invoice_expiry)
+    cutoff = datetime.now(timezone.utc) - expiry - PAYMENT_EXPIRY_GRACE
+    return await _delete_in_batches(delete_unpaid_chat_payments_before, cutoff, batch_size, max_batches)
+
+
 async def cleanup_empty_chats() -> None:
     while settings.lnbits_running:
-        cutoff = int((datetime.now(timezone.utc) - timedelta(minutes=20)).timestamp())
+        started_at = monotonic()
+        removed = 0
         try:
-            await delete_empty_chats_before(cutoff)
+            removed = await sweep_empty_chats()
         except Exception as e:
             logger.warning(f"Error cleaning empty chats: {e}")
+        cleanup_stats.record(removed, monotonic() - started_at)
+        if removed:
+            logger.info(f"Removed {removed} empty chats in {cleanup_stats.last_duration_ms}ms")
+        try:
+            # clients offline for longer than this reload the chat instead of resuming
+            await delete_chat_events_before(datetime.now(timezone.utc) - timedelta(days=1))
+        except Exception as e:
+            logger.warning(f"Error pruning chat events: {e}")
         await asyncio.sleep(60)
+
+
+async def archive_chats(max_batches: int = 10) -> None:
+    while settings.lnbits_running:
+        started_at = monotonic()
+        archived = 0
+        try:
+            categories = await get_categories_with_retention()
+        except Exception as e:
+            logger.warning(f"Error archiving chats: {e}")
+            categories = []
+        for category in categories:
+            try:
+                # bounded per run, a large backlog drains over several runs
+                for _ in range(max_batches):
+                    moved = await archive_category_chats(category, ARCHIVE_BATCH_SIZE)
+                    archived += moved
+                    if moved < ARCHIVE_BATCH_SIZE:
+                        break
+                    await asyncio.sleep(0)
+            except Exception as e:
+                logger.warning(f"Error archiving chats of category {category.id}: {e}")
+        archive_stats.record(archived, monotonic() - started_at)
+        if archived:
+            logger.info(f"Archived {archived} chats in {archive_stats.last_duration_ms}ms")
+        await asyncio.sleep(3600)
+
+
+async def expire_chat_payments() -> None:
+    while settings.lnbits_running:
+        started_at = monotonic()
+        removed = 0
+        try:
+            removed = await sweep_expired_payments()
+        except Exception as e:
+            logger.warning(f"Error expiring chat payments: {e}")
+        payments_stats.record(removed, monotonic() - started_at)
+        if removed:
+            logger.info(f"Removed {removed} expired chat payments in {payments_stats.last_duration_ms}ms")
+        await asyncio.sleep(300)
@@ -0,0 +1,189 @@
+"""
+Latency and throughput of the chat hot paths against the SQLite test db.
+
+The default run is a small smoke pass that keeps the harness working in CI.
+For real numbers run the full matrix, which goes up to 10k messages of history:
+
+    CHAT_BENCHMARK=1 pytest tests/test_benchmark.py -s
+
+CHAT_BENCHMARK_OPS sets the operations per case and CHAT_BENCHMARK_OUTPUT
+a path to write the results as JSON, for comparing runs.
+"""
+
+import asyncio
+import json
+import os
+from collections import deque
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from uuid import uuid4
+
+import pytest
+
+from chat.crud import (  # type: ignore[import]
+    create_categories,
+    create_chat_message,
+    get_chat,
+    get_chat_messages,
+    get_chats_paginated,
+    transaction,
+    update_chat_activity,
+)
+from chat.models import ChatMessage, CreateCategories, CreateChat, CreateChatMessage  # type: ignore[import]
+from chat.services import (  # type: ignore[import]
+    MESSAGES_PAGE_SIZE,
+    create_public_chat,
+    get_public_chat,
+    materialize_chat,
+    send_admin_message,
+    send_public_message,
+)
+from chat.tasks import _percentile  # type: ignore[import]
+
+FULL = bool(os.environ.get("CHAT_BENCHMARK"))
+HISTORY_SIZES = [10, 100, 1000, 10000] if FULL else [10, 100]
+PARTICIPANT_COUNTS = [1, 5, 9] if FULL else [1, 5]
+CONCURRENCY = [1, 8, 32] if FULL else [1, 4]
+OPERATIONS = int(os.environ.get("CHAT_BENCHMARK_OPS", 200 if FULL else 10))
+
+Operation = Callable[[int], Awaitable[object]]
+
+
+async def _seed_chat(categories_id: str, history: int, participants: int) -> tuple[str, list[str]]:
+    chat = await create_public_chat(
+        categories_id, CreateChat(participant_id="guest-0", participant_name="guest 0"), base_url="http://test"
+    )
+    await materialize_chat(chat.id, chat.token, None, categories_id=categories_id)
+    sender_ids = [f"guest-{index}" for index in range(participants)]
+    for index, sender_id in enumerate(sender_ids[1:], start=1):
+        await send_public_message(
+            categories_id,
+            chat.id,
+            CreateChatMessage(sender_id=sender_id, sender_name=f"guest {index}", sender_role="public", message="hi"),
+        )
+
+    loaded = await get_chat(chat.id, include_messages=False)
+    assert loaded
+    started_at = datetime.now(timezone.utc) - timedelta(seconds=history)
+    async with transaction() as conn:
+        for index in range(history):
+            await create_chat_message(
+                ChatMessage(
+                    id=uuid4().hex,
+                    chat_id=chat.id,
+                    sender_id=sender_ids[index % participants],
+                    sender_name=f"guest {index % participants}",
+                    sender_role="public",
+                    message=f"history message {index} " + "x" * 80,
+                    created_at=started_at + timedelta(seconds=index),
+                ),
+                conn=conn,
+            )
+        loaded.message_count += history
+        loaded.last_message_at = datetime.now(timezone.utc)
+        await update_chat_activity(loaded, conn=conn)
+    return chat.id, sender_ids
+
+
+def _operations(categories_id: str, user_id: str, chat_id: str, sender_ids: list[str]) -> dict[str, Operation]:
+    participants = len(sender_ids)
+    return {
+        "send_public_message": lambda index: send_public_message(
+            categories_id,
+            chat_id,
+            CreateChatMessage(
+                sender_id=sender_ids[index % participants],
+                sender_name=f"guest {index % participants}",
+                sender_role="public",
+                message=f"benchmark message {index}",
+            ),
+        ),
+        "send_admin_message": lambda index: send_admin_message(
+            chat_id,
+            CreateChatMessage(sender_id=user_id, sender_name="support", sender_role="admin", message=f"reply {index}"),
+        ),
+        "get_public_chat": lambda _: get_public_chat(categories_id, chat_id, MESSAGES_PAGE_SIZE),
+        "get_public_chat_full": lambda _: get_public_chat(categories_id, chat_id),
+        "get_chats_paginated": lambda _: get_chats_paginated(user_id, categories_id),
+    }
+
+
+async def _measure(operation: Operation, operations: int, concurrency: int) -> dict:
+    latencies: deque[float] = deque()
+    next_index = 0
+
+    async def worker() -> None:
+        nonlocal next_index
+        while next_index < operations:
+            index = next_index
+            next_index += 1
+            started_at = perf_counter()
+            await operation(index)
+            latencies.append(perf_counter() - started_at)
+
+    started_at = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - started_at
+    return {
+        "p50_ms": _percentile(latencies, 0.5),
+        "p99_ms": _percentile(latencies, 0.99),
+        "ops_per_s": round(operations / elapsed, 1),
+    }
+
+
+def _report(results: list[dict]) -> None:
+    header = f"{'operation':<22}{'history':>8}{'people':>8}{'conc':>6}{'p50 ms':>10}{'p99 ms':>10}{'ops/s':>10}"
+    print("\n" + header)
+    for row in results:
+        print(
+            f"{row['operation']:<22}{row['history']:>8}{row['participants']:>8}{row['concurrency']:>6}"
+            f"{row['p50_ms']:>10}{row['p99_ms']:>10}{row['ops_per_s']:>10}"
+        )
+    output = os.environ.get("CHAT_BENCHMARK_OUTPUT")
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+@pytest.mark.asyncio
+async def test_benchmark_chat_hot_paths():
+    user_id = uuid4().hex
+    category = await create_categories(user_id, CreateCategories(name="benchmark", chars=500))
+    results: list[dict] = []
+
+    for history in HISTORY_SIZES:
+        for participants in PARTICIPANT_COUNTS:
+            chat_id, sender_ids = await _seed_chat(category.id, history, participants)
+            operations = _operations(category.id, user_id, chat_id, sender_ids)
+            sent = 0
+            for concurrency in CONCURRENCY:
+                for name, operation in operations.items():
+                    stats = await _measure(operation, OPERATIONS, concurrency)
+                    results.append(
+                        {
+                            "operation": name,
+                            "history": history,
+                            "participants": participants,
+                            "concurrency": concurrency,
+                            **stats,
+                        }
+                    )
+                sent += 2 * OPERATIONS
+
+            # concurrent sends must not lose messages
+            messages = await get_chat_messages(chat_id)
+            assert len(messages) == history + participants - 1 + sent
+
+    _report(results)
+
+    if FULL:
+        # the send path must not grow with the history length
+        def send_p50(history: int) -> float:
+            return max(
+                row["p50_ms"]
+                for row in results
+                if row["operation"] == "send_public_message" and row["history"] == history
+            )
+
+        assert send_p50(HISTORY_SIZES[-1]) < 5 * send_p50(HISTORY_SIZES[0])
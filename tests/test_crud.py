@@ -1,18 +1,35 @@
+from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 
 import pytest
+from lnbits.db import SQLITE
 
+from chat.cache import categories_cache  # type: ignore[import]
 from chat.crud import (  # type: ignore[import]
     create_categories,
+    create_chat,
+    create_chat_message,
+    create_chat_payment,
+    db,
     delete_categories,
+    delete_chat,
+    delete_empty_chats_before,
+    delete_unpaid_chat_payments_before,
     get_categories,
     get_categories_by_id,
     get_categories_ids_by_user,
     get_categories_paginated,
+    get_chat,
+    get_chat_payment,
+    search_chat_messages,
     update_categories,
+    update_chat_activity,
 )
 from chat.models import (  # type: ignore[import]
     Categories,
+    ChatMessage,
+    ChatPayment,
+    ChatSession,
     CreateCategories,
 )
 
@@ -115,3 +132,225 @@ async def test_update_categories():
     assert categories_one.chars == categories_updated.chars
     assert categories_one.price_chars == categories_updated.price_chars
     assert categories_one.denomination == categories_updated.denomination
+
+
+@pytest.mark.asyncio
+async def test_chat_messages_are_stored_in_their_own_table():
+    categories_id = uuid4().hex
+    created_at = datetime.now(timezone.utc) - timedelta(hours=1)
+    chat = await create_chat(
+        categories_id,
+        ChatSession(id=uuid4().hex, categories_id=categories_id, created_at=created_at),
+    )
+
+    for index in range(3):
+        await create_chat_message(
+            ChatMessage(
+                id=f"{index}-{uuid4().hex}",
+                chat_id=chat.id,
+                sender_id="guest",
+                sender_name="guest",
+                sender_role="public",
+                message=f"message {index}",
+                created_at=created_at + timedelta(seconds=index),
+            )
+        )
+
+    loaded = await get_chat(chat.id)
+    assert loaded
+    assert [m["message"] for m in loaded.messages] == ["message 0", "message 1", "message 2"]
+
+    loaded = await get_chat(chat.id, include_messages=False)
+    assert loaded
+    assert loaded.messages == []
+
+
+@pytest.mark.asyncio
+async def test_categories_cache_is_invalidated_on_update_and_delete():
+    user_id = uuid4().hex
+    categories = await create_categories(user_id, CreateCategories(name="cached"))
+
+    hits = categories_cache.hits
+    assert await get_categories_by_id(categories.id)
+    assert await get_categories_by_id(categories.id)
+    assert categories_cache.hits > hits
+    assert await get_categories(uuid4().hex, categories.id) is None
+
+    await update_categories(Categories(**{**categories.dict(), "name": "renamed"}))
+    updated = await get_categories_by_id(categories.id)
+    assert updated
+    assert updated.name == "renamed"
+
+    await delete_categories(user_id, categories.id)
+    assert await get_categories_by_id(categories.id) is None
+
+
+@pytest.mark.asyncio
+async def test_empty_chat_sweep_deletes_in_batches():
+    categories_id = uuid4().hex
+    old = datetime.now(timezone.utc) - timedelta(hours=1)
+    empty = [
+        await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id, created_at=old))
+        for _ in range(5)
+    ]
+    funded = await create_chat(
+        categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id, created_at=old, balance=10)
+    )
+    active = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id, created_at=old))
+    active.last_message_at = datetime.now(timezone.utc)
+    await update_chat_activity(active)
+    recent = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=20)
+    assert await delete_empty_chats_before(cutoff, limit=2) == 2
+    while await delete_empty_chats_before(cutoff, limit=2):
+        pass
+
+    for chat in empty:
+        assert await get_chat(chat.id) is None
+    assert await get_chat(funded.id)
+    assert await get_chat(active.id)
+    assert await get_chat(recent.id)
+
+
+@pytest.mark.asyncio
+async def test_empty_chat_sweep_keeps_chats_awaiting_an_invoice():
+    categories_id = uuid4().hex
+    old = datetime.now(timezone.utc) - timedelta(hours=1)
+    invoiced = await create_chat(
+        categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id, created_at=old)
+    )
+    payment = await create_chat_payment(
+        ChatPayment(
+            payment_hash=uuid4().hex,
+            chat_id=invoiced.id,
+            categories_id=categories_id,
+            sender_id="guest",
+            sender_name="guest",
+            sender_role="public",
+            message="tip",
+            amount=21,
+            payment_type="tip",
+        )
+    )
+
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=20)
+    while await delete_empty_chats_before(cutoff, limit=500):
+        pass
+    assert await get_chat(invoiced.id)
+
+    # once the invoice expires and is swept the chat goes too
+    await delete_unpaid_chat_payments_before(datetime.now(timezone.utc) + timedelta(seconds=1), 500)
+    assert await get_chat_payment(payment.payment_hash) is None
+    await delete_empty_chats_before(cutoff, limit=500)
+    assert await get_chat(invoiced.id) is None
+
+
+@pytest.mark.asyncio
+async def test_search_chat_messages_ranks_hits_of_own_categories():
+    user_id = uuid4().hex
+    categories = await create_categories(user_id, CreateCategories(name="support"))
+    other = await create_categories(uuid4().hex, CreateCategories(name="other"))
+    word = f"zap{uuid4().hex[:8]}"
+
+    chats = {}
+    for categories_id, text in (
+        (categories.id, f"{word} {word} failed again"),
+        (categories.id, f"my {word} went through but the wallet is slow and shows nothing yet"),
+        (categories.id, "unrelated question"),
+        (other.id, f"{word} from another account"),
+    ):
+        chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+        await create_chat_message(
+            ChatMessage(
+                id=uuid4().hex,
+                chat_id=chat.id,
+                sender_id="guest",
+                sender_name="guest",
+                sender_role="public",
+                message=text,
+            )
+        )
+        chats[text] = chat.id
+
+    hits = await search_chat_messages(user_id, word)
+    assert [hit.chat_id for hit in hits] == [
+        chats[f"{word} {word} failed again"],
+        chats[f"my {word} went through but the wallet is slow and shows nothing yet"],
+    ]
+    assert hits[0].rank >= hits[1].rank
+    assert f"[{word}]" in hits[0].snippet
+    assert hits[0].categories_id == categories.id
+
+    # the last term matches as a prefix, operators in the input are searched literally
+    assert len(await search_chat_messages(user_id, word[:-2])) == 2
+    assert await search_chat_messages(user_id, f'{word} OR "unrelated') == []
+    assert await search_chat_messages(user_id, word, categories_id=other.id) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(db.type != SQLITE, reason="VACUUM renumbering only affects the SQLite index")
+async def test_search_index_survives_vacuum():
+    user_id = uuid4().hex
+    categories = await create_categories(user_id, CreateCategories(name="vacuum"))
+    word = f"vac{uuid4().hex[:8]}"
+    chat_ids = []
+    for text in ("gone soon", "still here", f"{word} is the one"):
+        chat = await create_chat(categories.id, ChatSession(id=uuid4().hex, categories_id=categories.id))
+        await create_chat_message(
+            ChatMessage(
+                id=uuid4().hex,
+                chat_id=chat.id,
+                sender_id="guest",
+                sender_name="guest",
+                sender_role="public",
+                message=text,
+            )
+        )
+        chat_ids.append(chat.id)
+    # leave a hole in the keys that VACUUM could close up
+    await delete_chat(categories.id, chat_ids[0])
+    async with db.connect() as conn:
+        await conn.execute("VACUUM chat")
+
+    hits = await search_chat_messages(user_id, word)
+    assert [hit.chat_id for hit in hits] == [chat_ids[2]]
+    assert f"[{word}]" in hits[0].snippet
+    # keyed on a declared INTEGER PRIMARY KEY, which VACUUM keeps, not the implicit rowid
+    index = await db.fetchone("SELECT sql FROM chat.sqlite_master WHERE name = 'messages_fts'")
+    assert "content_rowid='search_key'" in index["sql"]
+
+
+@pytest.mark.asyncio
+async def test_unpaid_chat_payments_expire_in_batches():
+    old = datetime.now(timezone.utc) - timedelta(hours=3)
+
+    async def _payment(created_at: datetime, paid: bool = False) -> ChatPayment:
+        return await create_chat_payment(
+            ChatPayment(
+                payment_hash=uuid4().hex,
+                chat_id="chat",
+                categories_id="categories",
+                sender_id="guest",
+                sender_name="guest",
+                sender_role="public",
+                message="hello",
+                amount=10,
+                paid=paid,
+                created_at=created_at,
+            )
+        )
+
+    expired = [await _payment(old) for _ in range(3)]
+    paid = await _payment(old, paid=True)
+    pending = await _payment(datetime.now(timezone.utc))
+
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=2)
+    assert await delete_unpaid_chat_payments_before(cutoff, limit=2) == 2
+    while await delete_unpaid_chat_payments_before(cutoff, limit=2):
+        pass
+
+    for payment in expired:
+        assert await get_chat_payment(payment.payment_hash) is None
+    assert await get_chat_payment(paid.payment_hash)
+    assert await get_chat_payment(pending.payment_hash)
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from chat.crud import claim_outbox_job, db, update_outbox_job  # type: ignore[import]
+from chat.dispatch import Dispatcher  # type: ignore[import]
+from chat.models import OutboxJob  # type: ignore[import]
+
+
+async def _get_job(job_id: str) -> OutboxJob | None:
+    return await db.fetchone("SELECT * FROM chat.outbox WHERE id = :id", {"id": job_id}, OutboxJob)
+
+
+@pytest.mark.asyncio
+async def test_outbox_job_is_retried_with_backoff_then_removed():
+    dispatcher = Dispatcher(base_delay=60)
+    calls: list[dict] = []
+
+    async def flaky(job: OutboxJob) -> None:
+        calls.append(job.payload)
+        if len(calls) == 1:
+            raise RuntimeError("backend down")
+
+    dispatcher.register("flaky", flaky)
+    job = await dispatcher.enqueue("flaky", {"value": 1})
+
+    await dispatcher.run_due()
+    retried = await _get_job(job.id)
+    assert retried
+    assert retried.status == "pending"
+    assert retried.attempts == 1
+    assert retried.last_error == "backend down"
+    assert retried.next_attempt_at > datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert dispatcher.retried == 1
+
+    # not due yet, the backoff keeps it out of the next batch
+    await dispatcher.run_due()
+    assert len(calls) == 1
+
+    retried.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await update_outbox_job(retried)
+    await dispatcher.run_due()
+    assert calls == [{"value": 1}, {"value": 1}]
+    assert await _get_job(job.id) is None
+    assert dispatcher.completed == 1
+
+
+@pytest.mark.asyncio
+async def test_outbox_job_gives_up_after_max_attempts():
+    dispatcher = Dispatcher(max_attempts=1)
+
+    async def broken(job: OutboxJob) -> None:
+        raise RuntimeError("nope")
+
+    dispatcher.register("broken", broken)
+    job = await dispatcher.enqueue("broken", {})
+    await dispatcher.run_due()
+
+    failed = await _get_job(job.id)
+    assert failed
+    assert failed.status == "failed"
+    assert dispatcher.failed == 1
+
+
+@pytest.mark.asyncio
+async def test_outbox_job_can_only_be_claimed_once():
+    dispatcher = Dispatcher()
+    job = await dispatcher.enqueue("unclaimed", {})
+    stale = job.copy()
+    lease_until = datetime.now(timezone.utc) + timedelta(minutes=5)
+
+    assert await claim_outbox_job(job, lease_until)
+    assert not await claim_outbox_job(stale, lease_until)
+
+
+@pytest.mark.asyncio
+async def test_hung_job_only_holds_its_own_slot():
+    dispatcher = Dispatcher(concurrency=2)
+    release = asyncio.Event()
+    done: list[int] = []
+
+    async def hang(job: OutboxJob) -> None:
+        await release.wait()
+
+    async def quick(job: OutboxJob) -> None:
+        done.append(job.payload["n"])
+
+    dispatcher.register("hang", hang)
+    dispatcher.register("quick", quick)
+    await dispatcher.enqueue("hang", {})
+    for n in range(3):
+        await dispatcher.enqueue("quick", {"n": n})
+
+    async def only_hung_left() -> None:
+        while dispatcher.in_flight != 1 or len(done) < 3:
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(dispatcher.start_due(), timeout=5)
+    # the quick jobs get through the free slot while the hung one holds the other
+    await asyncio.wait_for(only_hung_left(), timeout=5)
+    assert sorted(done) == [0, 1, 2]
+
+    release.set()
+    await dispatcher.run_due()
+    assert dispatcher.in_flight == 0
@@ -0,0 +1,35 @@
+from chat import limiter  # type: ignore[import]
+from chat.limiter import RateLimiter  # type: ignore[import]
+
+
+def test_rate_limiter_rejects_when_a_bucket_is_empty(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(limiter, "monotonic", lambda: now)
+    rate_limiter = RateLimiter()
+    keys = {"ip": "c:ip:1.2.3.4", "sender": "c:sender:guest"}
+
+    assert [rate_limiter.admit(keys, rate=3) for _ in range(3)] == [0, 0, 0]
+    retry_after = rate_limiter.admit(keys, rate=3)
+    assert retry_after == 20
+    # another sender from the same address is still limited by the ip bucket
+    assert rate_limiter.admit({"ip": "c:ip:1.2.3.4", "sender": "c:sender:other"}, rate=3) == 20
+    # the same address in another category has its own buckets
+    assert rate_limiter.admit({"ip": "d:ip:1.2.3.4"}, rate=3) == 0
+
+    now += 20
+    assert rate_limiter.admit(keys, rate=3) == 0
+    assert rate_limiter.admit(keys, rate=3) > 0
+
+    stats = rate_limiter.stats()
+    assert stats["allowed"] == 5
+    assert stats["rejected"] == {"ip": 3, "sender": 2}
+
+
+def test_rate_limiter_can_be_turned_off_and_evicts_idle_buckets():
+    rate_limiter = RateLimiter(maxsize=2)
+    assert all(rate_limiter.admit({"ip": "c:ip:x"}, rate=0) == 0 for _ in range(100))
+    for host in ("a", "b", "c"):
+        rate_limiter.admit({"ip": f"c:ip:{host}"}, rate=1)
+    assert rate_limiter.stats()["buckets"] == 2
+    # the oldest bucket was dropped, which is the same as a full one
+    assert rate_limiter.admit({"ip": "c:ip:a"}, rate=1) == 0
@@ -0,0 +1,74 @@
+import json
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import text  # type: ignore[import]
+
+from chat.crud import (  # type: ignore[import]
+    create_chat,
+    create_chat_event,
+    db,
+    get_chat,
+    get_chat_events_after,
+    get_chat_messages,
+    update_chat,
+)
+from chat.migrations import _copy_chat_messages, m021_public_admin_ids  # type: ignore[import]
+from chat.models import ChatSession  # type: ignore[import]
+
+MARKUP = "is 3 < 4 and 5 > 2? use <b>bold</b> &amp; more"
+
+
+@pytest.mark.asyncio
+async def test_legacy_messages_are_copied_byte_for_byte():
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+    legacy = [
+        {
+            "id": uuid4().hex,
+            "sender_id": "guest-<1>",
+            "sender_name": "<i>guest</i> &amp; co",
+            "sender_role": "public",
+            "message": MARKUP,
+            "created_at": "2024-01-02T03:04:05+00:00",
+        }
+    ]
+    async with db.connect() as conn:
+        # written raw, like the JSON column held it before m011
+        await conn.conn.execute(
+            text("UPDATE chat.chats SET messages = :messages WHERE id = :id"),
+            {"id": chat.id, "messages": json.dumps(legacy)},
+        )
+        await conn.conn.commit()
+        await _copy_chat_messages(conn)
+
+    messages = await get_chat_messages(chat.id)
+    assert [message.message for message in messages] == [MARKUP]
+    assert messages[0].sender_name == "<i>guest</i> &amp; co"
+    assert messages[0].sender_id == "guest-<1>"
+
+
+@pytest.mark.asyncio
+async def test_public_admin_ids_keep_markup_in_participants_and_events():
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+    chat.participants = [
+        {"id": "admin-user-id", "name": "<b>support</b>", "role": "admin"},
+        {"id": "guest-<1>", "name": "5 > 2 &amp; co", "role": "public"},
+    ]
+    chat = await update_chat(chat)
+    assert chat
+    message = {"sender_id": "admin-user-id", "sender_name": "<b>support</b>", "sender_role": "admin", "message": MARKUP}
+    await create_chat_event(chat.id, "message", {"type": "message", "message": message})
+
+    async with db.connect() as conn:
+        await m021_public_admin_ids(conn)
+
+    stored = await get_chat(chat.id, include_messages=False)
+    assert stored
+    assert stored.participants == [
+        {"id": "admin-<b>support</b>", "name": "<b>support</b>", "role": "admin"},
+        {"id": "guest-<1>", "name": "5 > 2 &amp; co", "role": "public"},
+    ]
+    events = await get_chat_events_after(chat.id, 0, 10)
+    assert events[0].payload["message"] == {**message, "sender_id": "admin-<b>support</b>"}
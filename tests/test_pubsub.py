@@ -0,0 +1,82 @@
+import asyncio
+import json
+from uuid import uuid4
+
+import pytest
+
+from chat.crud import create_chat, create_chat_event  # type: ignore[import]
+from chat.models import ChatSession  # type: ignore[import]
+from chat.pubsub import MAX_NOTIFY_BYTES, ChatPubSub, LocalBackend  # type: ignore[import]
+
+
+class _Worker:
+    def __init__(self, backend: LocalBackend):
+        self.sent: list[tuple[str, dict]] = []
+        self.pubsub = ChatPubSub(backend, deliver=self.deliver)
+
+    async def deliver(self, channel: str, data: str) -> None:
+        self.sent.append((channel, json.loads(data)))
+
+
+async def _start(*workers: _Worker) -> list[asyncio.Task]:
+    tasks = [asyncio.create_task(worker.pubsub.run()) for worker in workers]
+    await asyncio.sleep(0)
+    return tasks
+
+
+@pytest.mark.asyncio
+async def test_events_reach_clients_on_every_worker_once():
+    backend = LocalBackend()
+    visitor, agent = _Worker(backend), _Worker(backend)
+    tasks = await _start(visitor, agent)
+    try:
+        await visitor.pubsub.publish("chat:abc", {"type": "message", "seq": 1})
+        await agent.pubsub.publish("chat:abc", {"type": "resolved", "seq": 2})
+
+        assert visitor.sent == agent.sent
+        assert [payload["seq"] for _, payload in visitor.sent] == [1, 2]
+
+        # a redelivered envelope is dropped
+        envelope = {"id": "replayed", "origin": "elsewhere", "channel": "chat:abc", "data": {"seq": 3}}
+        await backend.publish(json.dumps(envelope))
+        await backend.publish(json.dumps(envelope))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    assert [payload["seq"] for _, payload in agent.sent] == [1, 2, 3]
+    assert agent.pubsub.stats()["relayed"] == 2
+    assert agent.pubsub.stats()["duplicates"] == 1
+    assert visitor.pubsub.stats()["published"] == 1
+
+
+@pytest.mark.asyncio
+async def test_large_events_are_relayed_by_reference():
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+    payload = {"type": "message", "message": {"message": "x" * MAX_NOTIFY_BYTES}}
+    event = await create_chat_event(chat.id, "message", payload)
+    assert event
+
+    backend = LocalBackend()
+    visitor, agent = _Worker(backend), _Worker(backend)
+    sizes: list[int] = []
+    publish = backend.publish
+
+    async def measure(message: str) -> bool:
+        sizes.append(len(message))
+        return await publish(message)
+
+    backend.publish = measure  # type: ignore[method-assign]
+    tasks = await _start(visitor, agent)
+    try:
+        await visitor.pubsub.publish(f"chat:{chat.id}", {**payload, "seq": event.seq})
+        # too big for the owner feed, which has no event log to fall back on
+        await visitor.pubsub.publish("chatowner:x", payload)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    assert sizes and max(sizes) < MAX_NOTIFY_BYTES
+    assert agent.sent == [(f"chat:{chat.id}", {**payload, "seq": event.seq})]
+    assert visitor.pubsub.stats()["dropped"] == 1
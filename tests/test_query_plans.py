@@ -0,0 +1,71 @@
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone
+from typing import Any
+
+import pytest
+from lnbits.db import SQLITE, Filters
+from sqlalchemy import event  # type: ignore[import]
+
+from chat.crud import (  # type: ignore[import]
+    db,
+    delete_empty_chats_before,
+    delete_unpaid_chat_payments_before,
+    get_categories_ids_by_user,
+    get_chats_paginated,
+)
+
+# The plans are read with EXPLAIN QUERY PLAN, the Postgres indexes are not covered here.
+pytestmark = pytest.mark.skipif(db.type != SQLITE, reason="query plans are only checked on SQLite")
+
+LONG_AGO = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+async def _query_plan(call: Callable[[], Awaitable[Any]], table: str) -> str:
+    """
+    Run the crud call, then explain the statement it sent for `table` with
+    the parameters it was bound to.
+    """
+    statements: list[tuple[str, Any]] = []
+
+    def capture(_conn, _cursor, statement, parameters, _context, _executemany) -> None:
+        if table in statement:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        await call()
+    finally:
+        event.remove(db.engine.sync_engine, "before_cursor_execute", capture)
+    assert statements, f"no statement on {table}"
+
+    statement, parameters = statements[0]
+    async with db.connect() as conn:
+        result = await conn.conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        rows = result.mappings().all()
+    return "\n".join(row["detail"] for row in rows)
+
+
+@pytest.mark.asyncio
+async def test_chat_list_uses_category_index():
+    filters: Filters = Filters(limit=10, sortby="last_message_at", direction="desc")
+    plan = await _query_plan(lambda: get_chats_paginated("u", filters=filters), "chat.chats")
+    assert "idx_chats_category_" in plan
+    assert "idx_categories_user" in plan
+
+
+@pytest.mark.asyncio
+async def test_empty_chat_sweep_uses_index():
+    plan = await _query_plan(lambda: delete_empty_chats_before(LONG_AGO, 500), "chat.chats")
+    assert "idx_chats_last_message_created" in plan
+
+
+@pytest.mark.asyncio
+async def test_expired_payments_sweep_uses_index():
+    plan = await _query_plan(lambda: delete_unpaid_chat_payments_before(LONG_AGO, 500), "chat.chat_payments")
+    assert "idx_chat_payments_paid_created" in plan
+
+
+@pytest.mark.asyncio
+async def test_categories_by_user_uses_index():
+    plan = await _query_plan(lambda: get_categories_ids_by_user("u"), "chat.categories")
+    assert "idx_categories_user" in plan
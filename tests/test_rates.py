@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from chat import rates  # type: ignore[import]
+from chat.models import Categories  # type: ignore[import]
+from chat.rates import FiatRates  # type: ignore[import]
+from chat.services import _calculate_amount, get_price_quote  # type: ignore[import]
+
+
+@pytest.mark.asyncio
+async def test_fiat_rate_is_fetched_once_and_kept_warm(monkeypatch):
+    fetched: list[str] = []
+
+    async def get_fiat_rate_satoshis(currency: str) -> float:
+        fetched.append(currency)
+        await asyncio.sleep(0.01)
+        return 1000.0 + len(fetched)
+
+    monkeypatch.setattr(rates, "get_fiat_rate_satoshis", get_fiat_rate_satoshis)
+    fiat_rates = FiatRates(ttl=60)
+
+    assert await asyncio.gather(*(fiat_rates.get("EUR") for _ in range(5))) == [1001.0] * 5
+    assert fetched == ["EUR"]
+
+    assert await fiat_rates.refresh() == 1
+    assert await fiat_rates.get("EUR") == 1002.0
+    assert fetched == ["EUR", "EUR"]
+
+    # not used for longer than keep_warm, dropped from the refresh
+    fiat_rates.keep_warm = 0
+    assert await fiat_rates.refresh() == 0
+    assert fiat_rates.stats()["denominations"] == []
+
+
+@pytest.mark.asyncio
+async def test_calculate_amount_and_quote_use_cached_rate(monkeypatch):
+    calls = 0
+
+    async def get_fiat_rate_satoshis(currency: str) -> float:
+        nonlocal calls
+        calls += 1
+        return 2500.0
+
+    monkeypatch.setattr(rates, "get_fiat_rate_satoshis", get_fiat_rate_satoshis)
+    monkeypatch.setattr(rates.fiat_rates, "cache", rates.TTLCache("rates", ttl=60))
+    category = Categories(id="c", user_id="u", name="paid", paid=True, price_chars=0.01, denomination="USD")
+
+    assert await _calculate_amount(category, "hello") == 125
+    assert await _calculate_amount(category, "hello world") == 275
+    quote = await get_price_quote(category)
+    assert quote.sats_per_unit == 2500.0
+    assert quote.price_chars == 0.01
+    assert calls == 1
@@ -0,0 +1,758 @@
+import json
+from asyncio import Queue, ensure_future, gather, sleep
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+import pytest
+from lnbits.core.crud import create_account
+from lnbits.core.crud.wallets import create_wallet
+from lnbits.core.models import Payment
+from lnbits.core.services import websocket_manager
+from lnbits.core.services.websockets import WebsocketConnection
+
+from chat.cache import wallets_cache  # type: ignore[import]
+from chat.crud import (  # type: ignore[import]
+    archive_chat,
+    create_categories,
+    create_chat,
+    create_chat_event,
+    create_chat_message,
+    create_chat_payment,
+    credit_chat_balance,
+    db,
+    delete_chat_events_before,
+    get_archived_chat,
+    get_chat,
+    get_chat_messages,
+    get_chat_payment,
+    get_chats_paginated,
+    update_categories,
+    update_chat,
+)
+from chat.migrations import m021_public_admin_ids  # type: ignore[import]
+from chat.models import (  # type: ignore[import]
+    Categories,
+    ChatMessage,
+    ChatPayment,
+    ChatSession,
+    CreateCategories,
+    CreateChat,
+    CreateChatMessage,
+)
+from chat.services import (  # type: ignore[import]
+    _resolve_category_wallet,
+    _resolve_user_wallet,
+    archive_category_chats,
+    create_public_chat,
+    get_archived_chat_export,
+    get_chat_events_page,
+    get_chat_messages_page,
+    get_public_chat,
+    mark_chat_resolved,
+    materialize_chat,
+    owner_channel,
+    payment_received_for_client_data,
+    send_admin_message,
+    send_public_message,
+    toggle_chat_claim,
+)
+from chat.writer import chat_writers  # type: ignore[import]
+
+
+class _RecordingWebsocket:
+    def __init__(self):
+        self.sent: list[dict] = []
+
+    async def send_text(self, data: str) -> None:
+        self.sent.append(json.loads(data))
+
+
+async def _create_chat_with_messages(count: int) -> ChatSession:
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+    created_at = datetime.now(timezone.utc) - timedelta(hours=1)
+    for index in range(count):
+        await create_chat_message(
+            ChatMessage(
+                id=uuid4().hex,
+                chat_id=chat.id,
+                sender_id="admin-user-id" if index % 2 else "guest",
+                sender_name="support" if index % 2 else "guest",
+                sender_role="admin" if index % 2 else "public",
+                message=f"message {index}",
+                # pairs of messages share a timestamp to exercise the id tie-break
+                created_at=created_at + timedelta(seconds=index // 2),
+            )
+        )
+    return chat
+
+
+@pytest.mark.asyncio
+async def test_chat_messages_page_walks_history_newest_first():
+    chat = await _create_chat_with_messages(7)
+
+    seen: list[str] = []
+    pages = 0
+    cursor = None
+    while True:
+        page = await get_chat_messages_page(chat.id, before=cursor, limit=3)
+        pages += 1
+        assert len(page.data) <= 3
+        seen = [m["message"] for m in page.data] + seen
+        cursor = page.next_cursor
+        if not cursor:
+            break
+
+    assert pages == 3
+    assert len(seen) == 7
+    assert len(set(seen)) == 7
+    assert seen[-1] == "message 6"
+
+
+@pytest.mark.asyncio
+async def test_admin_ids_never_reach_the_public_page():
+    account = await create_account()
+    category = await create_categories(account.id, CreateCategories(name="private"))
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id))
+    await toggle_chat_claim(chat.id, account.id)
+
+    websocket = _RecordingWebsocket()
+    connection = WebsocketConnection(
+        item_id=f"chat:{chat.id}",
+        websocket=websocket,  # type: ignore[arg-type]
+        receive_queue=Queue(),
+    )
+    websocket_manager.active_connections.append(connection)
+    try:
+        await send_admin_message(
+            chat.id,
+            CreateChatMessage(sender_id=category.user_id, sender_name="support", sender_role="admin", message="hi"),
+        )
+    finally:
+        websocket_manager.active_connections.remove(connection)
+
+    public_chat = await get_public_chat(category.id, chat.id, messages_limit=10)
+    assert public_chat.participants[0]["id"] == "admin-support"
+    assert public_chat.messages[0]["sender_id"] == "admin-support"
+    seen = [
+        public_chat.json(),
+        (await get_chat_messages_page(chat.id)).json(),
+        (await get_chat_events_page(public_chat, after=0)).json(),
+        json.dumps(websocket.sent),
+    ]
+    assert all(category.user_id not in data for data in seen)
+    # the claim itself is kept for the claim split payout
+    stored = await get_chat(chat.id, include_messages=False)
+    assert stored
+    assert stored.claimed_by_id == category.user_id
+
+
+@pytest.mark.asyncio
+async def test_migration_moves_legacy_admin_ids_to_their_public_form():
+    chat = await _create_chat_with_messages(4)
+    chat.participants = [
+        {"id": "admin-user-id", "name": "support", "role": "admin"},
+        {"id": "guest", "name": "guest", "role": "public"},
+    ]
+    chat = await update_chat(chat)
+    assert chat
+    await create_chat_event(
+        chat.id,
+        "message",
+        {
+            "type": "message",
+            "message": {"sender_id": "admin-user-id", "sender_name": "support", "sender_role": "admin"},
+        },
+    )
+
+    async with db.connect() as conn:
+        await m021_public_admin_ids(conn)
+
+    stored = await get_chat(chat.id)
+    assert stored
+    assert [participant["id"] for participant in stored.participants] == ["admin-support", "guest"]
+    assert {message["sender_id"] for message in stored.messages} == {"admin-support", "guest"}
+    page = await get_chat_events_page(stored, after=0)
+    assert page.data[0]["message"]["sender_id"] == "admin-support"
+
+
+@pytest.mark.asyncio
+async def test_chat_list_is_served_from_summary_columns():
+    user_id = uuid4().hex
+    category = await create_categories(user_id, CreateCategories(name="support"))
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id))
+    for index in range(3):
+        await send_admin_message(
+            chat.id,
+            CreateChatMessage(
+                sender_id="admin-support",
+                sender_name="support",
+                sender_role="admin",
+                message=f"reply {index} " + "x" * 200,
+            ),
+        )
+
+    page = await get_chats_paginated(user_id=user_id)
+    assert page.total == 1
+    summary = page.data[0]
+    assert summary.id == chat.id
+    assert summary.message_count == 3
+    assert summary.last_message_preview.startswith("reply 2 ")
+    assert len(summary.last_message_preview) == 120
+    assert summary.last_message_at is not None
+    assert not hasattr(summary, "messages")
+
+    other_category = await create_categories(uuid4().hex, CreateCategories(name="other"))
+    page = await get_chats_paginated(user_id=user_id, categories_id=other_category.id)
+    assert page.total == 0
+    page = await get_chats_paginated(user_id=user_id, categories_id=category.id)
+    assert page.total == 1
+
+
+@pytest.mark.asyncio
+async def test_owner_feed_receives_chat_deltas():
+    user_id = uuid4().hex
+    category = await create_categories(user_id, CreateCategories(name="support"))
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id))
+
+    websocket = _RecordingWebsocket()
+    connection = WebsocketConnection(
+        item_id=owner_channel(user_id),
+        websocket=websocket,  # type: ignore[arg-type]
+        receive_queue=Queue(),
+    )
+    websocket_manager.active_connections.append(connection)
+    try:
+        await send_admin_message(
+            chat.id,
+            CreateChatMessage(sender_id="admin-support", sender_name="support", sender_role="admin", message="hello"),
+        )
+        await mark_chat_resolved(chat.id, True)
+    finally:
+        websocket_manager.active_connections.remove(connection)
+
+    assert owner_channel(user_id) != owner_channel(uuid4().hex)
+    assert [event["type"] for event in websocket.sent] == ["update", "update"]
+    assert all(event["chat_id"] == chat.id for event in websocket.sent)
+    assert websocket.sent[0]["changes"]["last_message_preview"] == "hello"
+    assert websocket.sent[0]["changes"]["message_count"] == 1
+    assert websocket.sent[1]["changes"]["resolved"] is True
+
+
+@pytest.mark.asyncio
+async def test_category_wallet_resolution_is_cached_and_invalidated():
+    user_id = uuid4().hex
+    wallet = await create_wallet(user_id=user_id, wallet_name="chat")
+    category = await create_categories(user_id, CreateCategories(name="support"))
+
+    misses = wallets_cache.misses
+    assert await _resolve_category_wallet(category) == wallet.id
+    assert await _resolve_category_wallet(category) == wallet.id
+    assert await _resolve_user_wallet(user_id) == wallet.id
+    # first call misses on the category and the user key, the rest are hits
+    assert wallets_cache.misses == misses + 2
+
+    other = await create_wallet(user_id=user_id, wallet_name="payouts")
+    category = await update_categories(Categories(**{**category.dict(), "wallet": other.id}))
+    assert await _resolve_category_wallet(category) == other.id
+    assert wallets_cache.get(f"category:{category.id}") is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_drawdowns_and_top_ups_never_lose_sats():
+    category = await create_categories(
+        uuid4().hex,
+        CreateCategories(name="prepaid", paid=True, lnurlp=True, price_chars=1, denomination="sat"),
+    )
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id, balance=50))
+    message = CreateChatMessage(sender_id="guest", sender_name="guest", sender_role="public", message="x" * 10)
+
+    async def send() -> bool:
+        try:
+            await send_public_message(category.id, chat.id, message)
+        except ValueError:
+            return False
+        return True
+
+    top_ups = [credit_chat_balance(chat.id, 10) for _ in range(5)]
+    results = await gather(*[send() for _ in range(20)], *top_ups)
+    sent = sum(1 for result in results[:20] if result)
+
+    stored = await get_chat(chat.id, include_messages=False)
+    assert stored
+    assert stored.balance >= 0
+    assert stored.balance == 50 + 5 * 10 - sent * 10
+    assert len(await get_chat_messages(chat.id)) == sent
+
+
+@pytest.mark.asyncio
+async def test_failed_drawdown_message_keeps_the_balance(monkeypatch):
+    category = await create_categories(
+        uuid4().hex,
+        CreateCategories(name="prepaid", paid=True, lnurlp=True, price_chars=1, denomination="sat", claim_split=50),
+    )
+    chat = await create_chat(
+        category.id,
+        ChatSession(id=uuid4().hex, categories_id=category.id, balance=50, claimed_by_id="agent", claimed_by_name="a"),
+    )
+
+    async def fail(*_args, **_kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr("chat.services.create_chat_message", fail)
+    with pytest.raises(RuntimeError):
+        await send_public_message(
+            category.id,
+            chat.id,
+            CreateChatMessage(sender_id="guest", sender_name="guest", sender_role="public", message="x" * 10),
+        )
+
+    stored = await get_chat(chat.id, include_messages=False)
+    assert stored
+    assert stored.balance == 50
+    assert await get_chat_messages(chat.id) == []
+    jobs = await db.fetchall("SELECT payload FROM chat.outbox WHERE kind = 'claim_split'")
+    assert not [job for job in jobs if chat.id in job["payload"]]
+
+
+@pytest.mark.asyncio
+async def test_parallel_sends_keep_every_message_and_participant():
+    category = await create_categories(uuid4().hex, CreateCategories(name="busy"))
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id))
+
+    guests = [
+        send_public_message(
+            category.id,
+            chat.id,
+            CreateChatMessage(
+                sender_id=f"guest-{index}", sender_name=f"guest {index}", sender_role="public", message=f"hi {n}"
+            ),
+        )
+        for index in range(8)
+        for n in range(5)
+    ]
+    replies = [
+        send_admin_message(
+            chat.id,
+            CreateChatMessage(sender_id="admin-user-id", sender_name="support", sender_role="admin", message=f"{n}"),
+        )
+        for n in range(10)
+    ]
+    await gather(*guests, *replies, credit_chat_balance(chat.id, 25), mark_chat_resolved(chat.id, True))
+
+    stored = await get_chat(chat.id)
+    assert stored
+    assert len(stored.messages) == 50
+    assert stored.message_count == 50
+    assert sorted(participant["id"] for participant in stored.participants) == sorted(
+        [f"guest-{index}" for index in range(8)] + ["admin-support"]
+    )
+    assert stored.balance == 25
+    assert stored.resolved
+
+
+@pytest.mark.asyncio
+async def test_participants_with_markup_are_stored_as_sent():
+    category = await create_categories(uuid4().hex, CreateCategories(name="markup"))
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id))
+
+    for n in range(3):
+        await send_public_message(
+            category.id,
+            chat.id,
+            CreateChatMessage(sender_id="<", sender_name=">", sender_role="public", message=f"<b>{n}</b> &amp;"),
+        )
+
+    stored = await get_chat(chat.id)
+    assert stored
+    assert stored.participants == [{**stored.participants[0], "id": "<", "name": ">"}]
+    assert stored.messages[-1]["message"] == "<b>2</b> &amp;"
+    assert stored.last_message_preview == "<b>2</b> &amp;"
+
+
+@pytest.mark.asyncio
+async def test_public_chat_is_stored_with_its_first_message():
+    category = await create_categories(uuid4().hex, CreateCategories(name="lazy"))
+    chat = await create_public_chat(
+        category.id, CreateChat(participant_id="guest-1", participant_name="guest"), base_url="http://test"
+    )
+    assert chat.token
+    assert await get_chat(chat.id) is None
+    provisional = await get_public_chat(category.id, chat.id, token=chat.token)
+    assert provisional.id == chat.id
+    assert provisional.participants[0]["id"] == "guest-1"
+
+    other = await create_public_chat(category.id, CreateChat(participant_id="guest-2"), base_url="http://test")
+    forged = chat.token[:-1] + ("0" if chat.token[-1] != "0" else "1")
+    for token in (None, forged, other.token):
+        with pytest.raises(ValueError, match="Chat not found"):
+            await get_public_chat(category.id, chat.id, token=token)
+        with pytest.raises(ValueError, match="Chat not found"):
+            await send_public_message(
+                category.id,
+                chat.id,
+                CreateChatMessage(
+                    sender_id="guest-1", sender_name="guest", sender_role="public", message="hi", token=token
+                ),
+            )
+    assert await get_chat(chat.id) is None
+
+    await gather(
+        *[
+            send_public_message(
+                category.id,
+                chat.id,
+                CreateChatMessage(
+                    sender_id="guest-1", sender_name="guest", sender_role="public", message=f"{n}", token=chat.token
+                ),
+            )
+            for n in range(5)
+        ]
+    )
+    stored = await get_chat(chat.id)
+    assert stored
+    assert stored.message_count == 5
+    assert [participant["id"] for participant in stored.participants] == ["guest-1"]
+
+
+@pytest.mark.asyncio
+async def test_stale_chat_update_is_rejected_and_keeps_balance():
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+    stale = await get_chat(chat.id, include_messages=False)
+    assert stale
+    fresh = stale.copy()
+
+    fresh.title = "first"
+    updated = await update_chat(fresh)
+    assert updated
+    assert updated.version == stale.version + 1
+    stale.title = "second"
+    assert await update_chat(stale) is None
+
+    # a whole row write never carries a balance read before a credit
+    await credit_chat_balance(chat.id, 10)
+    updated.title = "third"
+    updated = await update_chat(updated)
+    assert updated
+    assert updated.title == "third"
+    assert updated.balance == 10
+
+
+def _paid_invoice(extra: dict, amount_sat: int = 21) -> Payment:
+    payment_hash = uuid4().hex
+    return Payment(
+        checking_id=payment_hash,
+        payment_hash=payment_hash,
+        wallet_id="wallet",
+        amount=amount_sat * 1000,
+        fee=0,
+        bolt11="lnbc",
+        extra={"tag": "chat", **extra},
+    )
+
+
+@pytest.mark.asyncio
+async def test_invoice_for_a_missing_chat_stays_unpaid():
+    category = await create_categories(uuid4().hex, CreateCategories(name="tips", paid=True, price_chars=1))
+    chat_id = uuid4().hex
+    payment = _paid_invoice({"chat_id": chat_id})
+    await create_chat_payment(
+        ChatPayment(
+            payment_hash=payment.payment_hash,
+            chat_id=chat_id,
+            categories_id=category.id,
+            sender_id="guest",
+            sender_name="guest",
+            sender_role="public",
+            message="thanks",
+            amount=21,
+            payment_type="tip",
+        )
+    )
+
+    assert not await payment_received_for_client_data(payment)
+    stored = await get_chat_payment(payment.payment_hash)
+    assert stored
+    assert not stored.paid
+
+    # a replay once the chat is back still delivers the tip
+    await create_chat(category.id, ChatSession(id=chat_id, categories_id=category.id))
+    assert await payment_received_for_client_data(payment)
+    assert [message.message for message in await get_chat_messages(chat_id)] == ["thanks"]
+
+
+@pytest.mark.asyncio
+async def test_replayed_invoice_is_finalized_once():
+    category = await create_categories(uuid4().hex, CreateCategories(name="payg", paid=True, price_chars=1))
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id))
+    payment = _paid_invoice({"chat_id": chat.id})
+    await create_chat_payment(
+        ChatPayment(
+            payment_hash=payment.payment_hash,
+            chat_id=chat.id,
+            categories_id=category.id,
+            sender_id="guest",
+            sender_name="guest",
+            sender_role="public",
+            message="paid hello",
+            amount=21,
+        )
+    )
+
+    websocket = _RecordingWebsocket()
+    connection = WebsocketConnection(
+        item_id=f"chat:{chat.id}",
+        websocket=websocket,  # type: ignore[arg-type]
+        receive_queue=Queue(),
+    )
+    websocket_manager.active_connections.append(connection)
+    try:
+        results = await gather(*[payment_received_for_client_data(payment) for _ in range(5)])
+    finally:
+        websocket_manager.active_connections.remove(connection)
+
+    assert all(results)
+    # one multiplexed channel carries both the message and the settled invoice
+    assert [event["type"] for event in websocket.sent] == ["message", "paid"]
+    assert websocket.sent[1]["payment_hash"] == payment.payment_hash
+    messages = await get_chat_messages(chat.id)
+    assert [message.message for message in messages] == ["paid hello"]
+    stored = await get_chat(chat.id, include_messages=False)
+    assert stored
+    assert stored.message_count == 1
+
+
+@pytest.mark.asyncio
+async def test_paid_invoice_waits_for_a_busy_chat(monkeypatch):
+    monkeypatch.setattr(chat_writers, "max_queue", 0)
+    category = await create_categories(uuid4().hex, CreateCategories(name="queue", paid=True, price_chars=1))
+    chat = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id))
+    payment = _paid_invoice({"chat_id": chat.id})
+    await create_chat_payment(
+        ChatPayment(
+            payment_hash=payment.payment_hash,
+            chat_id=chat.id,
+            categories_id=category.id,
+            sender_id="guest",
+            sender_name="guest",
+            sender_role="public",
+            message="paid while busy",
+            amount=21,
+        )
+    )
+
+    async with chat_writers.hold(chat.id):
+        finalizing = ensure_future(payment_received_for_client_data(payment))
+        while chat_writers.stats()["queued"] < 2:
+            await sleep(0.01)
+        # a send can be retried by the visitor and is turned away
+        with pytest.raises(ValueError, match="busy"):
+            await send_public_message(
+                category.id,
+                chat.id,
+                CreateChatMessage(sender_id="guest", sender_name="guest", sender_role="public", message="hi"),
+            )
+
+    assert await finalizing
+    assert [message.message for message in await get_chat_messages(chat.id)] == ["paid while busy"]
+
+
+@pytest.mark.asyncio
+async def test_replayed_lnurl_top_up_is_credited_once():
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+    payment = _paid_invoice({"chat_id": chat.id, "payment_type": "balance"}, amount_sat=100)
+
+    await gather(*[payment_received_for_client_data(payment) for _ in range(3)])
+    await payment_received_for_client_data(payment)
+
+    stored = await get_chat(chat.id, include_messages=False)
+    assert stored
+    assert stored.balance == 100
+
+
+@pytest.mark.asyncio
+async def test_chat_events_carry_sequence_and_resume_after_reconnect():
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id))
+
+    websocket = _RecordingWebsocket()
+    connection = WebsocketConnection(
+        item_id=f"chat:{chat.id}",
+        websocket=websocket,  # type: ignore[arg-type]
+        receive_queue=Queue(),
+    )
+    websocket_manager.active_connections.append(connection)
+    try:
+        await send_admin_message(
+            chat.id,
+            CreateChatMessage(sender_id="admin-user-id", sender_name="support", sender_role="admin", message="hi"),
+        )
+        await mark_chat_resolved(chat.id, True)
+        await mark_chat_resolved(chat.id, False)
+    finally:
+        websocket_manager.active_connections.remove(connection)
+
+    assert [event["seq"] for event in websocket.sent] == [1, 2, 3]
+
+    stored = await get_chat(chat.id, include_messages=False)
+    assert stored
+    assert stored.event_seq == 3
+
+    # a client that only saw the message catches up on the two resolve toggles
+    page = await get_chat_events_page(stored, after=1)
+    assert not page.reset
+    assert [(event["seq"], event["type"]) for event in page.data] == [(2, "resolved"), (3, "resolved")]
+    assert page.last_seq == 3
+
+    page = await get_chat_events_page(stored, after=0)
+    assert page.data[0]["message"]["sender_id"] == "admin-support"
+
+    assert (await get_chat_events_page(stored, after=3)).data == []
+
+    await delete_chat_events_before(datetime.now(timezone.utc) + timedelta(seconds=1))
+    page = await get_chat_events_page(stored, after=1)
+    assert page.reset
+    assert page.last_seq == 3
+
+
+@pytest.mark.asyncio
+async def test_retention_archives_old_resolved_chats_and_keeps_payments():
+    category = await create_categories(uuid4().hex, CreateCategories(name="retained", archive_resolved_days=7))
+    old = datetime.now(timezone.utc) - timedelta(days=8)
+    stale = await create_chat(
+        category.id,
+        ChatSession(id=uuid4().hex, categories_id=category.id, resolved=True, created_at=old, updated_at=old),
+    )
+    recent = await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id, resolved=True))
+    still_open = await create_chat(
+        category.id,
+        ChatSession(id=uuid4().hex, categories_id=category.id, created_at=old, updated_at=old),
+    )
+    await send_admin_message(
+        stale.id,
+        CreateChatMessage(sender_id="admin-user-id", sender_name="support", sender_role="admin", message="bye"),
+    )
+    # sending bumps updated_at, put it back in the past
+    sent = await get_chat(stale.id, include_messages=False)
+    assert sent
+    sent.updated_at = old
+    await update_chat(sent)
+    payment = await create_chat_payment(
+        ChatPayment(
+            payment_hash=uuid4().hex,
+            chat_id=stale.id,
+            categories_id=category.id,
+            sender_id="guest",
+            sender_name="guest",
+            sender_role="public",
+            message="paid",
+            amount=10,
+            paid=True,
+        )
+    )
+
+    assert await archive_category_chats(category) == 1
+
+    assert await get_chat(stale.id) is None
+    assert await get_chat_messages(stale.id) == []
+    assert await get_chat(recent.id)
+    assert await get_chat(still_open.id)
+    assert await get_chat_payment(payment.payment_hash)
+
+    archived = await get_archived_chat(stale.id)
+    assert archived
+    assert archived.message_count == 1
+    export = get_archived_chat_export(archived)
+    assert export["chat"]["id"] == stale.id
+    assert [message["message"] for message in export["messages"]] == ["bye"]
+
+    assert await archive_category_chats(category) == 0
+
+
+@pytest.mark.asyncio
+async def test_archived_chat_is_not_created_again_from_its_token():
+    category = await create_categories(uuid4().hex, CreateCategories(name="archived"))
+    chat = await create_public_chat(
+        category.id, CreateChat(participant_id="guest", participant_name="guest"), base_url="http://test"
+    )
+    assert await materialize_chat(chat.id, chat.token, None, categories_id=category.id)
+    assert await archive_chat(chat.id)
+
+    assert await materialize_chat(chat.id, chat.token, None, categories_id=category.id) is None
+    with pytest.raises(ValueError):
+        await send_public_message(
+            category.id,
+            chat.id,
+            CreateChatMessage(
+                sender_id="guest", sender_name="guest", sender_role="public", message="again", token=chat.token
+            ),
+        )
+    assert await get_chat(chat.id) is None
+
+
+@pytest.mark.asyncio
+async def test_archiving_keeps_the_first_record_and_the_live_chat():
+    categories_id = uuid4().hex
+    chat = await create_chat(categories_id, ChatSession(id=uuid4().hex, categories_id=categories_id, title="first"))
+    assert await archive_chat(chat.id)
+    await create_chat(categories_id, ChatSession(id=chat.id, categories_id=categories_id, title="second"))
+
+    assert await archive_chat(chat.id) is None
+    assert await get_chat(chat.id)
+    archived = await get_archived_chat(chat.id)
+    assert archived
+    assert archived.title == "first"
+
+
+@pytest.mark.asyncio
+async def test_retention_carries_on_past_a_failing_chat(monkeypatch):
+    category = await create_categories(uuid4().hex, CreateCategories(name="failing", archive_idle_days=7))
+    old = datetime.now(timezone.utc) - timedelta(days=8)
+    chats = [
+        await create_chat(category.id, ChatSession(id=uuid4().hex, categories_id=category.id, created_at=old))
+        for _ in range(3)
+    ]
+    failing = chats[1].id
+
+    async def archive_or_fail(chat_id: str):
+        if chat_id == failing:
+            raise RuntimeError("disk full")
+        return await archive_chat(chat_id)
+
+    monkeypatch.setattr("chat.services.archive_chat", archive_or_fail)
+    assert await archive_category_chats(category) == 2
+    assert await get_chat(failing)
+    assert await get_archived_chat(chats[0].id)
+    assert await get_archived_chat(chats[2].id)
+
+
+@pytest.mark.asyncio
+async def test_retention_keeps_chats_with_balance_or_open_invoices():
+    category = await create_categories(uuid4().hex, CreateCategories(name="credit", archive_idle_days=3))
+    old = datetime.now(timezone.utc) - timedelta(days=5)
+    funded, invoiced, idle = [
+        await create_chat(
+            category.id, ChatSession(id=uuid4().hex, categories_id=category.id, created_at=old, balance=balance)
+        )
+        for balance in (500, 0, 0)
+    ]
+    await create_chat_payment(
+        ChatPayment(
+            payment_hash=uuid4().hex,
+            chat_id=invoiced.id,
+            categories_id=category.id,
+            sender_id="guest",
+            sender_name="guest",
+            sender_role="public",
+            message="tip",
+            amount=21,
+            payment_type="tip",
+        )
+    )
+
+    assert await archive_category_chats(category) == 1
+    assert await get_archived_chat(idle.id)
+    assert await get_chat(funded.id)
+    assert await get_chat(invoiced.id)
@@ -0,0 +1,57 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from lnbits.core.models import Payment
+
+from chat.tasks import InvoiceWorkers  # type: ignore[import]
+
+
+def _payment(chat_id: str, index: int) -> Payment:
+    payment_hash = uuid4().hex
+    return Payment(
+        checking_id=payment_hash,
+        payment_hash=payment_hash,
+        wallet_id="wallet",
+        amount=1000,
+        fee=0,
+        bolt11="lnbc",
+        extra={"tag": "chat", "chat_id": chat_id, "index": index},
+    )
+
+
+@pytest.mark.asyncio
+async def test_invoice_workers_keep_chat_order_and_run_chats_in_parallel():
+    handled: list[tuple[str, int]] = []
+    slow_started = asyncio.Event()
+
+    async def handler(payment: Payment) -> None:
+        if payment.extra["chat_id"] == "slow" and payment.extra["index"] == 0:
+            slow_started.set()
+            await asyncio.sleep(0.2)
+        handled.append((payment.extra["chat_id"], payment.extra["index"]))
+
+    workers = InvoiceWorkers(lanes=4, handler=handler)
+    fast = next(
+        f"fast-{n}" for n in range(100) if workers.lane(_payment(f"fast-{n}", 0)) != workers.lane(_payment("slow", 0))
+    )
+    tasks = workers.start()
+    try:
+        for index in range(3):
+            await workers.submit(_payment("slow", index))
+        await slow_started.wait()
+        for index in range(3):
+            await workers.submit(_payment(fast, index))
+        await asyncio.wait_for(workers.join(), timeout=5)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # the fast chat finished while the slow chat's first payment was still running
+    assert handled[:3] == [(fast, 0), (fast, 1), (fast, 2)]
+    assert [index for chat_id, index in handled if chat_id == "slow"] == [0, 1, 2]
+
+    stats = workers.stats()
+    assert stats["processed"] == 6
+    assert stats["queue_depth"] == 0
+    assert stats["processing_ms_p99"] >= 200
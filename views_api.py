@@ -1,52 +1,82 @@
+import math
 from http import HTTPStatus
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, Query, Request
 from fastapi.exceptions import HTTPException
 from lnbits.core.models import SimpleStatus
 from lnbits.core.models.users import AccountId
 from lnbits.db import Filters, Page
-from lnbits.decorators import check_account_id_exists, optional_user_id, parse_filters
+from lnbits.decorators import check_account_id_exists, check_admin, optional_user_id, parse_filters
 from lnbits.helpers import generate_filter_params_openapi
 
+from .cache import cache_stats
 from .crud import (
     create_categories,
     delete_categories,
+    get_archived_chat,
+    get_archived_chats,
     get_categories,
     get_categories_by_id,
-    get_categories_ids_by_user,
     get_categories_paginated,
     get_chat,
     get_chat_for_category,
     get_chats_paginated,
+    get_outbox_counts,
+    search_chat_messages,
     update_categories,
 )
+from .dispatch import dispatcher
 from .helpers import chat_lnurl_url, lnurl_encode_chat
+from .limiter import DEFAULT_RATE_LIMIT, rate_limiter
 from .models import (
+    ArchivedChat,
+    ArchivedChatsFilters,
     Categories,
     CategoriesFilters,
+    ChatEventsPage,
     ChatMessage,
+    ChatMessagesPage,
     ChatPaymentRequest,
+    ChatSearchHit,
     ChatSession,
     ChatsFilters,
+    ChatSummary,
     CreateCategories,
     CreateChat,
     CreateChatMessage,
+    PriceQuote,
     PublicCategories,
     TipRequest,
 )
+from .pubsub import chat_pubsub
+from .rates import fiat_rates
 from .services import (
+    MAX_EVENTS_PAGE_SIZE,
+    MAX_MESSAGES_PAGE_SIZE,
+    MAX_SEARCH_RESULTS,
+    MESSAGES_PAGE_SIZE,
     create_public_chat,
+    get_archived_chat_export,
+    get_chat_events_page,
+    get_chat_messages_page,
+    get_price_quote,
     get_public_chat,
+    load_latest_messages,
     mark_chat_resolved,
     mark_chat_seen,
+    owner_channel,
+    read_chat_token,
     request_tip,
     send_admin_message,
     send_public_message,
     toggle_chat_claim,
 )
+from .tasks import archive_stats, cleanup_stats, invoice_workers, payments_stats
+from .writer import chat_writers
 
 categories_filters = parse_filters(CategoriesFilters)
 chats_filters = parse_filters(ChatsFilters)
+archived_chats_filters = parse_filters(ArchivedChatsFilters)
 
 chat_api_router = APIRouter()
 
@@ -63,6 +93,11 @@ async def api_create_categories(
         payload["claim_split"] = 0
     if payload.get("claim_split") is not None:
         payload["claim_split"] = max(0, min(float(payload["claim_split"]), 90))
+    for key in ("archive_resolved_days", "archive_idle_days"):
+        if payload.get(key) is not None:
+            payload[key] = max(0, int(payload[key])) or None
+    if payload.get("rate_limit") is not None:
+        payload["rate_limit"] = max(0, int(payload["rate_limit"]))
     categories = await create_categories(account_id.id, CreateCategories(**payload))
     return categories
 
@@ -84,6 +119,11 @@ async def api_update_categories(
         payload["claim_split"] = 0
     if payload.get("claim_split") is not None:
         payload["claim_split"] = max(0, min(float(payload["claim_split"]), 90))
+    for key in ("archive_resolved_days", "archive_idle_days"):
+        if payload.get(key) is not None:
+            payload[key] = max(0, int(payload[key])) or None
+    if payload.get("rate_limit") is not None:
+        payload["rate_limit"] = max(0, int(payload["rate_limit"]))
     categories = await update_categories(Categories(**{**categories.dict(), **payload}))
     return categories
 
@@ -144,6 +184,23 @@ async def api_get_public_categories(categories_id: str) -> PublicCategories:
     return PublicCategories(**payload)
 
 
+@chat_api_router.get(
+    "/api/v1/categories/{categories_id}/public/quote",
+    name="Get Price Quote",
+    summary="Get the price per character and the sats rate of the category denomination. " "This is a public endpoint.",
+    response_description="A price quote or 404 if not found",
+    response_model=PriceQuote,
+)
+async def api_get_price_quote(categories_id: str) -> PriceQuote:
+    categories = await get_categories_by_id(categories_id)
+    if not categories:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Categories not found.")
+    try:
+        return await get_price_quote(categories)
+    except Exception as exc:
+        raise HTTPException(HTTPStatus.SERVICE_UNAVAILABLE, "Exchange rate unavailable.") from exc
+
+
 @chat_api_router.delete(
     "/api/v1/categories/{categories_id}",
     name="Delete Categories",
@@ -162,6 +219,24 @@ async def api_delete_categories(
 
 
 ############################# Chats #############################
+async def _check_rate_limit(request: Request, categories_id: str, sender_id: str | None = None) -> None:
+    categories = await get_categories_by_id(categories_id)
+    if not categories:
+        return
+    rate = DEFAULT_RATE_LIMIT if categories.rate_limit is None else categories.rate_limit
+    host = request.client.host if request.client else "unknown"
+    keys = {"ip": f"{categories_id}:ip:{host}"}
+    if sender_id:
+        keys["sender"] = f"{categories_id}:sender:{sender_id}"
+    retry_after = rate_limiter.admit(keys, rate)
+    if retry_after:
+        raise HTTPException(
+            HTTPStatus.TOO_MANY_REQUESTS,
+            "Too many requests, slow down.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
 @chat_api_router.post(
     "/api/v1/chats/{categories_id}/public",
     name="Create Chat",
@@ -175,6 +250,7 @@ async def api_create_public_chat(
     data: CreateChat,
     request: Request,
 ) -> ChatSession:
+    await _check_rate_limit(request, categories_id, data.participant_id)
     base_url = str(request.base_url)
     try:
         return await create_public_chat(categories_id, data, base_url)
@@ -188,28 +264,75 @@ async def api_create_public_chat(
     summary="Get chat history for the public page.",
     response_model=ChatSession,
 )
-async def api_get_public_chat(categories_id: str, chat_id: str) -> ChatSession:
+async def api_get_public_chat(
+    categories_id: str,
+    chat_id: str,
+    messages_limit: int | None = Query(None, ge=1, le=MAX_MESSAGES_PAGE_SIZE),
+    token: str | None = None,
+) -> ChatSession:
     try:
-        return await get_public_chat(categories_id, chat_id)
+        return await get_public_chat(categories_id, chat_id, messages_limit=messages_limit, token=token)
     except ValueError as exc:
         raise HTTPException(HTTPStatus.NOT_FOUND, str(exc)) from exc
 
 
+@chat_api_router.get(
+    "/api/v1/chats/{categories_id}/{chat_id}/public/messages",
+    name="Get Chat Messages (Public)",
+    summary="Get a page of chat messages, newest first, older pages via the `before` cursor.",
+    response_model=ChatMessagesPage,
+)
+async def api_get_public_chat_messages(
+    categories_id: str,
+    chat_id: str,
+    before: str | None = None,
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MAX_MESSAGES_PAGE_SIZE),
+) -> ChatMessagesPage:
+    chat = await get_chat_for_category(categories_id, chat_id, include_messages=False)
+    if not chat:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Chat not found.")
+    return await get_chat_messages_page(chat.id, before=before, limit=limit)
+
+
+@chat_api_router.get(
+    "/api/v1/chats/{categories_id}/{chat_id}/public/events",
+    name="Get Chat Events (Public)",
+    summary="Get the websocket events after sequence `after`, for resuming after a reconnect.",
+    response_model=ChatEventsPage,
+)
+async def api_get_public_chat_events(
+    categories_id: str,
+    chat_id: str,
+    after: int = Query(0, ge=0),
+    limit: int = Query(MAX_EVENTS_PAGE_SIZE, ge=1, le=MAX_EVENTS_PAGE_SIZE),
+    token: str | None = None,
+) -> ChatEventsPage:
+    chat = await get_chat_for_category(categories_id, chat_id, include_messages=False)
+    if not chat:
+        if read_chat_token(token, chat_id, categories_id):
+            # still provisional, nothing has happened yet
+            return ChatEventsPage()
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Chat not found.")
+    return await get_chat_events_page(chat, after=after, limit=limit)
+
+
 @chat_api_router.get(
     "/api/v1/chats/{categories_id}/{chat_id}/lnurl",
     name="Get Chat LNURL",
     summary="Get LNURL for chat balance funding.",
 )
-async def api_get_chat_lnurl(categories_id: str, chat_id: str, request: Request) -> dict:
-    chat = await get_chat_for_category(categories_id, chat_id)
+async def api_get_chat_lnurl(categories_id: str, chat_id: str, request: Request, token: str | None = None) -> dict:
+    chat = await get_chat_for_category(categories_id, chat_id, include_messages=False) or read_chat_token(
+        token, chat_id, categories_id
+    )
     if not chat:
         raise HTTPException(HTTPStatus.NOT_FOUND, "Chat not found.")
     categories = await get_categories_by_id(categories_id)
     if not categories or not categories.paid or not categories.lnurlp:
         raise HTTPException(HTTPStatus.NOT_FOUND, "Chat does not accept balance.")
     return {
-        "lnurl": lnurl_encode_chat(request, chat.id),
-        "url": chat_lnurl_url(request, chat.id),
+        "lnurl": lnurl_encode_chat(request, chat.id, chat.token),
+        "url": chat_lnurl_url(request, chat.id, chat.token),
     }
 
 
@@ -226,6 +349,7 @@ async def api_send_public_message(
     request: Request,
     user_id: str | None = Depends(optional_user_id),
 ) -> ChatPaymentRequest:
+    await _check_rate_limit(request, categories_id, data.sender_id)
     try:
         base_url = str(request.base_url)
         return await send_public_message(categories_id, chat_id, data, user_id=user_id, base_url=base_url)
@@ -289,7 +413,9 @@ async def api_send_tip(
     categories_id: str,
     chat_id: str,
     data: TipRequest,
+    request: Request,
 ) -> ChatPaymentRequest:
+    await _check_rate_limit(request, categories_id, data.sender_id)
     try:
         return await request_tip(
             categories_id,
@@ -297,6 +423,8 @@ async def api_send_tip(
             data.amount,
             data.sender_id,
             data.sender_name,
+            token=data.token,
+            base_url=str(request.base_url),
         )
     except ValueError as exc:
         raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
@@ -308,27 +436,47 @@ async def api_send_tip(
     summary="get paginated list of chats",
     response_description="list of chats",
     openapi_extra=generate_filter_params_openapi(ChatsFilters),
-    response_model=Page[ChatSession],
+    response_model=Page[ChatSummary],
 )
 async def api_get_chats_paginated(
     account_id: AccountId = Depends(check_account_id_exists),
     categories_id: str | None = None,
     filters: Filters = Depends(chats_filters),
-) -> Page[ChatSession]:
-
-    categories_ids = await get_categories_ids_by_user(account_id.id)
-
-    if categories_id:
-        if categories_id not in categories_ids:
-            raise HTTPException(HTTPStatus.FORBIDDEN, "Not your categories.")
-        categories_ids = [categories_id]
-
+) -> Page[ChatSummary]:
+    # ownership is part of the query, other users' categories simply match nothing
     return await get_chats_paginated(
-        categories_ids=categories_ids,
+        user_id=account_id.id,
+        categories_id=categories_id,
         filters=filters,
     )
 
 
+@chat_api_router.get(
+    "/api/v1/chats/feed",
+    name="Chats Change Feed",
+    summary="Get the websocket channel that streams chat list changes for this account.",
+)
+async def api_get_chats_feed(
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> dict:
+    return {"channel": owner_channel(account_id.id)}
+
+
+@chat_api_router.get(
+    "/api/v1/chats/search",
+    name="Search Chat Messages",
+    summary="Full text search over the messages of this account's chats, best matches first.",
+    response_model=list[ChatSearchHit],
+)
+async def api_search_chat_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    categories_id: str | None = None,
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_RESULTS),
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> list[ChatSearchHit]:
+    return await search_chat_messages(account_id.id, q, categories_id=categories_id, limit=limit)
+
+
 @chat_api_router.get(
     "/api/v1/chats/{chat_id}",
     name="Get Chat (Admin)",
@@ -338,17 +486,62 @@ async def api_get_chats_paginated(
 )
 async def api_get_chat(
     chat_id: str,
+    messages_limit: int | None = Query(None, ge=1, le=MAX_MESSAGES_PAGE_SIZE),
     account_id: AccountId = Depends(check_account_id_exists),
 ) -> ChatSession:
-    chat = await get_chat(chat_id)
+    chat = await get_chat(chat_id, include_messages=not messages_limit)
     if not chat:
         raise HTTPException(HTTPStatus.NOT_FOUND, "Chat not found.")
     categories = await get_categories(account_id.id, chat.categories_id)
     if not categories:
         raise HTTPException(HTTPStatus.NOT_FOUND, "Categories deleted for this chat.")
+    if messages_limit:
+        await load_latest_messages(chat, messages_limit)
     return chat
 
 
+@chat_api_router.get(
+    "/api/v1/chats/{chat_id}/messages",
+    name="Get Chat Messages (Admin)",
+    summary="Get a page of chat messages, newest first, older pages via the `before` cursor.",
+    response_model=ChatMessagesPage,
+)
+async def api_get_chat_messages(
+    chat_id: str,
+    before: str | None = None,
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MAX_MESSAGES_PAGE_SIZE),
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> ChatMessagesPage:
+    chat = await get_chat(chat_id, include_messages=False)
+    if not chat:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Chat not found.")
+    categories = await get_categories(account_id.id, chat.categories_id)
+    if not categories:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Categories deleted for this chat.")
+    return await get_chat_messages_page(chat.id, before=before, limit=limit)
+
+
+@chat_api_router.get(
+    "/api/v1/chats/{chat_id}/events",
+    name="Get Chat Events (Admin)",
+    summary="Get the websocket events after sequence `after`, for resuming after a reconnect.",
+    response_model=ChatEventsPage,
+)
+async def api_get_chat_events(
+    chat_id: str,
+    after: int = Query(0, ge=0),
+    limit: int = Query(MAX_EVENTS_PAGE_SIZE, ge=1, le=MAX_EVENTS_PAGE_SIZE),
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> ChatEventsPage:
+    chat = await get_chat(chat_id, include_messages=False)
+    if not chat:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Chat not found.")
+    categories = await get_categories(account_id.id, chat.categories_id)
+    if not categories:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Categories deleted for this chat.")
+    return await get_chat_events_page(chat, after=after, limit=limit)
+
+
 @chat_api_router.post(
     "/api/v1/chats/{chat_id}/messages",
     name="Send Chat Message (Admin)",
@@ -416,3 +609,64 @@ async def api_mark_chat_seen(
         return await mark_chat_seen(chat_id)
     except ValueError as exc:
         raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+
+
+############################# Archive #############################
+@chat_api_router.get(
+    "/api/v1/archive",
+    name="Archived Chats List",
+    summary="get paginated list of archived chats",
+    response_description="list of archived chats, without their content",
+    openapi_extra=generate_filter_params_openapi(ArchivedChatsFilters),
+    response_model=Page[ArchivedChat],
+)
+async def api_get_archived_chats(
+    account_id: AccountId = Depends(check_account_id_exists),
+    categories_id: str | None = None,
+    filters: Filters = Depends(archived_chats_filters),
+) -> Page[ArchivedChat]:
+    return await get_archived_chats(
+        user_id=account_id.id,
+        categories_id=categories_id,
+        filters=filters,
+    )
+
+
+@chat_api_router.get(
+    "/api/v1/archive/{chat_id}",
+    name="Get Archived Chat",
+    summary="Get the archived chat with its messages.",
+)
+async def api_get_archived_chat(
+    chat_id: str,
+    account_id: AccountId = Depends(check_account_id_exists),
+) -> dict:
+    archived = await get_archived_chat(chat_id)
+    if not archived:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Archived chat not found.")
+    categories = await get_categories(account_id.id, archived.categories_id)
+    if not categories:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Archived chat not found.")
+    return get_archived_chat_export(archived)
+
+
+############################# Metrics #############################
+@chat_api_router.get(
+    "/api/v1/metrics",
+    name="Chat Metrics",
+    summary="Per-process counters for the chat caches and background work (admin only).",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_metrics() -> dict:
+    return {
+        "caches": cache_stats(),
+        "outbox": {**dispatcher.stats(), "jobs": await get_outbox_counts()},
+        "invoices": invoice_workers.stats(),
+        "cleanup": cleanup_stats.stats(),
+        "archive": archive_stats.stats(),
+        "expired_payments": payments_stats.stats(),
+        "rates": fiat_rates.stats(),
+        "writers": chat_writers.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "pubsub": chat_pubsub.stats(),
+    }
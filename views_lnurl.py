@@ -16,7 +16,7 @@ from lnurl import (
 from pydantic import parse_obj_as
 
 from .crud import get_categories_by_id, get_chat
-from .services import _resolve_category_wallet
+from .services import _resolve_category_wallet, materialize_chat, read_chat_token
 
 chat_lnurl_router = APIRouter()
 
@@ -36,8 +36,9 @@ async def api_lnurl_callback(
     request: Request,
     chat_id: str,
     amount: int = Query(...),
+    token: str | None = Query(None),
 ) -> LnurlErrorResponse | LnurlPayActionResponse:
-    chat = await get_chat(chat_id)
+    chat = await get_chat(chat_id, include_messages=False) or read_chat_token(token, chat_id)
     if not chat:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Chat does not exist.")
     category = await get_categories_by_id(chat.categories_id)
@@ -54,6 +55,9 @@ async def api_lnurl_callback(
     if not wallet_id:
         return LnurlErrorResponse(reason="Category wallet not configured.")
 
+    if chat.token and not await materialize_chat(chat_id, token, str(request.base_url)):
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Chat does not exist.")
+
     amount_sat = int(amount / 1000)
     payment = await create_invoice(
         wallet_id=wallet_id,
@@ -74,8 +78,8 @@ async def api_lnurl_callback(
     "/lnurl/{chat_id}",
     name="chat.api_lnurl_response",
 )
-async def api_lnurl_response(request: Request, chat_id: str) -> LnurlPayResponse:
-    chat = await get_chat(chat_id)
+async def api_lnurl_response(request: Request, chat_id: str, token: str | None = Query(None)) -> LnurlPayResponse:
+    chat = await get_chat(chat_id, include_messages=False) or read_chat_token(token, chat_id)
     if not chat:
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Chat does not exist.")
     category = await get_categories_by_id(chat.categories_id)
@@ -83,6 +87,8 @@ async def api_lnurl_response(request: Request, chat_id: str) -> LnurlPayResponse
         raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Chat does not accept balance.")
 
     url = request.url_for("chat.api_lnurl_callback", chat_id=chat.id)
+    if chat.token:
+        url = url.include_query_params(token=chat.token)
     callback_url = parse_obj_as(CallbackUrl, str(url))
 
     metadata = LnurlPayMetadata(json.dumps([["text/plain", f"Chat balance for {category.name}"]]))
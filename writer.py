@@ -0,0 +1,50 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+
+class ChatWriters:
+    """
+    Serializes the writes to each chat inside this process, callers for the
+    same chat take turns. At most `max_queue` callers wait per chat, more are
+    turned away instead of piling up, unless they hold with `capped=False`
+    because they can't be retried. Writes from other workers are caught by
+    the row version `update_chat` checks.
+    """
+
+    def __init__(self, max_queue: int = 100) -> None:
+        self.max_queue = max_queue
+        self.rejected = 0
+        self.conflicts = 0
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._queued: dict[str, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, chat_id: str, capped: bool = True) -> AsyncIterator[None]:
+        queued = self._queued.get(chat_id, 0)
+        if capped and queued > self.max_queue:
+            self.rejected += 1
+            raise ValueError("Chat is busy, try again.")
+        self._queued[chat_id] = queued + 1
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:
+                yield
+        finally:
+            self._queued[chat_id] -= 1
+            if not self._queued[chat_id]:
+                # nobody holds or waits for it any more
+                del self._queued[chat_id]
+                self._locks.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self._locks),
+            "queued": sum(self._queued.values()),
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "conflicts": self.conflicts,
+        }
+
+
+chat_writers = ChatWriters()